@@ -1,4 +1,4 @@
-from flask import Flask, redirect, url_for
+from flask import Flask, redirect, url_for, request, flash, jsonify
 from flask_migrate import Migrate
 
 from app.extensions import db, login_manager
@@ -9,24 +9,35 @@ from app.pacientes import pacientes_bp
 from app.ayudas import ayudas_bp
 from app.enfermeria.routes import enfermeria_bp
 from app.menu import menu_bp
+from app.metricas import metricas_bp
+from app.catalogos import catalogos_bp
+from app.pdf import pdf_bp
 from app.utils.fechas import ahora_bogota
 from app.inventario.routes import inventario_bp
 from app.param.routes import param_bp
+from app.cli import registrar_comandos
+from app.utils.motor import configurar_motor
+from app.utils.transacciones import BaseDatosOcupada
+from app.utils.render_pdf import ColaLlena
+from config import obtener_config
 from datetime import datetime
 
 migrate = Migrate()
 
 
-def create_app():
+def create_app(config_name=None):
     app = Flask(__name__, template_folder='templates')
 
-    # Configuración básica
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///historia_clinica.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['SECRET_KEY'] = 'tu_clave_secreta_aqui'
+    # Configuración por entorno (APP_ENV=development|testing|production)
+    config_class = obtener_config(config_name)
+    app.config.from_object(config_class)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = config_class.opciones_motor(
+        app.config['SQLALCHEMY_DATABASE_URI']
+    )
 
     # Extensiones
     db.init_app(app)
+    configurar_motor(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
@@ -39,11 +50,34 @@ def create_app():
     app.register_blueprint(menu_bp, url_prefix='/menu')
     app.register_blueprint(inventario_bp)
     app.register_blueprint(param_bp)
+    app.register_blueprint(metricas_bp)
+    app.register_blueprint(catalogos_bp)
+    app.register_blueprint(pdf_bp)
+
+    # Comandos de consola (flask <comando>)
+    registrar_comandos(app)
 
     # Ruta raíz
     @app.route('/')
     def index():
         return redirect(url_for('menu.inicio'))
+
+    @app.errorhandler(BaseDatosOcupada)
+    def base_datos_ocupada(e):
+        # La escritura no se pudo hacer: avisamos en vez de perder el formulario en un 500
+        if request.accept_mimetypes.best == 'application/json' or request.is_json:
+            return jsonify({'error': str(e)}), 503
+        flash(f'⚠️ {e}', 'warning')
+        return redirect(request.referrer or url_for('menu.inicio'))
+
+    @app.errorhandler(ColaLlena)
+    def cola_pdf_llena(e):
+        # Hay demasiados PDF en proceso: se rechaza para no frenar al resto de la app
+        if request.accept_mimetypes.best == 'application/json' or request.is_json:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': '10'}
+        flash(f'⚠️ {e}', 'warning')
+        return redirect(request.referrer or url_for('menu.inicio'))
+
     @app.context_processor
     def inject_now():
         from datetime import datetime
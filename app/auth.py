@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from app.models import User
 from app.extensions import db
+from app.utils.transacciones import confirmar
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -31,7 +32,7 @@ def register():
         nuevo_usuario = User(username=username, email=email)
         nuevo_usuario.set_password(password)
         db.session.add(nuevo_usuario)
-        db.session.commit()
+        confirmar()
         flash('Registro exitoso. Ya puedes iniciar sesión.', 'success')
         return redirect(url_for('auth.login'))
 
@@ -1,6 +1,6 @@
 from flask import (
     render_template, request, redirect, url_for,
-    flash, jsonify, current_app, send_from_directory, send_file, make_response
+    flash, jsonify, current_app, send_from_directory, send_file, make_response, abort
 )
 from flask_login import current_user, login_required
 from app.ayudas import ayudas_bp
@@ -10,33 +10,44 @@ from app.models import (
     LabSolicitud, LabResultado, OrdenMedica, OrdenLaboratorioItem
 )
 from app.extensions import db
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from app.utils.transacciones import confirmar
+from app.utils.busqueda_pacientes import buscar_pacientes
+from app.utils.cache_catalogos import catalogo
+from app.utils.cache_pdf import respuesta_pdf
+from app.utils.render_pdf import renderizar, encolar_pdf, ErrorPDF
+from app.utils.rangos_laboratorio import marcar_solicitudes
+from app.utils.almacen_archivos import almacen, es_clave, guardar_subida, soltar_archivos, borrar_contenidos
+from app.utils.envio_archivos import enviar_contenido
+from app.utils.miniaturas import (
+    VARIANTES, MIMETYPE as MIMETYPE_MINIATURA, admite, encolar_miniaturas, sufijo as sufijo_derivado,
+)
+from app.utils.acumulado_laboratorio import (
+    acumulado_historia, datos_sparklines, exportar_csv, exportar_xlsx, sparkline,
+)
+from app.utils.carga_laboratorios import cargar_resultados, guardar_resultados, COLUMNAS as COLUMNAS_CARGA
+from app.utils.plantilla_laboratorios import plantilla_temporal, MIMETYPE as MIMETYPE_XLSX
+from app.utils.texto import valor_numerico
+from app.utils.versiones_historia import marcar_historias
 from datetime import datetime
+import json
 import os
 import pandas as pd
-import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from io import BytesIO
 from app.utils.fechas import ahora_bogota
 from werkzeug.utils import secure_filename
-from xhtml2pdf import pisa  # Cambiamos pdfkit por pisa
 from io import BytesIO
 
-UPLOAD_SUBFOLDER = os.path.join('uploads', 'ayudas')
-
-def guardar_archivo_ayuda(historia_id: int, tipo: str, file_storage):
-    """Guarda un archivo para una ayuda diagnóstica y devuelve la ruta RELATIVA."""
-    if not file_storage or not file_storage.filename:
-        return None
+def guardar_archivo_ayuda(file_storage):
+    """Guarda un archivo de ayuda diagnóstica en el almacén por contenido.
 
-    nombre_seguro = secure_filename(file_storage.filename)
-    base_dir = os.path.join(current_app.root_path, UPLOAD_SUBFOLDER, tipo, str(historia_id))
-    os.makedirs(base_dir, exist_ok=True)
-
-    ruta_absoluta = os.path.join(base_dir, nombre_seguro)
-    file_storage.save(ruta_absoluta)
-
-    ruta_relativa = os.path.relpath(ruta_absoluta, current_app.root_path)
-    return ruta_relativa
+    Devuelve ``(archivo_id, nombre)``, o ``(None, None)`` si no vino archivo.
+    """
+    archivo_id = guardar_subida(file_storage)
+    if archivo_id is None:
+        return None, None
+    return archivo_id, secure_filename(file_storage.filename)
 
 
 # ========== RUTAS PRINCIPALES ==========
@@ -61,14 +72,7 @@ def buscar_paciente():
         flash('Ingrese un criterio de búsqueda (nombre o número de historia/paciente).', 'warning')
         return redirect(url_for('ayudas.inicio_ayudas'))
 
-    pacientes = (
-        Paciente.query
-        .filter(
-            (Paciente.nombre.ilike(f"%{criterio}%")) |
-            (Paciente.numero.ilike(f"%{criterio}%"))
-        )
-        .all()
-    )
+    pacientes = buscar_pacientes(criterio, limite=50)
 
     if not pacientes:
         flash('No se encontraron pacientes con ese criterio.', 'info')
@@ -139,19 +143,21 @@ def ayudas_imagenes(historia_id):
             fecha_str = request.form.get('fecha_resultado', '').strip()
             fecha = datetime.strptime(fecha_str, '%Y-%m-%d') if fecha_str else None
             observaciones = request.form.get('observaciones', '').strip()
-            archivo_rel = guardar_archivo_ayuda(historia_id, 'imagenes', request.files.get('archivo'))
-
             if nombre:
+                archivo_id, nombre_archivo = guardar_archivo_ayuda(request.files.get('archivo'))
                 ayuda = AyudaDiagnostica(
                     historia_id=historia.id,
                     tipo='imagen',
                     nombre_examen=nombre,
                     fecha_resultado=fecha,
-                    archivo=archivo_rel,
+                    archivo_id=archivo_id,
+                    nombre_archivo=nombre_archivo,
                     observaciones=observaciones
                 )
                 db.session.add(ayuda)
-                db.session.commit()
+                confirmar()
+                if ayuda.contenido:
+                    encolar_miniaturas(ayuda.contenido.sha256, ayuda.contenido.tipo_mime)
                 flash('Estudio de imágenes registrado correctamente.', 'success')
             else:
                 flash('El nombre del examen es obligatorio.', 'warning')
@@ -160,11 +166,12 @@ def ayudas_imagenes(historia_id):
             ayuda_id = request.form.get('ayuda_id', type=int)
             ayuda = AyudaDiagnostica.query.get_or_404(ayuda_id)
             ayuda.observaciones = request.form.get('observaciones', '').strip()
-            db.session.commit()
+            confirmar()
             flash('Observaciones actualizadas.', 'success')
 
     examenes = (
         AyudaDiagnostica.query
+        .options(joinedload(AyudaDiagnostica.contenido))
         .filter_by(historia_id=historia.id, tipo='imagen')
         .order_by(AyudaDiagnostica.fecha_resultado.desc().nullslast())
         .all()
@@ -175,6 +182,7 @@ def ayudas_imagenes(historia_id):
         paciente=paciente,
         historia=historia,
         examenes=examenes,
+        con_miniatura=admite,
         current_user=current_user
     )
 
@@ -204,6 +212,37 @@ def ayudas_laboratorios(historia_id):
     )
 
 
+@ayudas_bp.route('/historia/<int:historia_id>/laboratorios/acumulado', methods=['GET'])
+@login_required
+def acumulado_laboratorios(historia_id):
+    """Resultados de la historia por parámetro y fecha (formato: html, csv, xlsx o json)."""
+    historia = HistoriaClinica.query.get_or_404(historia_id)
+    acumulado = acumulado_historia(historia_id)
+    formato = request.args.get('formato', 'html')
+
+    if formato == 'json':
+        return jsonify(datos_sparklines(acumulado))
+    if formato in ('csv', 'xlsx'):
+        nombre = f"Acumulado_lab_{historia.numero_historia or historia.id}.{formato}"
+        contenido = exportar_csv(acumulado) if formato == 'csv' else exportar_xlsx(acumulado)
+        return send_file(
+            BytesIO(contenido),
+            mimetype='text/csv' if formato == 'csv' else
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            as_attachment=True,
+            download_name=secure_filename(nombre),
+        )
+
+    return render_template(
+        'laboratorio/acumulado.html',
+        historia=historia,
+        paciente=historia.paciente,
+        acumulado=acumulado,
+        sparkline=sparkline,
+        current_user=current_user
+    )
+
+
 @ayudas_bp.route('/historia/<int:historia_id>/laboratorios/nueva', methods=['GET', 'POST'])
 @login_required
 def nueva_solicitud_laboratorio(historia_id):
@@ -240,7 +279,7 @@ def nueva_solicitud_laboratorio(historia_id):
             )
             db.session.add(resultado)
 
-        db.session.commit()
+        confirmar()
         flash('Solicitud de laboratorio creada.', 'success')
         return redirect(url_for('ayudas.ver_solicitud_laboratorio', solicitud_id=solicitud.id))
 
@@ -267,23 +306,15 @@ def ver_solicitud_laboratorio(solicitud_id):
             campo_interp = f"interp_{res.id}"
 
             if campo_valor in request.form:
-                nuevo_valor = request.form.get(campo_valor, '').strip()
-                res.valor = nuevo_valor
-
-                try:
-                    v = float(nuevo_valor.replace(',', '.'))
-                    p = res.parametro
-                    if p.valor_ref_min is not None and p.valor_ref_max is not None:
-                        res.flag_fuera_rango = not (p.valor_ref_min <= v <= p.valor_ref_max)
-                except ValueError:
-                    res.flag_fuera_rango = False
+                res.valor = request.form.get(campo_valor, '').strip()
 
             if campo_interp in request.form:
                 res.interpretacion = request.form.get(campo_interp, '').strip()
 
         solicitud.fecha_resultado = ahora_bogota()
         solicitud.estado = 'interpretado'
-        db.session.commit()
+        marcar_solicitudes([solicitud.id])
+        confirmar()
         flash('Resultados de laboratorio actualizados.', 'success')
         return redirect(url_for('ayudas.ver_solicitud_laboratorio', solicitud_id=solicitud.id))
 
@@ -310,151 +341,9 @@ def ver_solicitud_laboratorio(solicitud_id):
 @login_required
 def descargar_plantilla_laboratorios():
     """Descarga una plantilla Excel para carga masiva de exámenes."""
-    wb = openpyxl.Workbook()
-
-    # HOJA PRINCIPAL: EXÁMENES
-    ws = wb.active
-    ws.title = "Examenes"
-
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    center_align = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
-    headers = [
-        'NUMERO_PACIENTE',
-        'EXAMEN',
-        'PARAMETRO',
-        'VALOR',
-        'FECHA_RESULTADO',
-        'LABORATORIO'
-    ]
-
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num)
-        cell.value = header
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = center_align
-        cell.border = thin_border
-
-    pacientes = Paciente.query.order_by(Paciente.numero).all()
-    row_num = 2
-    for p in pacientes:
-        cell = ws.cell(row=row_num, column=1)
-        cell.value = p.numero
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal="left", vertical="center")
-
-        for col_num in range(2, len(headers) + 1):
-            c = ws.cell(row=row_num, column=col_num)
-            c.border = thin_border
-            c.alignment = Alignment(horizontal="left", vertical="center")
-
-        row_num += 1
-
-    ws.column_dimensions['A'].width = 18
-    ws.column_dimensions['B'].width = 25
-    ws.column_dimensions['C'].width = 25
-    ws.column_dimensions['D'].width = 15
-    ws.column_dimensions['E'].width = 20
-    ws.column_dimensions['F'].width = 20
-
-    # HOJA DE INSTRUCCIONES
-    ws_instruc = wb.create_sheet("Instrucciones", 0)
-    ws_instruc.column_dimensions['A'].width = 90
-
-    instruc = [
-        "INSTRUCCIONES DE CARGA MASIVA DE EXÁMENES DE LABORATORIO",
-        "",
-        "1. Hoja \"Examenes\":",
-        "   - La columna NUMERO_PACIENTE ya viene prellenada con los pacientes existentes.",
-        "   - NO modifique estos números. Si no va a registrar exámenes para un paciente,",
-        "     simplemente deje su fila en blanco.",
-        "",
-        "2. COLUMNAS OBLIGATORIAS POR CADA FILA CON DATOS:",
-        "   - NUMERO_PACIENTE: Ya viene prellenado.",
-        "   - EXAMEN: Nombre exacto del examen en el sistema.",
-        "   - PARAMETRO: Nombre exacto del parámetro del examen.",
-        "   - VALOR: Valor del resultado.",
-        "   - FECHA_RESULTADO: Fecha en formato DD/MM/YYYY.",
-        "   - LABORATORIO: Nombre del laboratorio que realizó el examen.",
-        "",
-        "3. REGLAS:",
-        "   - Puede dejar filas sin exámenes si no va a cargar nada para ese paciente.",
-        "   - No cambie ni elimine los números de pacientes prellenados.",
-        "   - No agregue filas intermedias vacías entre filas que sí tengan datos.",
-        "",
-        "4. HOJA \"Catalogos\":",
-        "   - Contiene la lista de exámenes y parámetros válidos.",
-        "   - Copie y pegue desde allí los valores de EXAMEN y PARAMETRO para evitar errores",
-        "     de escritura.",
-        "",
-        "5. DESPUÉS DE LLENAR:",
-        "   - Guardar el archivo como Excel (.xlsx).",
-        "   - Ir a Módulo Ayudas > Laboratorios > Carga masiva.",
-        "   - Seleccionar este archivo.",
-        "   - Hacer clic en \"Procesar carga masiva\".",
-    ]
-
-    for idx, linea in enumerate(instruc, 1):
-        cell = ws_instruc.cell(row=idx, column=1)
-        cell.value = linea
-        if idx == 1:
-            cell.font = Font(bold=True, size=12)
-
-    # HOJA DE CATÁLOGOS
-    ws_cat = wb.create_sheet("Catalogos", 2)
-
-    ws_cat['A1'] = "EXAMEN_ID"
-    ws_cat['B1'] = "EXAMEN_NOMBRE"
-    ws_cat['C1'] = "GRUPO"
-    ws_cat['D1'] = "PARAMETRO_NOMBRE"
-    ws_cat['E1'] = "UNIDAD"
-    ws_cat['F1'] = "VALOR_REF_MIN"
-    ws_cat['G1'] = "VALOR_REF_MAX"
-
-    for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G']:
-        ws_cat.column_dimensions[col].width = 22
-
-    header_cat_font = Font(bold=True)
-    for col in range(1, 8):
-        ws_cat.cell(row=1, column=col).font = header_cat_font
-
-    examenes = CatLaboratorioExamen.query.order_by(
-        CatLaboratorioExamen.grupo, CatLaboratorioExamen.nombre
-    ).all()
-
-    row = 2
-    for ex in examenes:
-        if ex.parametros:
-            for p in ex.parametros:
-                ws_cat.cell(row=row, column=1, value=ex.id)
-                ws_cat.cell(row=row, column=2, value=ex.nombre)
-                ws_cat.cell(row=row, column=3, value=ex.grupo or "")
-                ws_cat.cell(row=row, column=4, value=p.nombre)
-                ws_cat.cell(row=row, column=5, value=p.unidad or "")
-                ws_cat.cell(row=row, column=6, value=p.valor_ref_min)
-                ws_cat.cell(row=row, column=7, value=p.valor_ref_max)
-                row += 1
-        else:
-            ws_cat.cell(row=row, column=1, value=ex.id)
-            ws_cat.cell(row=row, column=2, value=ex.nombre)
-            ws_cat.cell(row=row, column=3, value=ex.grupo or "")
-            row += 1
-
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-
     return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        plantilla_temporal(),
+        mimetype=MIMETYPE_XLSX,
         as_attachment=True,
         download_name='Plantilla_Carga_Masiva_Laboratorios.xlsx'
     )
@@ -470,111 +359,20 @@ def carga_masiva_laboratorios():
             return redirect(url_for('ayudas.carga_masiva_laboratorios'))
 
         try:
+            # Todo como texto: los documentos y valores no deben volverse float
             if file.filename.endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(file, sheet_name='Examenes')
+                df = pd.read_excel(file, sheet_name='Examenes', dtype=str)
             else:
-                df = pd.read_csv(file)
+                df = pd.read_csv(file, dtype=str)
 
-            columnas_req = [
-                'NUMERO_PACIENTE', 'EXAMEN', 'PARAMETRO',
-                'VALOR', 'FECHA_RESULTADO', 'LABORATORIO'
-            ]
-            faltantes = [c for c in columnas_req if c not in df.columns]
+            faltantes = [c for c in COLUMNAS_CARGA if c not in df.columns]
             if faltantes:
                 flash(f'Columnas faltantes: {", ".join(faltantes)}', 'danger')
                 return redirect(url_for('ayudas.carga_masiva_laboratorios'))
 
-            creados = 0
-            errores = []
-
-            for idx, row in df.iterrows():
-                try:
-                    num_pac = str(row['NUMERO_PACIENTE']).strip()
-                    nombre_exam = str(row['EXAMEN']).strip()
-                    nombre_param = str(row['PARAMETRO']).strip()
-                    valor = str(row['VALOR']).strip()
-                    lab_nombre = str(row.get('LABORATORIO') or '').strip()
-
-                    fecha_res = None
-                    if pd.notna(row.get('FECHA_RESULTADO')):
-                        try:
-                            fecha_res = pd.to_datetime(row['FECHA_RESULTADO'], format='%d/%m/%Y').to_pydatetime()
-                        except Exception:
-                            try:
-                                fecha_res = pd.to_datetime(row['FECHA_RESULTADO']).to_pydatetime()
-                            except Exception:
-                                errores.append(f"Fila {idx+2}: Fecha inválida")
-                                continue
-
-                    if not (num_pac and nombre_exam and nombre_param):
-                        errores.append(f"Fila {idx+2}: Falta información obligatoria")
-                        continue
-
-                    paciente = Paciente.query.filter_by(numero=num_pac).first()
-                    if not paciente:
-                        errores.append(f"Fila {idx+2}: Paciente {num_pac} no encontrado")
-                        continue
-
-                    historia = (
-                        HistoriaClinica.query
-                        .filter_by(paciente_id=paciente.id)
-                        .order_by(HistoriaClinica.fecha_registro.desc())
-                        .first()
-                    )
-                    if not historia:
-                        errores.append(f"Fila {idx+2}: Paciente {num_pac} sin historia clínica")
-                        continue
-
-                    examen = CatLaboratorioExamen.query.filter_by(nombre=nombre_exam).first()
-                    if not examen:
-                        errores.append(f"Fila {idx+2}: Examen '{nombre_exam}' no encontrado")
-                        continue
-
-                    param = CatLaboratorioParametro.query.filter_by(
-                        examen_id=examen.id,
-                        nombre=nombre_param
-                    ).first()
-                    if not param:
-                        errores.append(f"Fila {idx+2}: Parámetro '{nombre_param}' no encontrado")
-                        continue
-
-                    solicitud = None
-                    if fecha_res:
-                        solicitud = (
-                            LabSolicitud.query
-                            .filter_by(
-                                historia_id=historia.id,
-                                laboratorio_nombre=lab_nombre
-                            )
-                            .filter(db.func.date(LabSolicitud.fecha_solicitud) == fecha_res.date())
-                            .first()
-                        )
-
-                    if not solicitud:
-                        solicitud = LabSolicitud(
-                            historia_id=historia.id,
-                            fecha_solicitud=fecha_res or ahora_bogota(),
-                            estado='completado',
-                            laboratorio_nombre=lab_nombre
-                        )
-                        db.session.add(solicitud)
-                        db.session.flush()
-
-                    resultado = LabResultado(
-                        solicitud_id=solicitud.id,
-                        examen_id=examen.id,
-                        parametro_id=param.id,
-                        valor=valor,
-                        unidad=param.unidad
-                    )
-                    db.session.add(resultado)
-                    creados += 1
-
-                except Exception as e:
-                    errores.append(f"Fila {idx+2}: {str(e)}")
-                    continue
-
-            db.session.commit()
+            resumen = cargar_resultados(df)
+            confirmar()
+            creados, errores = resumen.creados, resumen.errores
 
             msg = f'Se cargaron {creados} resultados de laboratorio.'
             if errores:
@@ -604,13 +402,7 @@ def autocomplete_pacientes():
     if not termino:
         return jsonify([])
 
-    pacientes = (
-        Paciente.query
-        .filter(Paciente.nombre.ilike(f"%{termino}%"))
-        .order_by(Paciente.nombre.asc())
-        .limit(10)
-        .all()
-    )
+    pacientes = buscar_pacientes(termino, limite=10)
 
     datos = [
         {"id": p.id, "nombre": p.nombre, "numero": p.numero}
@@ -623,16 +415,36 @@ def autocomplete_pacientes():
 @login_required
 def ver_archivo_ayuda(ayuda_id):
     ayuda = AyudaDiagnostica.query.get_or_404(ayuda_id)
-    if not ayuda.archivo:
+    if not ayuda.tiene_archivo:
         flash('Este examen no tiene archivo asociado.', 'warning')
         if ayuda.tipo == 'imagen':
             return redirect(url_for('ayudas.ayudas_imagenes', historia_id=ayuda.historia_id))
         return redirect(url_for('ayudas.ayudas_laboratorios', historia_id=ayuda.historia_id))
 
-    ruta_absoluta = os.path.join(current_app.root_path, ayuda.archivo)
-    directorio, nombre = os.path.split(ruta_absoluta)
+    if not ayuda.archivo_id:
+        # Archivos subidos antes del almacén por contenido
+        ruta_absoluta = os.path.join(current_app.root_path, ayuda.archivo)
+        directorio, nombre = os.path.split(ruta_absoluta)
+        return send_from_directory(directorio, nombre)
 
-    return send_from_directory(directorio, nombre)
+    contenido = ayuda.contenido
+    return enviar_contenido(
+        contenido.sha256, contenido.tipo_mime, nombre=ayuda.nombre_archivo or contenido.sha256,
+    )
+
+
+@ayudas_bp.route('/contenido/<clave>/<variante>.jpg')
+@login_required
+def derivado_archivo(clave, variante):
+    """Miniatura o vista previa de un contenido; la URL lleva el hash, así que no caduca."""
+    if not es_clave(clave) or variante not in VARIANTES:
+        abort(404)
+    if not almacen().existe(clave, sufijo_derivado(variante)):
+        abort(404)
+    return enviar_contenido(
+        clave, MIMETYPE_MINIATURA, sufijo=sufijo_derivado(variante),
+        max_age=current_app.config.get('MINIATURAS_CACHE_S', 31536000),
+    )
 
 
 @ayudas_bp.route('/eliminar/<int:ayuda_id>', methods=['POST'])
@@ -650,8 +462,11 @@ def eliminar_ayuda(ayuda_id):
             except OSError:
                 pass
 
+    # El contenido se borra solo si ninguna otra ayuda lo usa
+    sueltos = soltar_archivos([ayuda.archivo_id])
     db.session.delete(ayuda)
-    db.session.commit()
+    confirmar()
+    borrar_contenidos(sueltos)
     flash('La ayuda diagnóstica se eliminó correctamente.', 'success')
 
     if tipo == 'imagen':
@@ -659,88 +474,101 @@ def eliminar_ayuda(ayuda_id):
     return redirect(url_for('ayudas.ayudas_laboratorios', historia_id=historia_id))
 
 
+def _examenes_ordenados(historia_id):
+    """Exámenes de las órdenes de la historia (los ítems más recientes primero), en una consulta."""
+    examenes_cat = catalogo('lab_examenes')
+    ids = db.session.execute(
+        select(OrdenLaboratorioItem.examen_id)
+        .join(OrdenMedica, OrdenMedica.id == OrdenLaboratorioItem.orden_id)
+        .where(OrdenMedica.historia_id == historia_id)
+        .order_by(OrdenLaboratorioItem.id.desc())
+    ).scalars().all()
+    return [examenes_cat.get(examen_id) for examen_id in ids if examenes_cat.get(examen_id)]
+
+
+def _resultados_solicitud(solicitud_id, parametro_ids=None):
+    """parametro_id -> (valor, bandera) de los resultados de la solicitud, en una consulta."""
+    consulta = select(
+        LabResultado.parametro_id, LabResultado.valor, LabResultado.flag_fuera_rango
+    ).where(LabResultado.solicitud_id == solicitud_id)
+    if parametro_ids is not None:
+        consulta = consulta.where(LabResultado.parametro_id.in_(parametro_ids))
+    return {r.parametro_id: r for r in db.session.execute(consulta)}
+
+
 @ayudas_bp.route('/laboratorio/paciente/<int:historia_id>', methods=['GET', 'POST'])
 @login_required
 def laboratorio_paciente(historia_id):
     historia = HistoriaClinica.query.get_or_404(historia_id)
 
-    ordenes = OrdenMedica.query.filter_by(historia_id=historia_id).all()
-    orden_ids = [o.id for o in ordenes]
-
-    if not orden_ids:
-        items = []
-    else:
-        items = (
-            db.session.query(OrdenLaboratorioItem)
-            .filter(OrdenLaboratorioItem.orden_id.in_(orden_ids))
-            .order_by(OrdenLaboratorioItem.id.desc())
-            .all()
-        )
-
     solicitud = LabSolicitud.query.filter_by(historia_id=historia_id).first()
     if solicitud is None:
         solicitud = LabSolicitud(historia_id=historia_id)
         db.session.add(solicitud)
-        db.session.commit()
+        confirmar()
+
+    parametros_cat = catalogo('lab_parametros')
 
     if request.method == 'POST':
-        form = request.form
-        for key, value in form.items():
+        enviados = {}
+        for key, value in request.form.items():
             if not key.startswith('resultado['):
                 continue
-
             try:
-                parametro_id = int(key[len('resultado['):-1])
+                enviados[int(key[len('resultado['):-1])] = value.strip()
             except ValueError:
                 continue
 
-            valor = value.strip()
-
-            res = LabResultado.query.filter_by(
-                solicitud_id=solicitud.id,
-                parametro_id=parametro_id
-            ).first()
-
-            if res is None and valor:
-                param = CatLaboratorioParametro.query.get(parametro_id)
-                if not param:
-                    continue
-                res = LabResultado(
-                    solicitud_id=solicitud.id,
-                    examen_id=param.examen_id,
-                    parametro_id=parametro_id,
-                    valor=valor,
-                    unidad=param.unidad,
-                )
-                db.session.add(res)
-            elif res:
-                res.valor = valor or None
+        # Solo se escriben los parámetros cuyo valor cambió
+        existentes = _resultados_solicitud(solicitud.id, list(enviados))
+        filas = []
+        for parametro_id, valor in enviados.items():
+            anterior = existentes.get(parametro_id)
+            if (anterior.valor if anterior else None) == (valor or None):
+                continue
+            param = parametros_cat.get(parametro_id)
+            if not param:
+                continue
+            filas.append({
+                'solicitud_id': solicitud.id,
+                'examen_id': param.examen_id,
+                'parametro_id': parametro_id,
+                'valor': valor or None,
+                'valor_num': valor_numerico(valor),
+                'unidad': param.unidad,
+            })
+
+        if filas:
+            guardar_resultados(filas)
+            marcar_solicitudes([solicitud.id])
+            marcar_historias([historia_id])
+            confirmar()
+
+        if request.headers.get('HX-Request'):
+            # htmx: solo las filas que cambiaron, cada una reemplaza la suya (hx-swap-oob)
+            cambiados = [f['parametro_id'] for f in filas]
+            resultados = _resultados_solicitud(solicitud.id, cambiados) if cambiados else {}
+            respuesta = make_response(render_template(
+                'ayudas/laboratorio_paciente_filas.html',
+                parametros=[parametros_cat.get(pid) for pid in cambiados],
+                resultados=resultados,
+                oob=True,
+            ))
+            respuesta.headers['HX-Trigger'] = json.dumps({'resultadosGuardados': len(filas)})
+            return respuesta
 
-        db.session.commit()
         flash('Resultados de laboratorio actualizados', 'success')
         return redirect(url_for('ayudas.laboratorio_paciente', historia_id=historia_id))
 
-    items_con_parametros = []
-    resultados_existentes = {
-        r.parametro_id: r
-        for r in LabResultado.query.filter_by(solicitud_id=solicitud.id).all()
-    }
-
-    for it in items:
-        examen = it.examen
-        parametros = (
-            CatLaboratorioParametro.query
-            .filter_by(examen_id=it.examen_id)
-            .order_by(CatLaboratorioParametro.id)
-            .all()
-        )
-
-        items_con_parametros.append({
-            'item': it,
+    resultados_existentes = _resultados_solicitud(solicitud.id)
+    items_con_parametros = [
+        {
             'examen': examen,
-            'parametros': parametros,
+            'parametros': parametros_cat.grupo(examen.id),
             'resultados': resultados_existentes,
-        })
+        }
+        for examen in _examenes_ordenados(historia_id)
+    ]
 
     return render_template(
         'ayudas/laboratorio_paciente.html',
@@ -749,10 +577,44 @@ def laboratorio_paciente(historia_id):
         solicitud=solicitud,
     )
 
+CATALOGOS_INFORME_LAB = ('laboratorio',)
+
+
 # CORRECCIÓN DE LA RUTA PDF: Se usa ayudas_bp y los modelos correctos definidos arriba
 @ayudas_bp.route('/historia/<int:historia_id>/generar_pdf_laboratorio')
 @login_required
 def generar_pdf_laboratorio(historia_id):
+    historia = HistoriaClinica.query.get_or_404(historia_id)
+    nombre_archivo = f"Lab_{historia.paciente.nombre.replace(' ', '_')}.pdf"
+
+    # El PDF se genera con xhtml2pdf en el pool de PDF y queda en la caché en disco
+    try:
+        return respuesta_pdf(
+            'laboratorio', historia_id, 'ayudas/informe.html',
+            generar=lambda: renderizar('xhtml2pdf', _html_informe_laboratorio(historia_id)),
+            nombre_descarga=nombre_archivo,
+            catalogos=CATALOGOS_INFORME_LAB,
+        )
+    except ErrorPDF:
+        flash("Error al crear el PDF", "danger")
+        return redirect(url_for('ayudas.laboratorio_paciente', historia_id=historia_id))
+
+
+@ayudas_bp.route('/historia/<int:historia_id>/generar_pdf_laboratorio/trabajo', methods=['POST'])
+@login_required
+def encolar_pdf_laboratorio(historia_id):
+    """Encola el informe y responde al instante; el progreso está en /pdf/trabajos/<id>."""
+    historia = HistoriaClinica.query.get_or_404(historia_id)
+    trabajo = encolar_pdf(
+        'laboratorio', historia_id, 'ayudas/informe.html',
+        generar_html=lambda: _html_informe_laboratorio(historia_id),
+        nombre_descarga=f"Lab_{historia.paciente.nombre.replace(' ', '_')}.pdf",
+        motor='xhtml2pdf', catalogos=CATALOGOS_INFORME_LAB,
+    )
+    return jsonify(trabajo), 200 if trabajo['estado'] == 'listo' else 202
+
+
+def _html_informe_laboratorio(historia_id):
     # 1. Obtención de datos (Misma lógica que ya tienes)
     historia = HistoriaClinica.query.get_or_404(historia_id)
     paciente = historia.paciente
@@ -765,31 +627,15 @@ def generar_pdf_laboratorio(historia_id):
     resultados_existentes = {r.parametro_id: r for r in LabResultado.query.filter_by(solicitud_id=solicitud.id).all()} if solicitud else {}
     
     items_con_parametros = []
+    parametros_cat = catalogo('lab_parametros')
     for it in items:
         examen = it.examen
-        parametros = CatLaboratorioParametro.query.filter_by(examen_id=it.examen_id).order_by(CatLaboratorioParametro.id).all()
+        parametros = parametros_cat.grupo(it.examen_id)
         items_con_parametros.append({'examen': examen, 'parametros': parametros, 'resultados': resultados_existentes})
 
     # 2. Renderizar HTML
-    html = render_template('ayudas/informe.html', 
+    return render_template('ayudas/informe.html', 
                            historia=historia, 
                            paciente=paciente, 
                            items_con_parametros=items_con_parametros)
 
-    # 3. Generar PDF con xhtml2pdf
-    buffer = BytesIO()
-    pisa_status = pisa.CreatePDF(html, dest=buffer)
-
-    # 4. Verificar errores y retornar
-    if pisa_status.err:
-        flash("Error al crear el PDF", "danger")
-        return redirect(url_for('ayudas.laboratorio_paciente', historia_id=historia_id))
-
-    buffer.seek(0)
-    response = make_response(buffer.read())
-    response.headers['Content-Type'] = 'application/pdf'
-    nombre_archivo = f"Lab_{paciente.nombre.replace(' ', '_')}.pdf"
-    response.headers['Content-Disposition'] = f'inline; filename={nombre_archivo}'
-    
-    return response
-
@@ -0,0 +1,74 @@
+import json
+
+from flask import Blueprint, jsonify, request, abort, current_app
+from flask_login import login_required
+
+from app.utils.indice_catalogo import CARGADORES, obtener_indice, buscar_en_catalogo
+
+catalogos_bp = Blueprint('catalogos', __name__, url_prefix='/catalogos')
+
+POR_PAGINA_MAX = 50
+
+# (catálogo, versión) -> cuerpo JSON ya serializado del catálogo completo
+_cuerpos = {}
+
+
+def _item(entrada):
+    return {'codigo': entrada.codigo, 'nombre': entrada.nombre, **entrada.extra}
+
+
+@catalogos_bp.route('/<nombre>/buscar')
+@login_required
+def buscar(nombre):
+    """Búsqueda paginada y ordenada por relevancia para los formularios."""
+    if nombre not in CARGADORES:
+        abort(404)
+
+    termino = request.args.get('q', '').strip()
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    por_pagina = min(max(request.args.get('por_pagina', 20, type=int), 1), POR_PAGINA_MAX)
+
+    # Se pide uno de más para saber si hay otra página
+    entradas = buscar_en_catalogo(
+        nombre, termino, limite=por_pagina + 1, desplazamiento=(pagina - 1) * por_pagina
+    ) if termino else []
+
+    return jsonify({
+        'items': [_item(e) for e in entradas[:por_pagina]],
+        'pagina': pagina,
+        'hay_mas': len(entradas) > por_pagina,
+        'version': obtener_indice(nombre).version,
+    })
+
+
+@catalogos_bp.route('/<nombre>')
+@login_required
+def completo(nombre):
+    """Catálogo completo con ETag por versión.
+
+    Con ``?v=<version>`` vigente la respuesta se puede guardar sin revalidar;
+    sin ``v`` el navegador revalida y recibe 304 mientras no cambie.
+    """
+    if nombre not in CARGADORES:
+        abort(404)
+
+    indice = obtener_indice(nombre)
+    clave = (nombre, indice.version)
+    cuerpo = _cuerpos.get(clave)
+    if cuerpo is None:
+        cuerpo = json.dumps(
+            {'version': indice.version, 'items': [_item(e) for e in indice.entradas]},
+            ensure_ascii=False,
+        )
+        # solo se guarda la versión vigente de cada catálogo
+        for viejo in [k for k in _cuerpos if k[0] == nombre]:
+            _cuerpos.pop(viejo, None)
+        _cuerpos[clave] = cuerpo
+
+    respuesta = current_app.response_class(cuerpo, mimetype='application/json')
+    respuesta.set_etag(f'{nombre}-v{indice.version}')
+    if request.args.get('v', type=int) == indice.version:
+        respuesta.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta.make_conditional(request)
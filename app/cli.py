@@ -0,0 +1,165 @@
+import os
+
+import click
+
+
+def registrar_comandos(app):
+    """Registra los comandos ``flask <comando>`` propios de la aplicación."""
+
+    @app.cli.command('verificar-planes')
+    def verificar_planes_cmd():
+        """Falla si alguna consulta caliente recorre una tabla completa."""
+        from app.utils.planes_consulta import CONSULTAS_CALIENTES, verificar_planes
+
+        fallas = verificar_planes()
+        for nombre in CONSULTAS_CALIENTES:
+            if nombre in fallas:
+                click.echo(f"✗ {nombre}: {'; '.join(fallas[nombre])}")
+            else:
+                click.echo(f"✓ {nombre}")
+
+        if fallas:
+            raise SystemExit(1)
+
+    @app.cli.command('invalidar-catalogo')
+    @click.argument('nombre')
+    def invalidar_catalogo_cmd(nombre):
+        """Sube la versión de un catálogo tras cargarlo por fuera de la app."""
+        from app.utils.transacciones import confirmar
+        from app.utils.versiones_catalogo import incrementar_version, version_catalogo
+
+        incrementar_version(nombre)
+        confirmar()
+        click.echo(f"{nombre}: versión {version_catalogo(nombre)}")
+
+    @app.cli.command('purgar-pacientes')
+    @click.option('--id', 'ids', type=int, multiple=True, help='Id de paciente (repetible).')
+    @click.option('--numero-prefijo', help='Documentos que empiezan así (p. ej. datos de prueba).')
+    @click.option('--simular', is_flag=True, help='Solo contar: deshace al final.')
+    @click.option('--si', is_flag=True, help='No pedir confirmación.')
+    def purgar_pacientes_cmd(ids, numero_prefijo, simular, si):
+        """Borra pacientes con todas sus historias, registros y órdenes."""
+        from app.extensions import db
+        from app.utils.transacciones import confirmar
+        from app.utils.purga_pacientes import (
+            seleccion_pacientes, purgar_pacientes, borrar_archivos, borrar_folios,
+        )
+
+        try:
+            seleccion = seleccion_pacientes(ids=ids, numero_prefijo=numero_prefijo)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+        conteos, archivos, paciente_ids = purgar_pacientes(seleccion)
+        for tabla, n in conteos.items():
+            click.echo(f"{tabla}: {n}")
+        click.echo(f"archivos de ayudas: {len(archivos)}")
+
+        if simular or not conteos['pacientes'] or not (si or click.confirm('¿Confirmar el borrado?')):
+            db.session.rollback()
+            click.echo("Sin cambios.")
+            return
+        confirmar()
+        borrar_archivos(archivos)
+        borrar_folios(paciente_ids)
+        click.echo(f"{conteos['pacientes']} pacientes eliminados.")
+
+    @app.cli.command('generar-miniaturas')
+    def generar_miniaturas_cmd():
+        """Genera las miniaturas que falten (p. ej. de archivos subidos antes de tenerlas)."""
+        from sqlalchemy import select
+        from app.extensions import db
+        from app.models import ArchivoAyuda
+        from app.utils.almacen_archivos import almacen
+        from app.utils.miniaturas import admite, generar_miniaturas
+
+        destino = almacen()
+        filas = db.session.execute(select(ArchivoAyuda.sha256, ArchivoAyuda.tipo_mime)).all()
+        generadas = 0
+        for clave, tipo_mime in filas:
+            if admite(tipo_mime) and generar_miniaturas(
+                destino, clave, tipo_mime, workers=app.config.get('MINIATURAS_WORKERS', 1),
+                timeout=app.config.get('MINIATURAS_TIMEOUT_S', 120),
+            ):
+                generadas += 1
+        click.echo(f"{generadas} de {len(filas)} archivos con miniaturas nuevas.")
+
+    @app.cli.command('barrer-archivos')
+    def barrer_archivos_cmd():
+        """Borra del almacén los contenidos que ninguna ayuda usa (p. ej. de subidas deshechas)."""
+        from app.utils.almacen_archivos import barrer_huerfanos
+
+        contenidos, temporales = barrer_huerfanos()
+        click.echo(f"{contenidos} contenidos huérfanos y {temporales} temporales borrados.")
+
+    @app.cli.command('ingesta-laboratorios')
+    @click.option('--dir', 'entrada', help='Carpeta de entrada (por defecto LAB_INGESTA_DIR).')
+    @click.option('--una-vez', is_flag=True, help='Procesar lo que haya y terminar.')
+    def ingesta_laboratorios_cmd(entrada, una_vez):
+        """Vigila la carpeta de exportes de los analizadores y carga sus resultados."""
+        import signal
+        import threading
+        from app.utils.ingesta_laboratorios import directorios, vigilar
+
+        dirs = directorios(entrada)
+        parar = threading.Event()
+        # SIGTERM (systemd, docker stop) termina después del bloque en curso
+        signal.signal(signal.SIGTERM, lambda *_: parar.set())
+
+        def al_procesar(resumen):
+            if resumen.destino is None:
+                click.echo(f"{resumen.archivo}: detenido tras {resumen.filas} filas; sigue en la próxima ejecución.")
+                return
+            click.echo(
+                f"{resumen.archivo}: {resumen.creados} resultados, {resumen.errores} errores "
+                f"-> {os.path.relpath(resumen.destino, dirs['entrada'])}"
+            )
+
+        if not una_vez:
+            click.echo(f"Vigilando {dirs['entrada']} (Ctrl+C para terminar)")
+        try:
+            vigilar(
+                dirs, al_procesar,
+                intervalo=app.config.get('LAB_INGESTA_INTERVALO_S', 10),
+                espera_s=0 if una_vez else app.config.get('LAB_INGESTA_ESPERA_S', 5),
+                bloque=app.config.get('LAB_INGESTA_BLOQUE', 5000),
+                intentos=app.config.get('LAB_INGESTA_INTENTOS', 3),
+                parar=parar, una_vez=una_vez,
+            )
+        except KeyboardInterrupt:
+            click.echo("Detenido.")
+
+    @app.cli.command('importar-catalogo-lab')
+    @click.argument('ruta', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--simular', is_flag=True, help='Solo mostrar los cambios: deshace al final.')
+    def importar_catalogo_lab_cmd(ruta, simular):
+        """Sincroniza el catálogo de exámenes y parámetros de laboratorio con un CSV."""
+        from app.extensions import db
+        from app.utils.transacciones import confirmar
+        from app.utils.catalogo_laboratorio import leer_csv, importar_catalogo
+        from app.utils.rangos_laboratorio import remarcar_parametro
+
+        try:
+            examenes, parametros = leer_csv(ruta)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+        cambios = importar_catalogo(examenes, parametros)
+        click.echo(f"{len(examenes)} exámenes y {len(parametros)} parámetros en el archivo.")
+        for campo, n in zip(cambios._fields, map(len, cambios)):
+            if n and campo != 'parametros_conservados':
+                click.echo(f"{campo.replace('_', ' ')}: {n}")
+        if cambios.parametros_conservados:
+            ids = ', '.join(map(str, cambios.parametros_conservados[:20]))
+            click.echo(f"No están en el archivo pero tienen resultados (se conservan): {ids}")
+
+        escribe = any(len(c) for c in cambios[:6])
+        if simular or not escribe:
+            db.session.rollback()
+            click.echo("Sin cambios." if not escribe else "Simulación: sin cambios.")
+            return
+        confirmar()
+        # Los resultados ya guardados se vuelven a marcar con los rangos nuevos
+        for parametro_id in cambios.rangos_cambiados:
+            remarcar_parametro(parametro_id)
+        click.echo("Catálogo actualizado.")
@@ -1,15 +1,13 @@
 from decimal import Decimal
-from datetime import datetime, timedelta, time
+from datetime import datetime, time
 import json
-from io import BytesIO
 from collections import defaultdict
 
 from flask import (
     Blueprint, render_template, request, redirect,
-    url_for, flash, jsonify, make_response, send_file, session
+    url_for, flash, jsonify, make_response, abort
 )
 from flask_login import login_required, current_user
-from sqlalchemy import func, text, or_
 # from weasyprint import HTML  # Descomenta si lo usas, si no, déjalo así
 
 # --- 1. DEFINICIÓN DEL BLUEPRINT ---
@@ -17,6 +15,16 @@ enfermeria_bp = Blueprint('enfermeria', __name__)
 
 # --- 2. IMPORTACIONES DE LA APP ---
 from app.extensions import db
+from app.utils.transacciones import confirmar
+from app.utils.busqueda_pacientes import buscar_pacientes
+from app.utils.cache_catalogos import catalogo
+from app.utils.entrega_turno import (
+    informe_entrega_turno, turno_en_curso, servicios_hospitalarios, HORARIO_TURNOS,
+)
+from app.utils.render_pdf import renderizar, ErrorPDF
+from app.utils.cache_pdf import responder_pdf
+from app.utils.folio_enfermeria import huella_folio, clave_folio, escribir_folio
+from app.utils.versiones_historia import marcar_enfermeria
 from app.models import (
     RegistroEnfermeria, Paciente, HistoriaClinica,
     AdministracionMedicamento, Medicamento, OrdenMedica, 
@@ -122,12 +130,8 @@ def inicio_enfermeria():
     if request.method == 'POST':
         criterio = request.form.get('criterio', '').strip()
         if criterio:
-            # Tu lógica de búsqueda actual
-            ids_validos = [h.paciente_id for h in HistoriaClinica.query.all()]
-            pacientes = Paciente.query.filter(Paciente.id.in_(ids_validos)).filter(
-                (Paciente.numero.ilike(f"%{criterio}%")) | 
-                (Paciente.nombre.ilike(f"%{criterio}%"))
-            ).all()
+            # Búsqueda sin tildes por nombre o documento (solo pacientes con historia)
+            pacientes = buscar_pacientes(criterio, limite=50, solo_con_historia=True)
         else:
             pacientes = []
     else:
@@ -152,19 +156,7 @@ def autocomplete_pacientes():
     if not termino:
         return jsonify([])
 
-    ids_validos = [h.paciente_id for h in HistoriaClinica.query.all()]
-
-    pacientes = (
-        Paciente.query
-        .filter(Paciente.id.in_(ids_validos))
-        .filter(
-            (Paciente.nombre.ilike(f"%{termino}%")) |
-            (Paciente.numero.ilike(f"%{termino}%"))
-        )
-        .order_by(Paciente.nombre.asc())
-        .limit(10)
-        .all()
-    )
+    pacientes = buscar_pacientes(termino, limite=10, solo_con_historia=True)
 
     datos = [
         {"id": p.id, "nombre": p.nombre, "numero": p.numero}
@@ -384,7 +376,7 @@ def crear():
         )
         
         db.session.add(registro)
-        db.session.commit()
+        confirmar()
         flash('Registro creado correctamente.', 'success')
         return redirect(url_for('enfermeria.crear', paciente_id=paciente_id))
     
@@ -416,7 +408,7 @@ def eliminar_registro_enfermeria(registro_id):
         return redirect(url_for('enfermeria.registros_paciente', paciente_id=registro.paciente_id))
     
     db.session.delete(registro)
-    db.session.commit()
+    confirmar()
     flash('Registro de enfermería eliminado.', 'success')
 
     return redirect(url_for('enfermeria.registros_paciente', paciente_id=paciente_id))
@@ -431,7 +423,7 @@ def eliminar_signos_enfermeria(registro_id):
     registro.signos_vitales = json.dumps({})
     registro.control_glicemia = None
 
-    db.session.commit()
+    confirmar()
     flash('Signos vitales eliminados del registro.', 'success')
     return redirect(url_for('enfermeria.registros_paciente', paciente_id=paciente_id))
 
@@ -444,7 +436,7 @@ def eliminar_balance_enfermeria(registro_id):
 
     registro.balance_liquidos = json.dumps({})
 
-    db.session.commit()
+    confirmar()
     flash('Balance de líquidos eliminado del registro.', 'success')
     return redirect(url_for('enfermeria.registros_paciente', paciente_id=paciente_id))
 
@@ -458,7 +450,7 @@ def eliminar_nota_enfermeria(registro_id):
     registro.tipo_nota = None
     registro.texto_nota = None
 
-    db.session.commit()
+    confirmar()
     flash('Nota de enfermería eliminada del registro.', 'success')
     return redirect(url_for('enfermeria.registros_paciente', paciente_id=paciente_id))
 
@@ -492,7 +484,7 @@ def eliminar_insumo_paciente(ip_id):
             solicitud.estado = 'parcial'
 
         db.session.delete(ip)
-        db.session.commit()
+        confirmar()
         flash('✅ Registro eliminado. El insumo vuelve a estar disponible para legalizar.', 'success')
         
     except Exception as e:
@@ -543,7 +535,7 @@ def administrar_medicamentos(registro_id):
                     flash(f"Acción bloqueada: La hora {hora_input} es del turno {t_calc}. Su turno actual es {turno_actual_sistema}.", 'danger')
                     return redirect(url_for('enfermeria.administrar_medicamentos', registro_id=registro_id))
                 
-                med_bd = Medicamento.query.filter_by(codigo=codigo).first()
+                med_bd = catalogo('medicamentos').por_clave(codigo)
                 if med_bd and cantidad:
                     nueva_admin = AdministracionMedicamento(
                         registro_enfermeria_id=registro.id,
@@ -555,7 +547,7 @@ def administrar_medicamentos(registro_id):
                         unidad=med_bd.unidad_inventario or 'UND'
                     )
                     db.session.add(nueva_admin)
-                    db.session.commit()
+                    confirmar()
                     flash('✅ Medicamento administrado correctamente.', 'success')
                 else:
                     flash('❌ Error: Datos incompletos.', 'danger')
@@ -605,7 +597,7 @@ def administrar_medicamentos(registro_id):
             
             if codigo_m not in meds_agrupados:
                 # Buscamos en el catálogo para obtener el nombre real
-                med_db = Medicamento.query.filter_by(codigo=codigo_m).first()
+                med_db = catalogo('medicamentos').por_clave(codigo_m)
                 meds_agrupados[codigo_m] = {
                     'total_f': 0.0,
                     'nombre': med_db.nombre if med_db else f"Cod: {codigo_m}",
@@ -662,7 +654,11 @@ def administrar_medicamentos(registro_id):
         .order_by(AdministracionMedicamento.hora_administracion.desc()).all()
     
     codigos_f = [m['codigo'] for m in medicamentos_formulados]
-    medicamentos_dropdown = Medicamento.query.filter(Medicamento.codigo.in_(codigos_f)).all() if codigos_f else []
+    medicamentos_cat = catalogo('medicamentos')
+    medicamentos_dropdown = [
+        medicamentos_cat.por_clave(c) for c in dict.fromkeys(codigos_f)
+        if medicamentos_cat.por_clave(c)
+    ]
 
     return render_template(
         'enfermeria/administrar_medicamentos.html',
@@ -717,7 +713,7 @@ def administrar_medicamentos_paciente(paciente_id):
         )
         
         db.session.add(registro)
-        db.session.commit()
+        confirmar()
     
     return redirect(url_for('enfermeria.administrar_medicamentos', registro_id=registro.id))
 
@@ -821,107 +817,61 @@ def api_medicamentos_formulados(registro_id):
 @enfermeria_bp.route('/paciente/<int:paciente_id>/exportar_pdf', methods=['GET'])
 @login_required
 def exportar_pdf(paciente_id):
-    paciente = Paciente.query.get_or_404(paciente_id)
-    
-    # 📌 Registros de enfermería
-    registros = (
-        RegistroEnfermeria.query
-        .filter_by(paciente_id=paciente_id)
-        .order_by(RegistroEnfermeria.fecha_registro.desc())
-        .all()
-    )
-
-    # 🔥 Signos vitales
-    for r in registros:
-        try:
-            sv = json.loads(r.signos_vitales or '{}')
-            if not isinstance(sv, dict):
-                sv = {}
-        except Exception:
-            sv = {}
-
-        r.signos_vitales_dict = {
-            "ta":   sv.get("ta")   or "",
-            "fc":   sv.get("fc")   or "",
-            "fr":   sv.get("fr")   or "",
-            "temp": sv.get("temp") or "",
-            "so2":  sv.get("so2")  or ""
-        }
-
-        # 💧 Balance de líquidos
-        try:
-            bl = json.loads(r.balance_liquidos or '{}')
-            if not isinstance(bl, dict):
-                bl = {"administrados": {}, "eliminados": {}}
-        except Exception:
-            bl = {"administrados": {}, "eliminados": {}}
-        r.balance_liquidos_dict = bl
-
-    # 💊 Medicamentos administrados
-    medicamentos = []
-    if registros:
-        registro_ids = [r.id for r in registros]
-        medicamentos = (
-            db.session.query(AdministracionMedicamento)
-            .filter(
-                # Primer filtro: que pertenezca a los registros (Relación)
-                AdministracionMedicamento.registro_enfermeria_id.in_(registro_ids), 
-                # Segundo filtro: que la cantidad sea mayor a 0 (Atributo directo)
-                AdministracionMedicamento.cantidad > 0 
-            )
-            .order_by(AdministracionMedicamento.hora_administracion.desc())
-            .limit(50)
-            .all()
+    """Folio de enfermería completo en PDF (por bloques; de la caché si no cambió)."""
+    huella = huella_folio(paciente_id)
+    if huella is None:
+        abort(404)
+    try:
+        return responder_pdf(
+            'enfermeria', clave_folio(paciente_id), huella,
+            generar=None,
+            nombre_descarga=f'folio_enfermeria_{paciente_id}.pdf',
+            escribir=lambda destino: escribir_folio(paciente_id, destino),
         )
+    except ErrorPDF:
+        flash('Error al crear el PDF del folio de enfermería', 'danger')
+        return redirect(url_for('enfermeria.registros_paciente', paciente_id=paciente_id))
 
-# 1. Consulta de solicitudes
-    solicitudes = SolicitudInsumo.query.filter_by(paciente_id=paciente_id).all()
 
-    insumos_registrados = []
-    insumos_pendientes = []
-    
-    # Obtenemos la fecha de hoy para comparar en el HTML
-    fecha_actual_obj = ahora_bogota()
-    hoy_str = fecha_actual_obj.strftime('%Y-%m-%d')
-
-    for sol in solicitudes: 
-        insumo = InsumoMedico.query.get(sol.insumo_medico_id)
-        if not insumo:
-            continue
-
-        # TODO este bloque debe estar dentro del FOR (con sangría a la derecha)
-        if sol.estado == 'entregado':
-            insumos_registrados.append({
-                'nombre': insumo.nombre,
-                'usado': int(sol.cantidad),
-                'fecha_uso': sol.fecha_solicitud.strftime('%Y-%m-%d %H:%M'),
-                'observaciones': sol.observaciones or 'Sin observaciones'
-            })
-        else:
-            insumos_pendientes.append({
-                'nombre': insumo.nombre,
-                'solicitado': int(sol.cantidad),
-                'fecha_solicitud': sol.fecha_solicitud.strftime('%d/%m %H:%M')
-            })
-
-    # 2. CREAMOS EL DICCIONARIO 'data' (Esto quita el error de Pylance)
-    contexto = {
-        'paciente': paciente,
-        'registros': registros,
-        'medicamentos': medicamentos,
-        'insumos_registrados': insumos_registrados,
-        'insumos_pendientes': insumos_pendientes,
-        'fecha_hoy': hoy_str,
-        'ahora_bogota': ahora_bogota,
-        'puede_editar_turno_template': validar_turno_estricto
-    }
+@enfermeria_bp.route('/entrega_turno', methods=['GET'])
+@login_required
+def entrega_turno():
+    """Informe de entrega de turno de todos los pacientes de un servicio (HTML o PDF)."""
+    servicios = servicios_hospitalarios()
+    fecha_actual, turno_actual = turno_en_curso(ahora_bogota())
+    servicio = request.args.get('servicio', '').strip()
+    turno = request.args.get('turno', turno_actual).strip().upper()
+    if turno not in HORARIO_TURNOS:
+        turno = turno_actual
+    try:
+        fecha = datetime.strptime(request.args.get('fecha', ''), '%Y-%m-%d').date()
+    except ValueError:
+        fecha = fecha_actual
+
+    informe = informe_entrega_turno(servicio, fecha, turno) if servicio else None
+    contexto = dict(
+        servicios=servicios, servicio=servicio, fecha=fecha, turno=turno,
+        turnos=TURNOS_DISPONIBLES, informe=informe, generado=ahora_bogota(),
+    )
+    if informe is None or request.args.get('formato') != 'pdf':
+        return render_template('enfermeria/entrega_turno.html', **contexto)
 
-    # 3. Renderizado (Usamos el diccionario que acabamos de crear)
-    # Si es para el PDF:
-    html_string = render_template('enfermeria/pdf_enfermeria_limpio.html', **contexto)
-    
-    # Si es para la vista normal:
-    return render_template('enfermeria/registros_paciente.html', **contexto)
+    try:
+        contenido = renderizar(
+            'weasyprint', render_template('enfermeria/pdf_entrega_turno.html', **contexto),
+            hojas=('pdf_entrega_turno.css',),
+        )
+    except ErrorPDF:
+        flash('Error al crear el PDF de entrega de turno', 'danger')
+        return redirect(url_for('enfermeria.entrega_turno', servicio=servicio,
+                                fecha=fecha.isoformat(), turno=turno))
+    respuesta = make_response(contenido)
+    respuesta.headers['Content-Type'] = 'application/pdf'
+    respuesta.headers['Content-Disposition'] = (
+        f"inline; filename=entrega_turno_{fecha.isoformat()}_{turno.replace('Ñ', 'N').lower()}.pdf"
+    )
+    respuesta.headers['Cache-Control'] = 'private, no-store'
+    return respuesta
 
    # ---------- 8) API INFO PACIENTE ----------
 
@@ -933,10 +883,7 @@ def buscar_info_paciente():
         return jsonify([]) # Devolvemos lista vacía en lugar de error 400
 
     # 1. Buscamos TODOS los pacientes que coincidan (limitamos a 5 para rapidez)
-    pacientes = Paciente.query.filter(
-        (Paciente.numero.like(f"%{q}%")) | 
-        (Paciente.nombre.ilike(f"%{q}%"))
-    ).limit(5).all()
+    pacientes = buscar_pacientes(q, limite=5)
 
     # 2. Si no hay pacientes por nombre/doc, buscamos por número de ingreso
     if not pacientes:
@@ -1035,7 +982,7 @@ def crear_nota():
         )
 
         db.session.add(registro)
-        db.session.commit()
+        confirmar()
         
         # MENSAJE DE ÉXITO
         flash('Nota de enfermería guardada. Puede redactar otra.', 'success')
@@ -1101,7 +1048,7 @@ def registrar_administracion_enfermeria(registro_enfermeria_id, codigo_medicamen
     if med.cantidad_disponible < 0:
         med.cantidad_disponible = 0
 
-    db.session.commit()
+    confirmar()
 
 
 @enfermeria_bp.route('/administracion/<int:admin_id>/editar', methods=['GET', 'POST'])
@@ -1136,7 +1083,7 @@ def editar_administracion_medicamento(admin_id):
                 admin.hora_administracion = datetime.strptime(nueva_fecha_str, '%Y-%m-%dT%H:%M')
 
             # 3. GUARDAR CAMBIOS REALES EN LA BASE DE DATOS
-            db.session.commit()
+            confirmar()
             flash('✅ Administración actualizada correctamente.', 'success')
             
         except Exception as e:
@@ -1165,7 +1112,7 @@ def eliminar_administracion_medicamento(admin_id):
         if admin.medicamento:
             admin.medicamento.cantidad_disponible += Decimal(str(admin.cantidad))
         db.session.delete(admin)
-        db.session.commit()
+        confirmar()
         flash('✅ Eliminado correctamente.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1224,7 +1171,7 @@ def registros_paciente(paciente_id):
     hoy_str = ahora_bogota().strftime('%Y-%m-%d')
 
     for sol in solicitudes:
-        insumo = InsumoMedico.query.get(sol.insumo_medico_id)
+        insumo = catalogo('insumos').get(sol.insumo_medico_id)
         if not insumo:
             continue
 
@@ -1316,6 +1263,8 @@ def administrar_medicamentos(historia_id):
         eliminados = AdministracionMedicamento.query.filter(
             AdministracionMedicamento.registro_enfermeria_id.in_(registro_ids)
         ).delete()
+        # El delete masivo no pasa por el flush: el folio debe cambiar de versión igual
+        marcar_enfermeria({r.paciente_id for r in registros_historia})
         print(f"🗑️ Eliminados {eliminados} administraciones anteriores")
     
     # 3. Crear un registro enfermería temporal para las órdenes
@@ -1338,7 +1287,7 @@ def administrar_medicamentos(historia_id):
     insertados = 0
     for med in medicamentos_ordenes:
         codigo = med.get('codigo', '')
-        med_obj = Medicamento.query.filter_by(codigo=codigo).first()
+        med_obj = catalogo('medicamentos').por_clave(codigo)
         if med_obj:
             admin = AdministracionMedicamento(
                 registro_enfermeria_id=registro_temp.id,
@@ -1352,7 +1301,7 @@ def administrar_medicamentos(historia_id):
             db.session.add(admin)
             insertados += 1
     
-    db.session.commit()
+    confirmar()
     
     print(f"✅ Historia {historia_id}: {insertados}/{len(medicamentos_ordenes)} medicamentos cargados")
     
@@ -1401,7 +1350,7 @@ def cargar_medicamentos_ordenes(historia_id):
     # Agregar cada medicamento
     count = 0
     for med in medicamentos_ordenes:
-        medicamento = Medicamento.query.filter_by(codigo=med.get('codigo')).first()
+        medicamento = catalogo('medicamentos').por_clave(med.get('codigo'))
     if medicamento:
             admin = AdministracionMedicamento(
             registro_enfermeria_id=registro.id,
@@ -1415,7 +1364,7 @@ def cargar_medicamentos_ordenes(historia_id):
             db.session.add(admin)
             count += 1
     
-    db.session.commit()
+    confirmar()
     
     print(f"✅ {count} medicamentos cargados en registro {registro.id}")
     return {'exito': count, 'registro_id': registro.id}
@@ -1443,7 +1392,7 @@ def solicitar_insumos(paciente_id):
                         enfermero_id=current_user.id
                     )
                     db.session.add(nueva_solicitud)
-                    db.session.commit()
+                    confirmar()
                     flash(f'✅ Solicitado: {insumo_medico.nombre}', 'success')
             except Exception as e:
                 db.session.rollback()
@@ -1459,7 +1408,7 @@ def solicitar_insumos(paciente_id):
     
     lista_para_tabla = []
     for p in pendientes:
-        m = InsumoMedico.query.get(p.insumo_medico_id)
+        m = catalogo('insumos').get(p.insumo_medico_id)
         
         # Obtenemos todos los registros de uso de este paciente
         registros_uso = InsumoPaciente.query.filter_by(paciente_id=paciente_id).all()
@@ -1490,7 +1439,7 @@ def solicitar_insumos(paciente_id):
         else:
             # Auto-cierre de solicitud si ya se consumió todo
             p.estado = 'entregado'
-            db.session.commit()
+            confirmar()
 
     return render_template('enfermeria/solicitar_insumos.html', 
                            paciente=paciente, 
@@ -1501,7 +1450,8 @@ def solicitar_insumos(paciente_id):
 def limpiar_insumos_solicitados(paciente_id):
     # Cambiamos InsumoPaciente por SolicitudInsumo
     SolicitudInsumo.query.filter_by(paciente_id=paciente_id, estado='pendiente').delete()
-    db.session.commit()
+    marcar_enfermeria([paciente_id])
+    confirmar()
     flash('🧹 Pendientes limpiados.', 'info')
     return redirect(url_for('enfermeria.solicitar_insumos', paciente_id=paciente_id))
 
@@ -1509,7 +1459,8 @@ def limpiar_insumos_solicitados(paciente_id):
 @login_required
 def reset_insumos_paciente(paciente_id):
     InsumoPaciente.query.filter_by(paciente_id=paciente_id).delete()
-    db.session.commit()
+    marcar_enfermeria([paciente_id])
+    confirmar()
     flash('⚠️ Historial reiniciado.', 'warning')
     return redirect(url_for('enfermeria.solicitar_insumos', paciente_id=paciente_id))
 # ---------- RUTAS DE EDICIÓN COMPLETAS ----------
@@ -1559,7 +1510,7 @@ def editar_signos(registro_id):
         registro.observaciones = request.form.get('observaciones')
         
         try:
-            db.session.commit()
+            confirmar()
             flash('✅ Signos vitales actualizados correctamente.', 'success')
         except Exception as e:
             db.session.rollback()
@@ -1610,7 +1561,7 @@ def registrar_insumos(paciente_id):
                     solicitud.estado = 'parcial'
                 
                 db.session.add(nuevo_registro)
-                db.session.commit()
+                confirmar()
                 flash(f"✅ Se registraron {cantidad_usada} unidades.", "success")
             except Exception as e:
                 db.session.rollback()
@@ -1681,7 +1632,7 @@ def editar_balance(registro_id):
             }
         }
         registro.balance_liquidos = json.dumps(balance_data)
-        db.session.commit()
+        confirmar()
         flash('✅ Balance de líquidos actualizado con éxito.', 'success')
         return redirect(url_for('enfermeria.registros_paciente', paciente_id=registro.paciente_id))
     
@@ -1721,7 +1672,7 @@ def editar_nota(registro_id):
         registro.tipo_nota = request.form.get('tipo_nota')
         registro.texto_nota = request.form.get('texto_nota')
         
-        db.session.commit()
+        confirmar()
         flash('✅ Nota de enfermería actualizada con éxito.', 'success')
         # Redirigir al detalle del paciente
         return redirect(url_for('enfermeria.registros_paciente', paciente_id=registro.paciente_id))
@@ -1761,7 +1712,7 @@ def editar_administracion_med(admin_id):
             if nueva_hora:
                 admin.hora_administracion = datetime.strptime(nueva_hora, '%Y-%m-%dT%H:%M')
             
-            db.session.commit()
+            confirmar()
             flash('✅ Administración de medicamento actualizada.', 'success')
         except Exception as e:
             db.session.rollback()
@@ -1806,7 +1757,7 @@ def editar_insumo_paciente(insumo_paciente_id):
                 else:
                     solicitud.estado = 'completado'
 
-            db.session.commit()
+            confirmar()
             flash("✅ Registro actualizado correctamente.", "success")
             return redirect(url_for('enfermeria.registrar_insumos', paciente_id=paciente_id))
             
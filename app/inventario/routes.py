@@ -1,6 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
 from app.extensions import db
+from app.utils.transacciones import confirmar
+from app.utils.versiones_catalogo import incrementar_version
 from app.models import InsumoMedico
 import pandas as pd 
 from io import BytesIO
@@ -50,7 +52,8 @@ def nuevo_insumo():
             activo=activo
         )
         db.session.add(ins)
-        db.session.commit()
+        incrementar_version('insumos')
+        confirmar()
         flash('Insumo creado correctamente', 'success')
         return redirect(url_for('inventario.listar_insumos'))
 
@@ -73,7 +76,8 @@ def editar_insumo(insumo_id): # <-- ESTE NOMBRE ES EL QUE BUSCA EL ERROR
             flash('Código y nombre son obligatorios', 'danger')
             return redirect(url_for('inventario.editar_insumo', insumo_id=insumo.id))
 
-        db.session.commit()
+        incrementar_version('insumos')
+        confirmar()
         flash('Insumo actualizado correctamente', 'success')
         return redirect(url_for('inventario.listar_insumos'))
 
@@ -85,7 +89,8 @@ def editar_insumo(insumo_id): # <-- ESTE NOMBRE ES EL QUE BUSCA EL ERROR
 def eliminar_insumo(insumo_id):
     ins = InsumoMedico.query.get_or_404(insumo_id)
     db.session.delete(ins)
-    db.session.commit()
+    incrementar_version('insumos')
+    confirmar()
     flash('Insumo eliminado', 'warning')
     return redirect(url_for('inventario.listar_insumos'))
 
@@ -103,7 +108,8 @@ def eliminar_insumos_seleccionados():
         .filter(InsumoMedico.id.in_([int(i) for i in ids]))
         .delete(synchronize_session=False)
     )
-    db.session.commit()
+    incrementar_version('insumos')
+    confirmar()
     flash(f'{deleted} insumos eliminados.', 'success')
     return redirect(url_for('inventario.listar_insumos'))
 
@@ -153,7 +159,8 @@ def importar_excel():
                 db.session.add(nuevo)
                 creados += 1
         
-        db.session.commit()
+        incrementar_version('insumos')
+        confirmar()
         flash(f'Proceso terminado: {creados} creados y {actualizados} actualizados.', 'success')
 
     except Exception as e:
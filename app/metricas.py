@@ -0,0 +1,22 @@
+from flask import Blueprint, jsonify
+from flask_login import login_required
+
+metricas_bp = Blueprint('metricas', __name__, url_prefix='/metricas')
+
+# nombre -> función sin argumentos que devuelve un dict serializable
+_proveedores = {}
+
+
+def registrar_metrica(nombre, funcion):
+    """Registra un proveedor de métricas que se expone en /metricas/."""
+    _proveedores[nombre] = funcion
+
+
+def snapshot_metricas():
+    return {nombre: funcion() for nombre, funcion in _proveedores.items()}
+
+
+@metricas_bp.route('/')
+@login_required
+def ver_metricas():
+    return jsonify(snapshot_metricas())
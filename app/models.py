@@ -1,4 +1,5 @@
 from app.extensions import db, login_manager
+from sqlalchemy import event
 from sqlalchemy.orm import backref
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -6,6 +7,7 @@ from datetime import datetime
 from decimal import Decimal
 import json
 from app.utils.fechas import ahora_bogota
+from app.utils.texto import normalizar_texto, valor_numerico
 
 class User(db.Model, UserMixin):
     __tablename__ = 'usuarios'
@@ -29,11 +31,20 @@ def load_user(user_id):
 
 class Paciente(db.Model):
     __tablename__ = 'pacientes'
+    __table_args__ = (
+        db.Index('ix_pacientes_ultima_actividad', 'ultima_actividad', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(150), nullable=False)
     numero = db.Column(db.String(50), nullable=False, unique=True)
     cama = db.Column(db.String(50))
+    # nombre sin tildes y en minúsculas para búsquedas (ver app/utils/busqueda_pacientes.py)
+    nombre_normalizado = db.Column(db.String(150), index=True)
+    # Sube con cada cambio de sus registros de enfermería (ver app/utils/versiones_historia.py)
+    version_enfermeria = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Último ingreso, orden o registro de enfermería; ordena el listado (ver app/utils/actividad_pacientes.py)
+    ultima_actividad = db.Column(db.DateTime, default=datetime.now)
 
     registros_enfermeria = db.relationship(
         'RegistroEnfermeria',
@@ -54,8 +65,17 @@ class Paciente(db.Model):
         lazy=True
     )
 
+@event.listens_for(Paciente, 'before_insert')
+@event.listens_for(Paciente, 'before_update')
+def _normalizar_nombre_paciente(mapper, connection, target):
+    target.nombre_normalizado = normalizar_texto(target.nombre)
+
+
 class HistoriaClinica(db.Model):
     __tablename__ = 'historias_clinicas'
+    __table_args__ = (
+        db.Index('ix_historias_clinicas_paciente_fecha', 'paciente_id', 'fecha_registro'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
@@ -142,8 +162,14 @@ class HistoriaClinica(db.Model):
     tiene_alergias = db.Column(db.String(2), default='no', nullable=True)
     descripcion_alergias = db.Column(db.Text, nullable=True)
 
+    # Sube con cada cambio de la historia, sus órdenes o sus signos (ver app/utils/versiones_historia.py)
+    version_contenido = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 class OrdenMedica(db.Model):
     __tablename__ = 'ordenes_medicas'
+    __table_args__ = (
+        db.Index('ix_ordenes_medicas_historia', 'historia_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     historia_id = db.Column(db.Integer, db.ForeignKey('historias_clinicas.id'), nullable=False)
@@ -168,6 +194,9 @@ class Medico(db.Model):
 
 class SignosVitales(db.Model):
     __tablename__ = 'signos_vitales'
+    __table_args__ = (
+        db.Index('ix_signos_vitales_historia', 'historia_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     historia_id = db.Column(db.Integer, db.ForeignKey('historias_clinicas.id'), nullable=False)
@@ -224,6 +253,10 @@ class CIE10(db.Model):
 
 class RegistroEnfermeria(db.Model):
     __tablename__ = 'registro_enfermeria'
+    __table_args__ = (
+        db.Index('ix_registro_enfermeria_paciente_fecha', 'paciente_id', 'fecha_registro'),
+        db.Index('ix_registro_enfermeria_historia_fecha', 'historia_clinica_id', 'fecha_registro'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
@@ -242,16 +275,40 @@ class RegistroEnfermeria(db.Model):
 
 class AyudaDiagnostica(db.Model):
     __tablename__ = 'ayuda_diagnostica'
+    __table_args__ = (
+        db.Index('ix_ayuda_diagnostica_historia_tipo', 'historia_id', 'tipo'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     historia_id = db.Column(db.Integer, db.ForeignKey('historias_clinicas.id'), nullable=False)
     tipo = db.Column(db.String(20), nullable=False)  # 'laboratorio', 'imagen', 'biopsia'
     nombre_examen = db.Column(db.String(255), nullable=False)
     fecha_resultado = db.Column(db.DateTime, nullable=True)
+    # ruta relativa de los archivos subidos antes del almacén por contenido
     archivo = db.Column(db.String(255), nullable=True)
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivos_ayuda.id'), nullable=True, index=True)
+    nombre_archivo = db.Column(db.String(255), nullable=True)
     observaciones = db.Column(db.Text, nullable=True)
 
     historia = db.relationship('HistoriaClinica', backref='ayudas_diagnosticas')
+    contenido = db.relationship('ArchivoAyuda')
+
+    @property
+    def tiene_archivo(self):
+        return bool(self.archivo_id or self.archivo)
+
+
+class ArchivoAyuda(db.Model):
+    """Contenido subido, guardado una sola vez por SHA-256 (ver app/utils/almacen_archivos.py)."""
+    __tablename__ = 'archivos_ayuda'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    tamano = db.Column(db.BigInteger, nullable=False)
+    tipo_mime = db.Column(db.String(100), nullable=True)
+    # ayudas que apuntan a este contenido; en 0 se borra la fila y el archivo
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    creado = db.Column(db.DateTime, default=ahora_bogota)
 
 
 class CatLaboratorioExamen(db.Model):
@@ -267,6 +324,9 @@ class CatLaboratorioExamen(db.Model):
 
 class CatLaboratorioParametro(db.Model):
     __tablename__ = 'cat_laboratorio_parametro'
+    __table_args__ = (
+        db.Index('ix_cat_laboratorio_parametro_examen', 'examen_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     examen_id = db.Column(db.Integer, db.ForeignKey('cat_laboratorio_examen.id'), nullable=False)
@@ -278,6 +338,9 @@ class CatLaboratorioParametro(db.Model):
 
 class LabSolicitud(db.Model):
     __tablename__ = 'lab_solicitud'
+    __table_args__ = (
+        db.Index('ix_lab_solicitud_historia_fecha', 'historia_id', 'fecha_solicitud'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -297,6 +360,11 @@ class LabSolicitud(db.Model):
 
 class LabResultado(db.Model):
     __tablename__ = 'lab_resultado'
+    __table_args__ = (
+        # Un valor por parámetro en cada solicitud: destino del upsert (ver app/utils/carga_laboratorios.py)
+        db.Index('uq_lab_resultado_solicitud_parametro', 'solicitud_id', 'parametro_id', unique=True),
+        db.Index('ix_lab_resultado_parametro', 'parametro_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -318,6 +386,8 @@ class LabResultado(db.Model):
     )
 
     valor = db.Column(db.String(100), nullable=True)
+    # ``valor`` como número, leído una vez al guardar (ver app/utils/rangos_laboratorio.py)
+    valor_num = db.Column(db.Float, nullable=True)
     unidad = db.Column(db.String(50), nullable=True)
     flag_fuera_rango = db.Column(db.Boolean, default=False)
     interpretacion = db.Column(db.String(255), nullable=True)
@@ -326,6 +396,11 @@ class LabResultado(db.Model):
     parametro = db.relationship('CatLaboratorioParametro')
     examen = db.relationship('CatLaboratorioExamen')
 
+@event.listens_for(LabResultado, 'before_insert')
+@event.listens_for(LabResultado, 'before_update')
+def _valor_numerico_resultado(mapper, connection, target):
+    target.valor_num = valor_numerico(target.valor)
+
 class DiagnosticoCIE10(db.Model):
     __tablename__ = 'diagnosticos_cie10'
 
@@ -336,6 +411,15 @@ class DiagnosticoCIE10(db.Model):
     habilitado = db.Column(db.Boolean, default=True)
 
 
+class CatalogoVersion(db.Model):
+    """Contador de versión por catálogo; cada proceso lo compara con su copia en memoria."""
+    __tablename__ = 'catalogo_versiones'
+
+    nombre = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    actualizado = db.Column(db.DateTime, default=ahora_bogota, onupdate=ahora_bogota)
+
+
 class Medicamento(db.Model):
     __tablename__ = 'medicamentos'
 
@@ -355,6 +439,10 @@ class Medicamento(db.Model):
 
 class AdministracionMedicamento(db.Model):
     __tablename__ = 'administracion_medicamento'
+    __table_args__ = (
+        db.Index('ix_administracion_medicamento_registro_med', 'registro_enfermeria_id', 'medicamento_id'),
+        db.Index('ix_administracion_medicamento_medicamento', 'medicamento_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -398,6 +486,10 @@ class InsumoMedico(db.Model):
 class SolicitudInsumo(db.Model):
     __tablename__ = 'solicitudes_insumos'
     
+    __table_args__ = (
+        db.Index('ix_solicitudes_insumos_paciente_estado', 'paciente_id', 'estado'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
     insumo_medico_id = db.Column(db.Integer, db.ForeignKey('insumos_medicos.id'), nullable=False)
@@ -416,6 +508,10 @@ class SolicitudInsumo(db.Model):
 class InsumoPaciente(db.Model):
     __tablename__ = 'insumos_paciente'
     
+    __table_args__ = (
+        db.Index('ix_insumos_paciente_paciente_insumo', 'paciente_id', 'insumo_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
     insumo_id = db.Column(db.Integer, db.ForeignKey('insumos_medicos.id'), nullable=False)
@@ -432,6 +528,9 @@ class InsumoPaciente(db.Model):
 
 class OrdenLaboratorioItem(db.Model):
     __tablename__ = 'orden_laboratorio_items'
+    __table_args__ = (
+        db.Index('ix_orden_laboratorio_items_orden', 'orden_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     orden_id = db.Column(db.Integer, db.ForeignKey('ordenes_medicas.id'), nullable=False)
@@ -1,7 +1,19 @@
 import os
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, send_file, make_response, current_app
-from datetime import datetime, date
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, send_file, make_response, current_app, abort, stream_with_context
+from werkzeug.utils import secure_filename
+from datetime import datetime, date, timedelta
 from app.extensions import db
+from app.utils.transacciones import confirmar
+from app.utils.busqueda_pacientes import buscar_pacientes
+from app.utils.indice_catalogo import buscar_cie10
+from app.utils.busqueda_clinica import buscar_en_notas
+from app.utils.cache_catalogos import catalogo
+from app.utils.cache_pdf import respuesta_pdf
+from app.utils.render_pdf import renderizar, encolar_pdf, leer_trabajo, publico
+from app.utils.exportacion_pdf import seleccionar_historias, crear_exportacion, generar_zip
+from app.utils.listado_pacientes import normalizar_filtros, pagina_pacientes, total_aproximado, ESTADOS
+from app.utils.entrega_turno import servicios_hospitalarios
+from app.utils.purga_pacientes import seleccion_pacientes, purgar_pacientes, borrar_archivos, borrar_folios
 from app.models import Paciente, RegistroEnfermeria, HistoriaClinica, SignosVitales, OrdenMedica, DiagnosticoCIE10
 from flask_login import login_required
 import pandas as pd
@@ -20,7 +32,6 @@ from app.models import (
 )
 from app.utils.fechas import ahora_bogota
 from app.utils.fechas import tz_bogota
-from weasyprint import HTML
 from datetime import datetime
 
 pacientes_bp = Blueprint('pacientes', __name__, url_prefix='/pacientes')
@@ -28,14 +39,20 @@ pacientes_bp = Blueprint('pacientes', __name__, url_prefix='/pacientes')
 @pacientes_bp.route('/listar', methods=['GET'], endpoint='listar')
 @login_required
 def listar():
-    """Lista todos los pacientes con paginación"""
-    page = request.args.get('page', 1, type=int)
-    pacientes = Paciente.query.paginate(page=page, per_page=10)
-    
+    """Lista de pacientes por última actividad, con filtros y paginación por cursor."""
+    filtros = normalizar_filtros(request.args)
+    pacientes, anterior, siguiente = pagina_pacientes(
+        filtros, despues=request.args.get('despues'), antes=request.args.get('antes'),
+    )
     return render_template(
         'pacientes/listar.html',
-        pacientes=pacientes.items,
-        pagination=pacientes
+        pacientes=pacientes,
+        filtros=filtros,
+        anterior=anterior,
+        siguiente=siguiente,
+        total=total_aproximado(filtros),
+        servicios=servicios_hospitalarios(),
+        estados=ESTADOS,
     )
 
 @pacientes_bp.route('/crear', methods=['GET', 'POST'], endpoint='crear')
@@ -60,7 +77,7 @@ def crear():
                 fecha_registro=ahora_bogota()
             )
             db.session.add(registro)
-            db.session.commit()
+            confirmar()
 
             flash('Paciente creado correctamente.', 'success')
             return redirect(url_for('pacientes.listar'))
@@ -172,12 +189,8 @@ def nuevo_ingreso():
         if historia.tiene_alergias == 'si' and not historia.descripcion_alergias:
             db.session.rollback()
             flash('❌ Debe describir las alergias si marca SÍ tiene alergias.', 'danger')
-            diagnosticos_cie10 = DiagnosticoCIE10.query.order_by(DiagnosticoCIE10.codigo).all()
-            medicamentos_catalogo = Medicamento.query.order_by(Medicamento.nombre).all()
             return render_template(
                 'pacientes/nuevo_ingreso.html',
-                diagnosticos_cie10=diagnosticos_cie10,
-                medicamentos_catalogo=medicamentos_catalogo,
                 form_data=form
             )
 
@@ -198,17 +211,13 @@ def nuevo_ingreso():
         )
         db.session.add(sv)
 
-        db.session.commit()
+        confirmar()
         flash('✅ Paciente e historia de ingreso creados correctamente con antecedentes, riesgos y alergias', 'success')
         return redirect(url_for('pacientes.listar'))
 
-        # GET: cargar catálogos
-    diagnosticos_cie10 = DiagnosticoCIE10.query.order_by(DiagnosticoCIE10.codigo).all()
-    medicamentos_catalogo = Medicamento.query.order_by(Medicamento.nombre).all()
+    # GET: CIE-10 y medicamentos se buscan desde el formulario (/catalogos/...)
     return render_template(
         'pacientes/nuevo_ingreso.html',
-        diagnosticos_cie10=diagnosticos_cie10,
-        medicamentos_catalogo=medicamentos_catalogo,
         historia=None  # ✅ NUEVA LÍNEA
     )
 
@@ -217,22 +226,19 @@ def nuevo_ingreso():
 @login_required
 def eliminar_paciente(paciente_id):
     paciente = Paciente.query.get_or_404(paciente_id)
+    nombre = paciente.nombre
     try:
-        for historia in list(paciente.historias_clinicas):
-            if getattr(historia, 'signos_vitales', None):
-                db.session.delete(historia.signos_vitales)
-            db.session.delete(historia)
-
-        for reg in list(paciente.registros_enfermeria):
-            db.session.delete(reg)
-
-        db.session.delete(paciente)
-        db.session.commit()
-        flash(f'Paciente {paciente.nombre} y todos sus registros fueron eliminados.', 'success')
+        conteos, archivos, paciente_ids = purgar_pacientes(seleccion_pacientes(ids=[paciente_id]))
+        confirmar()
     except Exception as e:
         db.session.rollback()
         flash(f'Error al eliminar paciente: {e}', 'danger')
+        return redirect(url_for('pacientes.listar'))
 
+    borrar_archivos(archivos)
+    borrar_folios(paciente_ids)
+    detalle = ', '.join(f'{tabla}: {n}' for tabla, n in conteos.items() if n)
+    flash(f'Paciente {nombre} y todos sus registros fueron eliminados ({detalle}).', 'success')
     return redirect(url_for('pacientes.listar'))
 
 @pacientes_bp.route('/carga-masiva', methods=['GET', 'POST'], endpoint='carga_masiva')
@@ -356,7 +362,7 @@ def carga_masiva():
                 except Exception as e:
                     errores.append(f"Fila {idx+2}: {str(e)}")
 
-            db.session.commit()
+            confirmar()
 
             mensaje = f'✅ Se crearon {creados} pacientes con historia de ingreso.'
             if errores:
@@ -461,6 +467,20 @@ def descargar_plantilla():
         flash(f'Error descargando plantilla: {str(e)}', 'danger')
         return redirect(url_for('pacientes.carga_masiva'))
 
+@pacientes_bp.route('/autocomplete', methods=['GET'])
+@login_required
+def autocomplete_pacientes():
+    termino = request.args.get('q', '').strip()
+    if not termino:
+        return jsonify([])
+
+    pacientes = buscar_pacientes(termino, limite=10)
+    return jsonify([
+        {"id": p.id, "nombre": p.nombre, "numero": p.numero}
+        for p in pacientes
+    ])
+
+
 @pacientes_bp.route('/historias_por_paciente', methods=['GET'])
 @login_required
 def historias_por_paciente():
@@ -487,6 +507,27 @@ def historias_por_paciente():
 
     return jsonify(datos)
 
+@pacientes_bp.route('/buscar_notas', methods=['GET'])
+@login_required
+def buscar_notas():
+    """Busca texto en historias, notas de enfermería e interpretaciones de laboratorio.
+
+    Parámetros: q, desde y hasta (YYYY-MM-DD, ambos incluidos).
+    """
+    termino = request.args.get('q', '').strip()
+    if not termino:
+        return jsonify({'error': 'q requerido'}), 400
+
+    try:
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        desde = datetime.strptime(desde, '%Y-%m-%d') if desde else None
+        hasta = datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1) if hasta else None
+    except ValueError:
+        return jsonify({'error': 'Fechas en formato YYYY-MM-DD'}), 400
+
+    return jsonify(buscar_en_notas(termino, desde=desde, hasta=hasta))
+
 @pacientes_bp.route('/autocomplete_cie10')
 @login_required
 def autocomplete_cie10():
@@ -495,20 +536,10 @@ def autocomplete_cie10():
     if not term:
         return jsonify([])
 
-    # Buscar por código que EMPIEZA por term o nombre que contiene term
-    query = DiagnosticoCIE10.query.filter(
-        db.and_(
-            DiagnosticoCIE10.habilitado.is_(True),
-            db.or_(
-                DiagnosticoCIE10.codigo.ilike(f"{term}%"),
-                DiagnosticoCIE10.nombre.ilike(f"%{term}%"),
-            )
-        )
-    ).order_by(DiagnosticoCIE10.codigo).limit(20)
-
+    # Código que EMPIEZA por term o palabras de la descripción (índice en memoria)
     resultados = [
         {"label": f"{dx.codigo} - {dx.nombre}", "value": dx.codigo}
-        for dx in query
+        for dx in buscar_cie10(term, limite=20)
     ]
     return jsonify(resultados)
 
@@ -562,31 +593,126 @@ def orden_medica(historia_id):
             )
             db.session.add(item)
 
-        db.session.commit()
+        confirmar()
         flash('Orden médica creada correctamente', 'success')
         return redirect(url_for('pacientes.listar'))
 
-    # GET: cargar catálogos
-    medicamentos_catalogo = Medicamento.query.order_by(Medicamento.nombre).all()
+    # GET: los medicamentos se buscan desde el formulario (/catalogos/medicamentos)
     examenes_catalogo = CatLaboratorioExamen.query.filter_by(activo=True).order_by(CatLaboratorioExamen.nombre).all()
 
     return render_template(
         'pacientes/crear_orden_medica.html',
         historia=historia,
-        medicamentos_catalogo=medicamentos_catalogo,
         examenes_catalogo=examenes_catalogo
     )
 
+# Hojas ya parseadas en los workers de PDF y catálogos cuyos nombres se imprimen
+HOJAS_LIBRO = ('pdf_libro.css',)
+CATALOGOS_LIBRO = ('medicamentos', 'cie10', 'laboratorio')
+
+
 @pacientes_bp.route('/historias/libro/<int:historia_id>/pdf')
 @login_required
 def pdf_libro_historia(historia_id):
+    # Solo se renderiza (en el pool de PDF) si no hay uno guardado para la versión vigente
+    return respuesta_pdf(
+        'libro', historia_id, 'pacientes/pdf_libro.html',
+        generar=lambda: renderizar('weasyprint', _html_libro_historia(historia_id), hojas=HOJAS_LIBRO),
+        nombre_descarga=f'libro_historia_{historia_id}.pdf',
+        catalogos=CATALOGOS_LIBRO, estilos=HOJAS_LIBRO,
+    )
+
+
+@pacientes_bp.route('/historias/libro/<int:historia_id>/pdf/trabajo', methods=['POST'])
+@login_required
+def encolar_pdf_libro_historia(historia_id):
+    """Encola el PDF y responde al instante; el progreso está en /pdf/trabajos/<id>."""
+    trabajo = encolar_pdf(
+        'libro', historia_id, 'pacientes/pdf_libro.html',
+        generar_html=lambda: _html_libro_historia(historia_id),
+        nombre_descarga=f'libro_historia_{historia_id}.pdf',
+        hojas=HOJAS_LIBRO, catalogos=CATALOGOS_LIBRO,
+    )
+    return jsonify(trabajo), 200 if trabajo['estado'] == 'listo' else 202
+
+
+
+@pacientes_bp.route('/historias/exportar', methods=['GET', 'POST'])
+@login_required
+def exportar_lote():
+    """Exporta en un ZIP los PDF de las historias de un servicio, rango de fechas o CIE-10."""
+    servicios = servicios_hospitalarios()
+    if request.method == 'GET':
+        return render_template('pacientes/exportar_lote.html', servicios=servicios, trabajo=None)
+
+    filtros = {
+        'servicio': request.form.get('servicio', '').strip(),
+        'desde': request.form.get('desde', '').strip(),
+        'hasta': request.form.get('hasta', '').strip(),
+        'cie10': request.form.get('cie10', '').strip(),
+    }
+    if not any(filtros.values()):
+        flash('⚠️ Indique al menos un filtro (servicio, fechas o CIE-10).', 'warning')
+        return redirect(url_for('pacientes.exportar_lote'))
+    try:
+        desde = datetime.strptime(filtros['desde'], '%Y-%m-%d').date() if filtros['desde'] else None
+        hasta = datetime.strptime(filtros['hasta'], '%Y-%m-%d').date() if filtros['hasta'] else None
+    except ValueError:
+        flash('⚠️ Fechas en formato AAAA-MM-DD.', 'warning')
+        return redirect(url_for('pacientes.exportar_lote'))
+
+    historias = seleccionar_historias(filtros['servicio'], desde, hasta, filtros['cie10'])
+    maximo = current_app.config.get('PDF_LOTE_MAX', 1000)
+    if not historias:
+        flash('No hay historias con esos filtros.', 'info')
+        return redirect(url_for('pacientes.exportar_lote'))
+    if len(historias) > maximo:
+        flash(f'⚠️ Son {len(historias)} historias; el máximo por exportación es {maximo}. Acote los filtros.', 'warning')
+        return redirect(url_for('pacientes.exportar_lote'))
+
+    partes = [filtros['servicio'] or 'todos', filtros['desde'], filtros['hasta'], filtros['cie10']]
+    nombre = 'historias_' + '_'.join(secure_filename(p) for p in partes if p) + '.zip'
+    trabajo = crear_exportacion(filtros, historias, nombre)
+    return redirect(url_for('pacientes.ver_exportacion', trabajo_id=trabajo['id']))
+
+
+@pacientes_bp.route('/historias/exportar/<trabajo_id>')
+@login_required
+def ver_exportacion(trabajo_id):
+    trabajo = leer_trabajo(trabajo_id)
+    if trabajo is None or trabajo['tipo'] != 'lote':
+        abort(404)
+    return render_template('pacientes/exportar_lote.html', servicios=[], trabajo=publico(trabajo))
+
+
+@pacientes_bp.route('/historias/exportar/<trabajo_id>/zip')
+@login_required
+def descargar_exportacion(trabajo_id):
+    """ZIP enviado por partes; ``?pendientes=1`` reanuda con lo que no se alcanzó a entregar."""
+    trabajo = leer_trabajo(trabajo_id)
+    if trabajo is None or trabajo['tipo'] != 'lote':
+        abort(404)
+    partes = generar_zip(
+        trabajo_id, _html_libro_historia, 'pacientes/pdf_libro.html',
+        hojas=HOJAS_LIBRO, catalogos=CATALOGOS_LIBRO,
+        solo_pendientes=request.args.get('pendientes') == '1',
+    )
+    respuesta = current_app.response_class(stream_with_context(partes), mimetype='application/zip')
+    respuesta.headers['Content-Disposition'] = f'attachment; filename={trabajo["nombre_descarga"]}'
+    # que el proxy no acumule la respuesta: cada PDF debe salir en cuanto está listo
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+
+def _html_libro_historia(historia_id):
     historia = HistoriaClinica.query.get_or_404(historia_id)
     ordenes = OrdenMedica.query.filter_by(historia_id=historia_id).all()
     fecha_ingreso_local = historia.fecha_registro if historia.fecha_registro else None
+    medicamentos_cat = catalogo('medicamentos')
 
     diag_cie10 = None
     if historia.cie10_principal:
-        diag_cie10 = DiagnosticoCIE10.query.filter_by(codigo=historia.cie10_principal).first()
+        diag_cie10 = catalogo('cie10').por_clave(historia.cie10_principal)
 
     # --- 1. MEDICAMENTOS GENERALES (Ingreso) ---
     medicamentos_procesados = []
@@ -594,7 +720,7 @@ def pdf_libro_historia(historia_id):
         try:
             datos_json = json.loads(historia.medicamentos_json)
             for m in datos_json:
-                med_db = Medicamento.query.filter_by(codigo=str(m.get('codigo', '')).strip()).first()
+                med_db = medicamentos_cat.por_clave(str(m.get('codigo', '')).strip())
                 
                 # Procesar cantidad y vía con los nombres exactos de tu formulario
                 cant_v = m.get('cantidad_solicitada') or m.get('cantidad') or 0
@@ -622,7 +748,7 @@ def pdf_libro_historia(historia_id):
             try:
                 meds_lista_orden = json.loads(orden.medicamentos_json)
                 for mo in meds_lista_orden:
-                    med_db_o = Medicamento.query.filter_by(codigo=str(mo.get('codigo', '')).strip()).first()
+                    med_db_o = medicamentos_cat.por_clave(str(mo.get('codigo', '')).strip())
                     
                     cant_o = mo.get('cantidad_solicitada') or mo.get('cantidad') or 0
                     try:
@@ -655,8 +781,7 @@ def pdf_libro_historia(historia_id):
             'laboratorios': labs_orden
         })
 
-    ruta_logo = os.path.join(current_app.root_path, 'static', 'img', 'logo.png')
-    html = render_template(
+    return render_template(
         'pacientes/pdf_libro.html',
         historia=historia,
         fecha_ingreso_local=fecha_ingreso_local,
@@ -665,23 +790,18 @@ def pdf_libro_historia(historia_id):
         medicamentos=medicamentos_procesados, # Usamos la lista nueva
         now=datetime.now(),
     )
-    
-    pdf = HTML(string=html).write_pdf()
-    response = make_response(pdf)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'inline; filename=libro_historia_{historia_id}.pdf'
-    return response
 
 @pacientes_bp.route('/historias/libro/<int:historia_id>/ver')
 @login_required
 def ver_historia(historia_id):
     historia = HistoriaClinica.query.get_or_404(historia_id)
     ordenes = OrdenMedica.query.filter_by(historia_id=historia_id).all()
+    medicamentos_cat = catalogo('medicamentos')
     
     # 1. Procesar Diagnóstico CIE-10
     diag_cie10 = None
     if historia.cie10_principal:
-        diag_cie10 = DiagnosticoCIE10.query.filter_by(codigo=historia.cie10_principal).first()
+        diag_cie10 = catalogo('cie10').por_clave(historia.cie10_principal)
 
     # 2. Procesar Medicamentos que vienen en el INGRESO (bloque 5)
     meds_ingreso = []
@@ -691,7 +811,7 @@ def ver_historia(historia_id):
             for m in lista_ingreso:
                 # 1. Buscar nombre en DB
                 cod = m.get('codigo', '').strip()
-                med_db = Medicamento.query.filter_by(codigo=cod).first()
+                med_db = medicamentos_cat.por_clave(cod)
                 
                 # 2. PROCESAR CANTIDAD (Nombre exacto: cantidad_solicitada)
                 cant_valor = m.get('cantidad_solicitada') or 0
@@ -733,7 +853,7 @@ def ver_historia(historia_id):
                 meds_lista = json.loads(orden.medicamentos_json)
                 for m in meds_lista:
                     cod = m.get('codigo', '').strip()
-                    med_db = Medicamento.query.filter_by(codigo=cod).first()
+                    med_db = medicamentos_cat.por_clave(cod)
                     
                     # PROCESAR CANTIDAD (Limpiar el 4.000 a 4)
                     cant_v = m.get('cantidad_solicitada') or m.get('cantidad') or 0
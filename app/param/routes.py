@@ -2,6 +2,9 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
 from app.models import Medicamento, DiagnosticoCIE10, CatLaboratorioExamen
 from app.extensions import db
+from app.utils.transacciones import confirmar
+from app.utils.versiones_catalogo import incrementar_version
+from app.utils.rangos_laboratorio import encolar_remarcado
 
 param_bp = Blueprint('param', __name__, url_prefix='/param')
 
@@ -51,7 +54,8 @@ def medicamento_nuevo():
             unidad_inventario=unidad or None
         )
         db.session.add(med)
-        db.session.commit()
+        incrementar_version('medicamentos')
+        confirmar()
         flash('Medicamento creado correctamente', 'success')
         return redirect(url_for('param.medicamentos'))
 
@@ -75,7 +79,8 @@ def medicamento_editar(med_id):
             flash('Código y nombre son obligatorios', 'danger')
             return redirect(url_for('param.medicamento_editar', med_id=med.id))
 
-        db.session.commit()
+        incrementar_version('medicamentos')
+        confirmar()
         flash('Medicamento actualizado correctamente', 'success')
         return redirect(url_for('param.medicamentos'))
 
@@ -87,7 +92,8 @@ def medicamento_editar(med_id):
 def medicamento_eliminar(med_id):
     med = Medicamento.query.get_or_404(med_id)
     db.session.delete(med)
-    db.session.commit()
+    incrementar_version('medicamentos')
+    confirmar()
     flash('Medicamento eliminado', 'warning')
     return redirect(url_for('param.medicamentos'))
 
@@ -105,7 +111,8 @@ def medicamentos_eliminar_seleccionados():
         .filter(Medicamento.id.in_([int(i) for i in ids]))
         .delete(synchronize_session=False)
     )
-    db.session.commit()
+    incrementar_version('medicamentos')
+    confirmar()
     flash(f'{deleted} medicamentos eliminados.', 'success')
     return redirect(url_for('param.medicamentos'))
 
@@ -135,7 +142,8 @@ def cie10():
 def cie10_toggle(cie_id):
     d = DiagnosticoCIE10.query.get_or_404(cie_id)
     d.habilitado = not d.habilitado
-    db.session.commit()
+    incrementar_version('cie10')
+    confirmar()
     return redirect(url_for('param.cie10'))
 
 # 🧪 Lista de exámenes de laboratorio
@@ -167,7 +175,8 @@ def laboratorios():
 def laboratorio_toggle(examen_id):
     ex = CatLaboratorioExamen.query.get_or_404(examen_id)
     ex.activo = not ex.activo
-    db.session.commit()
+    incrementar_version('laboratorio')
+    confirmar()
     return redirect(url_for('param.laboratorios'))
 
 @param_bp.route('/laboratorios/<int:examen_id>', methods=['GET', 'POST'])
@@ -193,7 +202,8 @@ def laboratorio_detalle(examen_id):
                 valor_ref_max=float(vr_max) if vr_max else None,
             )
             db.session.add(param)
-            db.session.commit()
+            incrementar_version('laboratorio')
+            confirmar()
             flash('Parámetro agregado correctamente.', 'success')
 
         return redirect(url_for('param.laboratorio_detalle', examen_id=ex.id))
@@ -210,7 +220,8 @@ def laboratorio_eliminar(examen_id):
     # También se borran sus parámetros por la FK (si no tienes cascade, los borramos explícitos)
     CatLaboratorioParametro.query.filter_by(examen_id=ex.id).delete()
     db.session.delete(ex)
-    db.session.commit()
+    incrementar_version('laboratorio')
+    confirmar()
     flash('Examen de laboratorio eliminado.', 'warning')
     return redirect(url_for('param.laboratorios'))
 
@@ -230,13 +241,19 @@ def laboratorio_parametro_editar(param_id):
         flash('El nombre del parámetro es obligatorio.', 'danger')
         return redirect(url_for('param.laboratorio_detalle', examen_id=ex_id))
 
+    rango_anterior = (p.valor_ref_min, p.valor_ref_max)
     p.nombre = nombre
     p.unidad = unidad or None
     p.valor_ref_min = float(vr_min) if vr_min else None
     p.valor_ref_max = float(vr_max) if vr_max else None
 
-    db.session.commit()
+    incrementar_version('laboratorio')
+    confirmar()
     flash('Parámetro actualizado.', 'success')
+    if (p.valor_ref_min, p.valor_ref_max) != rango_anterior:
+        # Los resultados ya guardados se vuelven a marcar con el rango nuevo
+        encolar_remarcado(p.id)
+        flash('Las banderas de fuera de rango de sus resultados se están recalculando.', 'info')
     return redirect(url_for('param.laboratorio_detalle', examen_id=ex_id))
 
 # ELIMINAR PARÁMETRO
@@ -246,6 +263,7 @@ def laboratorio_parametro_eliminar(param_id):
     p = CatLaboratorioParametro.query.get_or_404(param_id)
     ex_id = p.examen_id
     db.session.delete(p)
-    db.session.commit()
+    incrementar_version('laboratorio')
+    confirmar()
     flash('Parámetro eliminado.', 'warning')
     return redirect(url_for('param.laboratorio_detalle', examen_id=ex_id))
@@ -0,0 +1,35 @@
+import os
+
+from flask import Blueprint, jsonify, abort
+from flask_login import login_required
+
+from app.utils.cache_pdf import enviar_pdf
+from app.utils.render_pdf import leer_trabajo, publico
+
+pdf_bp = Blueprint('pdf', __name__, url_prefix='/pdf')
+
+
+@pdf_bp.route('/trabajos/<trabajo_id>')
+@login_required
+def estado_trabajo(trabajo_id):
+    """Estado y progreso de un PDF encolado (en_cola, renderizando, listo, error)."""
+    trabajo = leer_trabajo(trabajo_id)
+    if trabajo is None:
+        abort(404)
+    return jsonify(publico(trabajo))
+
+
+@pdf_bp.route('/trabajos/<trabajo_id>/archivo')
+@login_required
+def archivo_trabajo(trabajo_id):
+    """PDF terminado del trabajo; 409 mientras no esté listo."""
+    trabajo = leer_trabajo(trabajo_id)
+    if trabajo is None:
+        abort(404)
+    if trabajo['estado'] != 'listo':
+        return jsonify({'estado': trabajo['estado'], 'progreso': trabajo['progreso'],
+                        'error': trabajo['error']}), 409
+    if not os.path.exists(trabajo['archivo']):
+        # La caché lo desalojó o la historia cambió: hay que pedir un trabajo nuevo
+        return jsonify({'error': 'El PDF ya no está disponible, solicítelo de nuevo.'}), 410
+    return enviar_pdf(trabajo['archivo'], trabajo['huella'], trabajo['nombre_descarga'])
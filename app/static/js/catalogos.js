@@ -0,0 +1,60 @@
+/*
+ * Autocompletado de catálogos bajo demanda.
+ *
+ * Un campo de texto con data-catalogo="medicamentos" (o "cie10") consulta
+ * /catalogos/<catalogo>/buscar mientras se escribe y llena su <datalist>.
+ * Al elegir una opción se copia el código al input oculto de la misma fila
+ * (data-catalogo-valor), que es el que viaja en el formulario. Funciona con
+ * filas clonadas porque los eventos se escuchan en el documento.
+ */
+(function () {
+  const ESPERA_MS = 200;
+  const temporizadores = new WeakMap();
+
+  function fila(input) {
+    return input.closest('[data-catalogo-fila]') || input.parentElement;
+  }
+
+  function elegir(input, opcion) {
+    const contenedor = fila(input);
+    const oculto = contenedor.querySelector('input[data-catalogo-valor]');
+    if (oculto) oculto.value = opcion ? opcion.dataset.codigo : '';
+
+    // Sugerir la unidad de inventario del medicamento si el campo está vacío
+    const unidad = contenedor.querySelector('input[name$="[unidad_inventario]"]');
+    if (opcion && unidad && !unidad.value && opcion.dataset.unidad) {
+      unidad.value = opcion.dataset.unidad;
+    }
+  }
+
+  function llenar(lista, items) {
+    lista.innerHTML = '';
+    items.forEach(item => {
+      const opcion = document.createElement('option');
+      opcion.value = `${item.codigo} - ${item.nombre}`;
+      opcion.dataset.codigo = item.codigo;
+      if (item.unidad_inventario) opcion.dataset.unidad = item.unidad_inventario;
+      lista.appendChild(opcion);
+    });
+  }
+
+  document.addEventListener('input', function (e) {
+    const input = e.target;
+    if (!input.matches || !input.matches('input[data-catalogo]')) return;
+
+    const lista = document.getElementById(input.getAttribute('list'));
+    const valor = input.value.trim();
+    const elegida = Array.from(lista.options).find(o => o.value === valor);
+    elegir(input, elegida || null);
+    if (elegida || valor.length < 2) return;
+
+    clearTimeout(temporizadores.get(input));
+    temporizadores.set(input, setTimeout(function () {
+      const url = `/catalogos/${input.dataset.catalogo}/buscar?q=${encodeURIComponent(valor)}`;
+      fetch(url, { headers: { 'Accept': 'application/json' } })
+        .then(resp => resp.json())
+        .then(data => llenar(lista, data.items || []))
+        .catch(err => console.error(err));
+    }, ESPERA_MS));
+  });
+})();
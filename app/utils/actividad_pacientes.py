@@ -0,0 +1,80 @@
+"""Última actividad de cada paciente.
+
+``pacientes.ultima_actividad`` ordena el listado de pacientes (ver
+app/utils/listado_pacientes.py) con un índice, sin calcular máximos sobre
+historias y registros en cada página. Sube en el mismo flush que inserta
+una historia, una orden médica, un registro de enfermería o una solicitud
+de insumos del paciente.
+
+Las inserciones masivas (``bulk_insert_mappings``, ``insert()``) no pasan
+por aquí; quien las use debe llamar a ``marcar_actividad``.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, update, select, or_
+
+from app.extensions import db
+from app.models import Paciente, HistoriaClinica, OrdenMedica, RegistroEnfermeria, SolicitudInsumo
+
+
+def marcar_actividad(paciente_ids, cuando=None, session=None):
+    """Pone ``ultima_actividad`` de ``paciente_ids`` en ``cuando`` (ahora por defecto)."""
+    session = session or db.session
+    ids = {i for i in paciente_ids if i is not None}
+    if ids:
+        session.execute(
+            update(Paciente)
+            .where(Paciente.id.in_(ids))
+            .values(ultima_actividad=cuando or datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _paciente_de(obj):
+    """(paciente_id, historia_id) de un objeto nuevo; la orden solo conoce su historia."""
+    if isinstance(obj, (HistoriaClinica, RegistroEnfermeria, SolicitudInsumo)):
+        if obj.paciente_id is not None:
+            return obj.paciente_id, None
+        return (obj.paciente.id if obj.paciente is not None else None), None
+    if isinstance(obj, OrdenMedica):
+        if obj.historia_id is not None:
+            return None, obj.historia_id
+        return (obj.historia.paciente_id if obj.historia is not None else None), None
+    return None, None
+
+
+@event.listens_for(db.session, 'before_flush')
+def _recolectar(session, flush_context, instances):
+    pacientes, historias = set(), set()
+    for obj in session.new:
+        paciente_id, historia_id = _paciente_de(obj)
+        if paciente_id is not None:
+            pacientes.add(paciente_id)
+        if historia_id is not None:
+            historias.add(historia_id)
+    if pacientes or historias:
+        session.info['_pendientes_actividad'] = (pacientes, historias)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _marcar(session, flush_context):
+    pendientes = session.info.pop('_pendientes_actividad', None)
+    if not pendientes:
+        return
+    pacientes, historias = pendientes
+    tabla = Paciente.__table__
+    condiciones = []
+    if pacientes:
+        condiciones.append(tabla.c.id.in_(pacientes))
+    if historias:
+        condiciones.append(tabla.c.id.in_(
+            select(HistoriaClinica.paciente_id).where(HistoriaClinica.id.in_(historias))
+        ))
+    session.connection().execute(
+        update(tabla).where(or_(*condiciones)).values(ultima_actividad=datetime.now())
+    )
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar(session):
+    session.info.pop('_pendientes_actividad', None)
@@ -0,0 +1,235 @@
+"""Acumulado de laboratorio de una historia: parámetros por fecha.
+
+Una sola consulta trae todos los resultados con valor de la historia (con
+la fecha de su solicitud) y pandas los pivota: una fila por parámetro, una
+columna por fecha de resultado, ordenadas por grupo y examen del catálogo.
+Si un parámetro tiene dos valores en la misma fecha queda el último.
+
+El acumulado se guarda en memoria por (historia, ``version_contenido``,
+versión del catálogo de laboratorio): cualquier resultado nuevo o editado
+sube la versión de la historia (app/utils/versiones_historia.py), así que
+nunca se sirve uno viejo. Se guardan hasta LAB_ACUMULADO_CACHE historias.
+
+Cada fila trae además los valores numéricos alineados con las fechas para
+las sparklines (``sparkline`` da los puntos de un ``<polyline>`` SVG) y la
+tendencia entre el primer y el último valor.
+"""
+import csv
+import io
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import pandas as pd
+from flask import current_app
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from sqlalchemy import select, func, type_coerce, String
+
+from app.extensions import db
+from app.metricas import registrar_metrica
+from app.models import LabResultado, LabSolicitud
+from app.utils.cache_catalogos import catalogo
+from app.utils.versiones_catalogo import version_catalogo
+from app.utils.versiones_historia import version_historia
+
+Acumulado = namedtuple('Acumulado', 'historia_id fechas filas')
+FilaAcumulado = namedtuple(
+    'FilaAcumulado',
+    'parametro_id grupo examen parametro unidad ref_min ref_max valores numeros fuera tendencia',
+)
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class _MetricasAcumulado:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.construccion_ms = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'ultima_construccion_ms': round(self.construccion_ms, 2),
+                'historias_en_cache': len(_cache),
+            }
+
+
+metricas_acumulado = _MetricasAcumulado()
+registrar_metrica('acumulado_laboratorio', metricas_acumulado.snapshot)
+
+
+def _tendencia(numeros):
+    valores = [n for n in numeros if n is not None]
+    if len(valores) < 2 or valores[-1] == valores[0]:
+        return None
+    return 'sube' if valores[-1] > valores[0] else 'baja'
+
+
+def consulta_resultados(historia_id):
+    """Resultados con valor de todas las solicitudes de la historia."""
+    return (
+        select(
+            LabResultado.id, LabResultado.parametro_id, LabResultado.examen_id, LabResultado.valor,
+            LabResultado.valor_num, LabResultado.flag_fuera_rango,
+            # Sin el tipo DateTime: SQLite devuelve el texto y pandas lo convierte de una vez
+            type_coerce(
+                func.coalesce(LabSolicitud.fecha_resultado, LabSolicitud.fecha_solicitud), String
+            ).label('fecha'),
+        )
+        .join(LabSolicitud, LabSolicitud.id == LabResultado.solicitud_id)
+        .where(LabSolicitud.historia_id == historia_id, LabResultado.valor.isnot(None), LabResultado.valor != '')
+    )
+
+
+def _construir(historia_id, session):
+    filas = session.execute(consulta_resultados(historia_id)).all()
+    if not filas:
+        return Acumulado(historia_id, (), ())
+
+    columnas = ['id', 'parametro_id', 'examen_id', 'valor', 'valor_num', 'fuera', 'fecha']
+    df = pd.DataFrame(dict(zip(columnas, zip(*filas))))
+    df['fecha'] = pd.to_datetime(df['fecha'], format='ISO8601').dt.floor('min')
+    df = df.sort_values(['fecha', 'id']).drop_duplicates(['parametro_id', 'fecha'], keep='last')
+    tabla = df.pivot(index='parametro_id', columns='fecha', values=['valor', 'valor_num', 'fuera'])
+    fechas = tuple(f.to_pydatetime() for f in tabla['valor'].columns)
+    # Matrices parámetro x fecha: recorrerlas es mucho más barato que .loc por fila
+    valores = tabla['valor'].to_numpy(dtype=object)
+    numeros = tabla['valor_num'].to_numpy(dtype='float64', na_value=float('nan'))
+    fuera = tabla['fuera'].fillna(False).to_numpy(dtype=bool)
+
+    examenes = catalogo('lab_examenes')
+    parametros = catalogo('lab_parametros')
+    examen_de = dict(zip(df['parametro_id'], df['examen_id']))
+    resultado = []
+    for i, parametro_id in enumerate(tabla.index.tolist()):
+        param = parametros.get(parametro_id)
+        examen = examenes.get(examen_de[parametro_id])
+        serie = tuple(None if n != n else n for n in numeros[i].tolist())
+        resultado.append(FilaAcumulado(
+            parametro_id=parametro_id,
+            grupo=(examen.grupo if examen else None) or '',
+            examen=examen.nombre if examen else '',
+            parametro=param.nombre if param else f'Parámetro {parametro_id}',
+            unidad=param.unidad if param else None,
+            ref_min=param.valor_ref_min if param else None,
+            ref_max=param.valor_ref_max if param else None,
+            valores=tuple(None if pd.isna(v) else v for v in valores[i]),
+            numeros=serie,
+            fuera=tuple(fuera[i].tolist()),
+            tendencia=_tendencia(serie),
+        ))
+    resultado.sort(key=lambda f: (f.grupo, f.examen, f.parametro_id))
+    return Acumulado(historia_id, fechas, tuple(resultado))
+
+
+def acumulado_historia(historia_id, session=None):
+    """Acumulado vigente de la historia, o None si la historia no existe."""
+    session = session or db.session
+    version = version_historia(historia_id, session)
+    if version is None:
+        return None
+    clave = (historia_id, version, version_catalogo('laboratorio'))
+    with _lock:
+        guardado = _cache.get(clave)
+        if guardado is not None:
+            _cache.move_to_end(clave)
+    if guardado is not None:
+        with metricas_acumulado._lock:
+            metricas_acumulado.aciertos += 1
+        return guardado
+
+    inicio = time.perf_counter()
+    acumulado = _construir(historia_id, session)
+    with metricas_acumulado._lock:
+        metricas_acumulado.fallos += 1
+        metricas_acumulado.construccion_ms = (time.perf_counter() - inicio) * 1000
+
+    limite = current_app.config.get('LAB_ACUMULADO_CACHE', 128)
+    with _lock:
+        # Las versiones anteriores de la misma historia ya no se pedirán
+        for vieja in [k for k in _cache if k[0] == historia_id]:
+            del _cache[vieja]
+        _cache[clave] = acumulado
+        while len(_cache) > limite:
+            _cache.popitem(last=False)
+    return acumulado
+
+
+def sparkline(numeros, ancho=120, alto=24):
+    """Puntos ``x,y`` de un ``<polyline>`` SVG; vacío si hay menos de dos valores."""
+    puntos = [(i, n) for i, n in enumerate(numeros) if n is not None]
+    if len(puntos) < 2:
+        return ''
+    minimo = min(n for _, n in puntos)
+    rango = (max(n for _, n in puntos) - minimo) or 1
+    paso = ancho / max(1, len(numeros) - 1)
+    return ' '.join(
+        f'{i * paso:.1f},{alto - 2 - (n - minimo) / rango * (alto - 4):.1f}' for i, n in puntos
+    )
+
+
+def datos_sparklines(acumulado):
+    """Serie numérica por parámetro, alineada con las fechas (JSON)."""
+    return {
+        'historia_id': acumulado.historia_id,
+        'fechas': [f.isoformat() for f in acumulado.fechas],
+        'parametros': [
+            {
+                'id': f.parametro_id, 'examen': f.examen, 'parametro': f.parametro,
+                'unidad': f.unidad, 'ref_min': f.ref_min, 'ref_max': f.ref_max,
+                'valores': list(f.numeros), 'tendencia': f.tendencia,
+            }
+            for f in acumulado.filas
+        ],
+    }
+
+
+def _encabezado(acumulado):
+    return ['EXAMEN', 'PARAMETRO', 'UNIDAD', 'REF_MIN', 'REF_MAX'] + [
+        f.strftime('%d/%m/%Y %H:%M') for f in acumulado.fechas
+    ]
+
+
+def exportar_csv(acumulado):
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow(_encabezado(acumulado))
+    for f in acumulado.filas:
+        escritor.writerow(
+            [f.examen, f.parametro, f.unidad or '', f.ref_min if f.ref_min is not None else '',
+             f.ref_max if f.ref_max is not None else '']
+            + [f'{v} *' if fuera else (v or '') for v, fuera in zip(f.valores, f.fuera)]
+        )
+    # BOM: Excel abre el CSV en UTF-8 sin romper las tildes
+    return ('﻿' + salida.getvalue()).encode('utf-8')
+
+
+def exportar_xlsx(acumulado):
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet('Acumulado')
+    hoja.freeze_panes = 'F2'
+    negrita, roja = Font(bold=True), Font(bold=True, color='C00000')
+    fila = []
+    for titulo in _encabezado(acumulado):
+        celda = WriteOnlyCell(hoja, value=titulo)
+        celda.font = negrita
+        fila.append(celda)
+    hoja.append(fila)
+    for f in acumulado.filas:
+        fila = [f.examen, f.parametro, f.unidad, f.ref_min, f.ref_max]
+        for valor, numero, fuera in zip(f.valores, f.numeros, f.fuera):
+            celda = WriteOnlyCell(hoja, value=numero if numero is not None else valor)
+            if fuera:
+                celda.font = roja
+            fila.append(celda)
+        hoja.append(fila)
+    salida = io.BytesIO()
+    libro.save(salida)
+    return salida.getvalue()
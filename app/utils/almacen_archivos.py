@@ -0,0 +1,395 @@
+"""Almacén por contenido de los archivos de ayudas diagnósticas.
+
+Cada archivo subido se copia por bloques (ARCHIVOS_BLOQUE_KB) a un temporal
+mientras se calcula su SHA-256; el hash es la clave del contenido. Si ya
+existe no se vuelve a escribir: dos estudios idénticos ocupan un solo
+archivo, y dos archivos distintos con el mismo nombre ya no se pisan.
+
+La tabla ``archivos_ayuda`` lleva una fila por contenido con el número de
+ayudas que la usan (``referencias``). ``guardar_subida`` suma una,
+``soltar_archivos`` resta y borra las filas que quedan en cero; el
+contenido se borra del almacén con ``borrar_contenidos`` después de
+confirmar, si nadie volvió a subirlo entretanto. Los archivos generados a
+partir de un contenido (miniaturas, ver app/utils/miniaturas.py) se guardan
+junto a él con un sufijo y se borran con él.
+
+Escribir un contenido y borrarlo se serializan con el bloqueo de escritura
+(``BEGIN IMMEDIATE`` en SQLite, un advisory lock por clave en PostgreSQL):
+la subida lo toma antes de mirar si el contenido ya existe y lo suelta al
+confirmar la referencia, y el borrado vuelve a comprobar las referencias
+con el bloqueo tomado. Así un borrado no se lleva un contenido que otra
+subida acaba de reutilizar. Si la transacción de la subida se deshace, el
+contenido queda sin fila; ``flask barrer-archivos`` (``barrer_huerfanos``)
+los borra.
+
+Backends (ARCHIVOS_BACKEND):
+
+- ``local``: ARCHIVOS_DIR (por defecto instance/archivos_ayudas), en
+  subdirectorios por los primeros caracteres del hash (``ab/cd/abcd...``)
+  para no juntar miles de archivos en una carpeta
+- ``s3``: un bucket compatible con S3 (ARCHIVOS_S3_BUCKET); con
+  ARCHIVOS_S3_ENDPOINT apunta a MinIO u otro servicio local. Necesita boto3,
+  que solo se importa si se elige este backend
+
+Se pueden agregar otros con ``registrar_backend``.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import select, update, delete, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.extensions import db
+from app.models import ArchivoAyuda
+from app.utils.fechas import ahora_bogota
+from app.utils.transacciones import iniciar_escritura
+
+_INSERT_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+_CLAVE = re.compile(r'^[0-9a-f]{64}$')
+
+# Tamaño de las listas IN (SQLite acepta pocos parámetros por sentencia)
+_LOTE_IN = 900
+
+
+def es_clave(valor):
+    """True si ``valor`` es una clave de contenido (y no una ruta de las de antes)."""
+    return bool(_CLAVE.match(valor or ''))
+
+
+def ruta_relativa(clave, sufijo=''):
+    """``ab/cd/abcd...``: posición del contenido dentro del almacén."""
+    return '/'.join((clave[:2], clave[2:4], clave + sufijo))
+
+
+class AlmacenLocal:
+    def __init__(self, raiz):
+        self.raiz = raiz
+
+    def ruta(self, clave, sufijo=''):
+        return os.path.join(self.raiz, *ruta_relativa(clave, sufijo).split('/'))
+
+    def temporal(self):
+        # En el mismo disco que el destino: guardar() es un rename atómico
+        directorio = os.path.join(self.raiz, 'tmp')
+        os.makedirs(directorio, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directorio, delete=False)
+
+    def guardar(self, clave, ruta_temporal, tipo_mime=None):
+        destino = self.ruta(clave)
+        if os.path.exists(destino):
+            os.remove(ruta_temporal)
+            return False
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(ruta_temporal, destino)
+        return True
+
+    def guardar_derivado(self, clave, sufijo, datos, tipo_mime=None):
+        """Archivo generado a partir del contenido (miniatura, vista previa), junto al original."""
+        with self.temporal() as temporal:
+            temporal.write(datos)
+        os.makedirs(os.path.dirname(self.ruta(clave)), exist_ok=True)
+        os.replace(temporal.name, self.ruta(clave, sufijo))
+
+    def existe(self, clave, sufijo=''):
+        return os.path.exists(self.ruta(clave, sufijo))
+
+    def abrir(self, clave, sufijo=''):
+        return open(self.ruta(clave, sufijo), 'rb')
+
+    def ruta_local(self, clave, sufijo=''):
+        return self.ruta(clave, sufijo)
+
+    def claves(self):
+        """Claves de todos los contenidos guardados (un derivado cuenta como su contenido)."""
+        for directorio, subdirectorios, nombres in os.walk(self.raiz):
+            if directorio == self.raiz and 'tmp' in subdirectorios:
+                subdirectorios.remove('tmp')
+            yield from {n[:64] for n in nombres if es_clave(n[:64])}
+
+    def borrar_temporales(self, antiguedad_s):
+        """Borra temporales de subidas interrumpidas con más de ``antiguedad_s`` segundos."""
+        directorio = os.path.join(self.raiz, 'tmp')
+        limite = time.time() - antiguedad_s
+        borrados = 0
+        try:
+            entradas = list(os.scandir(directorio))
+        except FileNotFoundError:
+            return 0
+        for entrada in entradas:
+            try:
+                if entrada.is_file() and entrada.stat().st_mtime < limite:
+                    os.remove(entrada.path)
+                    borrados += 1
+            except FileNotFoundError:
+                pass
+        return borrados
+
+    def borrar(self, clave):
+        """Borra el contenido y sus derivados."""
+        directorio = os.path.dirname(self.ruta(clave))
+        try:
+            nombres = [n for n in os.listdir(directorio) if n.startswith(clave)]
+        except FileNotFoundError:
+            return False
+        for nombre in nombres:
+            try:
+                os.remove(os.path.join(directorio, nombre))
+            except FileNotFoundError:
+                pass
+        return clave in nombres
+
+
+class AlmacenS3:
+    def __init__(self, bucket, prefijo='', endpoint_url=None, cliente=None):
+        if cliente is None:
+            import boto3
+            cliente = boto3.client('s3', endpoint_url=endpoint_url)
+        self.cliente = cliente
+        self.bucket = bucket
+        self.prefijo = prefijo
+
+    def _objeto(self, clave, sufijo=''):
+        return self.prefijo + ruta_relativa(clave, sufijo)
+
+    def temporal(self):
+        return tempfile.NamedTemporaryFile(delete=False)
+
+    def guardar(self, clave, ruta_temporal, tipo_mime=None):
+        try:
+            if self.existe(clave):
+                return False
+            extra = {'ContentType': tipo_mime} if tipo_mime else None
+            self.cliente.upload_file(ruta_temporal, self.bucket, self._objeto(clave), ExtraArgs=extra)
+            return True
+        finally:
+            os.remove(ruta_temporal)
+
+    def guardar_derivado(self, clave, sufijo, datos, tipo_mime=None):
+        extra = {'ContentType': tipo_mime} if tipo_mime else {}
+        self.cliente.put_object(Bucket=self.bucket, Key=self._objeto(clave, sufijo), Body=datos, **extra)
+
+    def existe(self, clave, sufijo=''):
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=self._objeto(clave, sufijo))
+            return True
+        except self.cliente.exceptions.ClientError as error:
+            if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def abrir(self, clave, sufijo=''):
+        return self.cliente.get_object(Bucket=self.bucket, Key=self._objeto(clave, sufijo))['Body']
+
+    def ruta_local(self, clave, sufijo=''):
+        return None
+
+    def url_firmada(self, clave, sufijo, tipo_mime, nombre, descarga, segundos):
+        """URL temporal para que el navegador baje el objeto directo del bucket."""
+        parametros = {'Bucket': self.bucket, 'Key': self._objeto(clave, sufijo)}
+        if tipo_mime:
+            parametros['ResponseContentType'] = tipo_mime
+        if nombre:
+            parametros['ResponseContentDisposition'] = (
+                f'{"attachment" if descarga else "inline"}; filename="{nombre}"'
+            )
+        return self.cliente.generate_presigned_url('get_object', Params=parametros, ExpiresIn=segundos)
+
+    def claves(self):
+        """Claves de todos los contenidos del bucket (un derivado cuenta como su contenido)."""
+        paginas = self.cliente.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefijo)
+        for pagina in paginas:
+            nombres = {objeto['Key'].rsplit('/', 1)[-1][:64] for objeto in pagina.get('Contents', [])}
+            yield from (n for n in nombres if es_clave(n))
+
+    def borrar_temporales(self, antiguedad_s):
+        # Los temporales de S3 están en el disco local y guardar() los borra siempre
+        return 0
+
+    def borrar(self, clave):
+        """Borra el contenido y sus derivados (todo lo que empieza con su clave)."""
+        listado = self.cliente.list_objects_v2(Bucket=self.bucket, Prefix=self._objeto(clave))
+        for objeto in listado.get('Contents', []):
+            self.cliente.delete_object(Bucket=self.bucket, Key=objeto['Key'])
+        return bool(listado.get('Contents'))
+
+
+def _local(config, app):
+    return AlmacenLocal(config.get('ARCHIVOS_DIR') or os.path.join(app.instance_path, 'archivos_ayudas'))
+
+
+def _s3(config, app):
+    if not config.get('ARCHIVOS_S3_BUCKET'):
+        raise RuntimeError('ARCHIVOS_BACKEND=s3 requiere ARCHIVOS_S3_BUCKET')
+    return AlmacenS3(
+        config['ARCHIVOS_S3_BUCKET'],
+        prefijo=config.get('ARCHIVOS_S3_PREFIJO') or '',
+        endpoint_url=config.get('ARCHIVOS_S3_ENDPOINT') or None,
+    )
+
+
+_BACKENDS = {'local': _local, 's3': _s3}
+
+
+def registrar_backend(nombre, fabrica):
+    """``fabrica(config, app)`` devuelve un objeto con la interfaz de AlmacenLocal."""
+    _BACKENDS[nombre] = fabrica
+
+
+def almacen():
+    """Backend configurado de la aplicación actual (uno por aplicación)."""
+    app = current_app._get_current_object()
+    instancia = app.extensions.get('almacen_archivos')
+    if instancia is None:
+        nombre = app.config.get('ARCHIVOS_BACKEND') or 'local'
+        if nombre not in _BACKENDS:
+            raise RuntimeError(f'Backend de archivos desconocido: {nombre}')
+        instancia = app.extensions['almacen_archivos'] = _BACKENDS[nombre](app.config, app)
+    return instancia
+
+
+def _recibir(file_storage, destino):
+    """Copia el archivo al temporal por bloques; devuelve (sha256, tamaño, ruta)."""
+    bloque = current_app.config.get('ARCHIVOS_BLOQUE_KB', 1024) * 1024
+    huella = hashlib.sha256()
+    tamano = 0
+    temporal = destino.temporal()
+    try:
+        with temporal:
+            while True:
+                datos = file_storage.stream.read(bloque)
+                if not datos:
+                    break
+                huella.update(datos)
+                temporal.write(datos)
+                tamano += len(datos)
+    except Exception:
+        os.remove(temporal.name)
+        raise
+    return huella.hexdigest(), tamano, temporal.name
+
+
+def _bloquear_contenidos(claves, session):
+    """Toma el bloqueo que serializa escribir y borrar ``claves``, hasta el commit o rollback."""
+    if session.get_bind().dialect.name == 'postgresql':
+        # En orden, para que dos transacciones no se esperen en cruz
+        for clave in sorted(set(claves)):
+            session.execute(text('SELECT pg_advisory_xact_lock(:n)'), {'n': int(clave[:15], 16)})
+    else:
+        iniciar_escritura(session)
+
+
+def guardar_subida(file_storage, session=None):
+    """Guarda el archivo subido y suma una referencia a su contenido.
+
+    Devuelve el id de ``archivos_ayuda`` (None si no vino archivo). No
+    confirma: la referencia se guarda junto con la ayuda que la usa.
+    """
+    if not file_storage or not file_storage.filename:
+        return None
+    session = session or db.session
+    dialecto = session.get_bind().dialect.name
+    if dialecto not in _INSERT_UPSERT:
+        raise RuntimeError(f'Almacén de archivos no soportado en {dialecto}')
+    destino = almacen()
+    clave, tamano, temporal = _recibir(file_storage, destino)
+    tipo_mime = mimetypes.guess_type(file_storage.filename)[0] or file_storage.mimetype or None
+    # Desde aquí hasta confirmar la referencia ningún borrado puede quitar el contenido
+    _bloquear_contenidos([clave], session)
+    destino.guardar(clave, temporal, tipo_mime)
+
+    sentencia = _INSERT_UPSERT[dialecto](ArchivoAyuda.__table__).values(
+        sha256=clave, tamano=tamano, tipo_mime=tipo_mime, referencias=1, creado=ahora_bogota(),
+    )
+    sentencia = sentencia.on_conflict_do_update(
+        index_elements=['sha256'],
+        set_={'referencias': ArchivoAyuda.__table__.c.referencias + 1},
+    ).returning(ArchivoAyuda.__table__.c.id)
+    return session.execute(sentencia).scalar_one()
+
+
+def soltar_archivos(archivo_ids, session=None):
+    """Resta una referencia por cada id (puede repetirse) y borra las que quedan en cero.
+
+    Devuelve las claves de contenido sin referencias, para ``borrar_contenidos``
+    después de confirmar. No confirma.
+    """
+    cuantas = Counter(i for i in archivo_ids if i is not None)
+    if not cuantas:
+        return []
+    session = session or db.session
+    iniciar_escritura(session)
+    # Un UPDATE por cada número distinto de referencias a restar (casi siempre uno)
+    por_cantidad = {}
+    for archivo_id, n in cuantas.items():
+        por_cantidad.setdefault(n, []).append(archivo_id)
+    for n, ids in por_cantidad.items():
+        session.execute(
+            update(ArchivoAyuda).where(ArchivoAyuda.id.in_(ids))
+            .values(referencias=ArchivoAyuda.referencias - n)
+            .execution_options(synchronize_session=False)
+        )
+    claves = session.execute(
+        select(ArchivoAyuda.sha256).where(ArchivoAyuda.id.in_(list(cuantas)), ArchivoAyuda.referencias <= 0)
+    ).scalars().all()
+    if claves:
+        session.execute(
+            delete(ArchivoAyuda).where(ArchivoAyuda.sha256.in_(claves))
+            .execution_options(synchronize_session=False)
+        )
+    return claves
+
+
+def borrar_contenidos(claves, session=None):
+    """Borra del almacén los contenidos soltados, salvo los que se volvieron a subir.
+
+    Se llama después de confirmar: abre su propia transacción con el bloqueo
+    tomado, así una subida del mismo contenido que esté en curso termina
+    antes (y su referencia se ve) o empieza después (y lo vuelve a escribir).
+    """
+    claves = list(claves)
+    if not claves:
+        return 0
+    session = session or db.session
+    destino = almacen()
+    borrados = 0
+    try:
+        _bloquear_contenidos(claves, session)
+        vigentes = set(session.execute(
+            select(ArchivoAyuda.sha256).where(ArchivoAyuda.sha256.in_(claves))
+        ).scalars())
+        for clave in claves:
+            if clave not in vigentes and destino.borrar(clave):
+                borrados += 1
+    finally:
+        # Solo se leyó: cerrar la transacción suelta el bloqueo
+        session.rollback()
+    return borrados
+
+
+def barrer_huerfanos(temporales_s=24 * 3600, session=None):
+    """Borra los contenidos del almacén que no tienen fila en ``archivos_ayuda``.
+
+    Quedan cuando se deshace la transacción de una subida. Devuelve
+    ``(contenidos, temporales)`` borrados; los temporales son los de
+    subidas interrumpidas con más de ``temporales_s`` segundos.
+    """
+    session = session or db.session
+    destino = almacen()
+    temporales = destino.borrar_temporales(temporales_s)
+    borrados = 0
+    claves = list(destino.claves())
+    for inicio in range(0, len(claves), _LOTE_IN):
+        lote = claves[inicio:inicio + _LOTE_IN]
+        con_fila = set(session.execute(
+            select(ArchivoAyuda.sha256).where(ArchivoAyuda.sha256.in_(lote))
+        ).scalars())
+        session.rollback()
+        # borrar_contenidos vuelve a comprobar con el bloqueo: una subida en curso se respeta
+        borrados += borrar_contenidos([c for c in lote if c not in con_fila], session=session)
+    return borrados, temporales
@@ -0,0 +1,244 @@
+"""Búsqueda de texto libre en el contenido clínico.
+
+Fuentes indexadas:
+
+- ``historia``: campos SOAP y los seis ``antecedentes_*`` de la historia clínica
+- ``enfermeria``: ``texto_nota`` de los registros de enfermería
+- ``laboratorio``: ``interpretacion`` de los resultados de laboratorio
+
+En SQLite cada fuente tiene un índice FTS5 de contenido externo que los
+triggers mantienen al día (migración c5a7e9d3b1f2). Cada fuente se consulta
+con ``MATCH ... ORDER BY rank LIMIT``, así el costo depende del número de
+coincidencias pedidas y no del número de notas. En otros motores se usa
+ILIKE como respaldo, sin ranking.
+
+No hay filtro por usuario: la aplicación no tiene roles ni permisos por
+paciente (``usuarios`` no guarda rol) y cualquier usuario con sesión ve
+todas las historias en las demás pantallas. La ruta exige sesión; si se
+agregan roles, ``buscar_en_notas`` recibe las fuentes a consultar.
+"""
+import html
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text, or_
+
+from app.extensions import db
+from app.models import Paciente, HistoriaClinica, RegistroEnfermeria, LabResultado, LabSolicitud
+from app.utils.texto import normalizar_texto, tokens
+
+# Marcadores que usa snippet(); se reemplazan por <mark> después de escapar el HTML
+_INICIO, _FIN = '\x02', '\x03'
+
+FUENTES = ('historia', 'enfermeria', 'laboratorio')
+
+_CONSULTAS_FTS = {
+    'historia': """
+        SELECT h.id AS registro_id, h.id AS historia_id, h.paciente_id,
+               h.fecha_registro AS fecha,
+               bm25(historias_fts) AS rank,
+               snippet(historias_fts, -1, :ini, :fin, '…', 16) AS fragmento
+        FROM historias_fts
+        JOIN historias_clinicas h ON h.id = historias_fts.rowid
+        WHERE historias_fts MATCH :expresion {filtro_fecha}
+        ORDER BY rank
+        LIMIT :limite
+    """,
+    'enfermeria': """
+        SELECT r.id AS registro_id, r.historia_clinica_id AS historia_id, r.paciente_id,
+               r.fecha_registro AS fecha,
+               bm25(notas_enfermeria_fts) AS rank,
+               snippet(notas_enfermeria_fts, 0, :ini, :fin, '…', 16) AS fragmento
+        FROM notas_enfermeria_fts
+        JOIN registro_enfermeria r ON r.id = notas_enfermeria_fts.rowid
+        WHERE notas_enfermeria_fts MATCH :expresion {filtro_fecha}
+        ORDER BY rank
+        LIMIT :limite
+    """,
+    'laboratorio': """
+        SELECT lr.id AS registro_id, s.historia_id, h.paciente_id,
+               COALESCE(s.fecha_resultado, s.fecha_solicitud) AS fecha,
+               bm25(lab_interpretacion_fts) AS rank,
+               snippet(lab_interpretacion_fts, 0, :ini, :fin, '…', 16) AS fragmento
+        FROM lab_interpretacion_fts
+        JOIN lab_resultado lr ON lr.id = lab_interpretacion_fts.rowid
+        JOIN lab_solicitud s ON s.id = lr.solicitud_id
+        JOIN historias_clinicas h ON h.id = s.historia_id
+        WHERE lab_interpretacion_fts MATCH :expresion {filtro_fecha}
+        ORDER BY rank
+        LIMIT :limite
+    """,
+}
+
+_COLUMNA_FECHA = {
+    'historia': 'h.fecha_registro',
+    'enfermeria': 'r.fecha_registro',
+    'laboratorio': 'COALESCE(s.fecha_resultado, s.fecha_solicitud)',
+}
+
+
+def expresion_fts(termino):
+    """Convierte el texto del usuario en una consulta FTS5 segura.
+
+    Cada palabra va entre comillas (no se interpretan operadores) y la
+    última se busca como prefijo: 'neumo bacter' -> "neumo" "bacter"*
+    """
+    palabras = tokens(termino)
+    if not palabras:
+        return ''
+    partes = ['"' + p.replace('"', '""') + '"' for p in palabras]
+    partes[-1] += '*'
+    return ' '.join(partes)
+
+
+def _fragmento_html(fragmento):
+    return html.escape(fragmento or '').replace(_INICIO, '<mark>').replace(_FIN, '</mark>')
+
+
+def _hay_indices_fts(session):
+    return session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'historias_fts'"
+    )).first() is not None
+
+
+def _buscar_fts(session, fuente, expresion, desde, hasta, limite):
+    filtro = ''
+    parametros = {'expresion': expresion, 'limite': limite, 'ini': _INICIO, 'fin': _FIN}
+    columna = _COLUMNA_FECHA[fuente]
+    if desde:
+        filtro += f' AND {columna} >= :desde'
+        parametros['desde'] = desde.isoformat(' ')
+    if hasta:
+        filtro += f' AND {columna} < :hasta'
+        parametros['hasta'] = hasta.isoformat(' ')
+
+    sql = _CONSULTAS_FTS[fuente].format(filtro_fecha=filtro)
+    return [
+        {
+            'fuente': fuente,
+            'registro_id': fila.registro_id,
+            'historia_id': fila.historia_id,
+            'paciente_id': fila.paciente_id,
+            'fecha': str(fila.fecha)[:16] if fila.fecha else None,
+            'rank': fila.rank,
+            'fragmento': _fragmento_html(fila.fragmento),
+        }
+        for fila in session.execute(text(sql), parametros)
+    ]
+
+
+def _fragmento_generico(valor, palabras, ancho=80):
+    """Recorte alrededor de la primera palabra encontrada (respaldo sin FTS)."""
+    valor = valor or ''
+    normalizado = normalizar_texto(valor)
+    posicion = min((normalizado.find(p) for p in palabras if p in normalizado), default=0)
+    inicio = max(0, posicion - ancho // 2)
+    recorte = valor[inicio:inicio + ancho]
+    return ('…' if inicio else '') + html.escape(recorte) + ('…' if inicio + ancho < len(valor) else '')
+
+
+def _buscar_generico(session, fuente, palabras, desde, hasta, limite):
+    if fuente == 'historia':
+        columnas = [
+            HistoriaClinica.subjetivos, HistoriaClinica.objetivos,
+            HistoriaClinica.analisis, HistoriaClinica.plan,
+            HistoriaClinica.antecedentes_medicos, HistoriaClinica.antecedentes_farmacologicos,
+            HistoriaClinica.antecedentes_quirurgicos, HistoriaClinica.antecedentes_toxicos,
+            HistoriaClinica.antecedentes_alergicos, HistoriaClinica.antecedentes_ginecobstetricos,
+        ]
+        fecha = HistoriaClinica.fecha_registro
+        consulta = session.query(
+            HistoriaClinica.id, HistoriaClinica.id, HistoriaClinica.paciente_id, fecha, *columnas
+        )
+    elif fuente == 'enfermeria':
+        columnas = [RegistroEnfermeria.texto_nota]
+        fecha = RegistroEnfermeria.fecha_registro
+        consulta = session.query(
+            RegistroEnfermeria.id, RegistroEnfermeria.historia_clinica_id,
+            RegistroEnfermeria.paciente_id, fecha, *columnas
+        )
+    else:
+        columnas = [LabResultado.interpretacion]
+        fecha = db.func.coalesce(LabSolicitud.fecha_resultado, LabSolicitud.fecha_solicitud)
+        consulta = (
+            session.query(LabResultado.id, LabSolicitud.historia_id,
+                          HistoriaClinica.paciente_id, fecha, *columnas)
+            .join(LabSolicitud, LabSolicitud.id == LabResultado.solicitud_id)
+            .join(HistoriaClinica, HistoriaClinica.id == LabSolicitud.historia_id)
+        )
+
+    for palabra in palabras:
+        consulta = consulta.filter(or_(*[c.ilike(f'%{palabra}%') for c in columnas]))
+    if desde:
+        consulta = consulta.filter(fecha >= desde)
+    if hasta:
+        consulta = consulta.filter(fecha < hasta)
+
+    resultados = []
+    for fila in consulta.order_by(fecha.desc()).limit(limite):
+        textos = [t for t in fila[4:] if t]
+        coincide = next((t for t in textos if palabras[0] in normalizar_texto(t)), textos[0] if textos else '')
+        resultados.append({
+            'fuente': fuente,
+            'registro_id': fila[0],
+            'historia_id': fila[1],
+            'paciente_id': fila[2],
+            'fecha': str(fila[3])[:16] if fila[3] else None,
+            'rank': 0.0,
+            'fragmento': _fragmento_generico(coincide, palabras),
+        })
+    return resultados
+
+
+def buscar_en_notas(termino, desde=None, hasta=None, fuentes=FUENTES,
+                    limite_por_fuente=200, max_por_paciente=5, session=None):
+    """Coincidencias agrupadas por paciente, del más relevante al menos relevante.
+
+    ``desde``/``hasta`` (datetime) filtran por la fecha del registro;
+    ``hasta`` es exclusivo. ``fuentes`` limita las fuentes consultadas.
+    """
+    session = session or db.session
+    inicio = time.perf_counter()
+    fuentes = [f for f in FUENTES if f in fuentes]
+
+    filas = []
+    expresion = expresion_fts(termino)
+    if expresion:
+        usar_fts = session.get_bind().dialect.name == 'sqlite' and _hay_indices_fts(session)
+        palabras = tokens(termino)
+        for fuente in fuentes:
+            if usar_fts:
+                filas.extend(_buscar_fts(session, fuente, expresion, desde, hasta, limite_por_fuente))
+            else:
+                filas.extend(_buscar_generico(session, fuente, palabras, desde, hasta, limite_por_fuente))
+
+    # bm25 devuelve valores negativos: menor es más relevante
+    filas.sort(key=lambda f: f['rank'])
+
+    grupos = OrderedDict()
+    for fila in filas:
+        grupo = grupos.setdefault(fila['paciente_id'], [])
+        if len(grupo) < max_por_paciente:
+            grupo.append(fila)
+
+    pacientes = {
+        p.id: p for p in
+        session.query(Paciente.id, Paciente.nombre, Paciente.numero)
+        .filter(Paciente.id.in_(list(grupos)))
+    } if grupos else {}
+
+    return {
+        'consulta': termino,
+        'fuentes': fuentes,
+        'total_coincidencias': len(filas),
+        'pacientes': [
+            {
+                'paciente_id': pid,
+                'nombre': pacientes[pid].nombre if pid in pacientes else None,
+                'numero': pacientes[pid].numero if pid in pacientes else None,
+                'coincidencias': [{k: v for k, v in f.items() if k != 'paciente_id'} for f in grupo],
+            }
+            for pid, grupo in grupos.items()
+        ],
+        'tiempo_ms': round((time.perf_counter() - inicio) * 1000, 2),
+    }
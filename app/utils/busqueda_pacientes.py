@@ -0,0 +1,189 @@
+"""Búsqueda de pacientes por nombre o número, sin distinguir tildes ni mayúsculas.
+
+Todas las pantallas que buscan pacientes usan ``buscar_pacientes``. La
+búsqueda trabaja sobre ``Paciente.nombre_normalizado`` y ordena así:
+
+0. el nombre o el número empiezan por el término (índice btree, por rango)
+1. cada palabra del término es inicio de una palabra del nombre
+2. el término aparece en cualquier parte (FTS5 trigram en SQLite, pg_trgm en PostgreSQL)
+
+Los candidatos por subcadena se ordenan por (1) antes del tope de
+``CANDIDATOS_SUBCADENA``. ``condicion_busqueda`` da los mismos aciertos
+como condición SQL, para filtrar otras consultas sin tope.
+"""
+from sqlalchemy import exists, text, or_, and_, case, literal, literal_column, select, table, column, false, true
+
+from app.extensions import db
+from app.models import Paciente, HistoriaClinica
+from app.utils.texto import normalizar_texto, tokens
+
+# Máximo de candidatos por subcadena que se traen para ordenar en memoria
+CANDIDATOS_SUBCADENA = 200
+
+_TOPE_RANGO = '\U0010ffff'
+_tabla_fts_por_engine = {}
+_pacientes_fts = table('pacientes_fts', column('rowid'))
+
+
+def _hay_tabla_fts(session):
+    engine = session.get_bind()
+    if engine not in _tabla_fts_por_engine:
+        existe = session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pacientes_fts'"
+        )).first() is not None
+        _tabla_fts_por_engine[engine] = existe
+    return _tabla_fts_por_engine[engine]
+
+
+def _escapar_like(valor):
+    return valor.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _con_historia():
+    return exists().where(HistoriaClinica.paciente_id == Paciente.id)
+
+
+def _rango(columna, prefijo):
+    return and_(columna >= prefijo, columna < prefijo + _TOPE_RANGO)
+
+
+def _contiene(columna, valor):
+    return columna.like(f'%{_escapar_like(valor)}%', escape='\\')
+
+
+def _frase_fts(valor):
+    # Cada palabra como frase: el tokenizador trigram busca subcadenas
+    return '"' + valor.replace('"', '""') + '"'
+
+
+def _ids_fts(expresion):
+    return select(_pacientes_fts.c.rowid).where(literal_column('pacientes_fts').op('MATCH')(expresion))
+
+
+def _condicion_prefijo(normalizado, numero):
+    """Nombre o número que empiezan por el término.
+
+    ``pacientes.numero`` se guarda tal como se escribió y se compara con
+    mayúsculas: el rango se prueba con el término como vino, en mayúsculas
+    y en minúsculas ('a6' encuentra 'A600').
+    """
+    variantes = {v for v in (numero, numero.upper(), numero.lower()) if v}
+    return or_(
+        _rango(Paciente.nombre_normalizado, normalizado),
+        *(_rango(Paciente.numero, v) for v in variantes),
+    )
+
+
+def _condicion_subcadena(session, palabras, numero_buscado):
+    """Todas las palabras dentro del nombre, o el término dentro del número."""
+    if session.get_bind().dialect.name == 'sqlite':
+        largas = [t for t in palabras if len(t) >= 3]
+        if not largas:
+            # Con menos de 3 letras solo se busca por prefijo
+            return false()
+        if _hay_tabla_fts(session):
+            cortas = [t for t in palabras if len(t) < 3]
+            nombre = and_(
+                Paciente.id.in_(_ids_fts(
+                    'nombre_normalizado : (' + ' AND '.join(_frase_fts(t) for t in largas) + ')'
+                )),
+                *(_contiene(Paciente.nombre_normalizado, t) for t in cortas),
+            )
+            if len(numero_buscado) < 3:
+                return nombre
+            return or_(nombre, Paciente.id.in_(_ids_fts('numero : ' + _frase_fts(numero_buscado))))
+
+    return or_(
+        and_(*(_contiene(Paciente.nombre_normalizado, t) for t in palabras)),
+        Paciente.numero.ilike(f'%{_escapar_like(numero_buscado)}%', escape='\\'),
+    )
+
+
+def condicion_busqueda(termino, session=None):
+    """Condición sobre ``Paciente`` con los mismos aciertos que ``buscar_pacientes``.
+
+    Sirve para filtrar otra consulta (p. ej. el listado) en SQL, sin el
+    tope de candidatos ni el orden por relevancia.
+    """
+    session = session or db.session
+    normalizado = normalizar_texto(termino)
+    if not normalizado:
+        return true()
+    numero = (termino or '').strip()
+    return or_(
+        _condicion_prefijo(normalizado, numero),
+        _condicion_subcadena(session, tokens(normalizado), numero.lower()),
+    )
+
+
+def _rank(nombre, numero, termino, numero_buscado, palabras):
+    nombre = nombre or ''
+    numero = (numero or '').lower()
+    if nombre.startswith(termino) or numero.startswith(numero_buscado):
+        return 0
+    palabras_nombre = nombre.split(' ')
+    if all(any(p.startswith(t) for p in palabras_nombre) for t in palabras):
+        return 1
+    return 2
+
+
+def _candidatos_prefijo(session, termino, numero, limite, solo_con_historia):
+    consulta = (
+        session.query(Paciente.id, Paciente.nombre_normalizado, Paciente.numero)
+        .filter(_condicion_prefijo(termino, numero))
+    )
+    if solo_con_historia:
+        consulta = consulta.filter(_con_historia())
+    return consulta.order_by(Paciente.nombre_normalizado).limit(limite).all()
+
+
+def _candidatos_subcadena(session, palabras, numero_buscado, solo_con_historia):
+    consulta = (
+        session.query(Paciente.id, Paciente.nombre_normalizado, Paciente.numero)
+        .filter(_condicion_subcadena(session, palabras, numero_buscado))
+    )
+    if solo_con_historia:
+        consulta = consulta.filter(_con_historia())
+    # Antes del tope, los que tienen cada palabra al inicio de una palabra del
+    # nombre (rank 1): con un término común no deben quedar fuera de los 200
+    inicio_de_palabra = and_(*(
+        literal(' ').concat(Paciente.nombre_normalizado).like(f'% {_escapar_like(t)}%', escape='\\')
+        for t in palabras
+    ))
+    return (
+        consulta.order_by(case((inicio_de_palabra, 0), else_=1), Paciente.nombre_normalizado)
+        .limit(CANDIDATOS_SUBCADENA).all()
+    )
+
+
+def buscar_pacientes(termino, limite=10, solo_con_historia=False, session=None):
+    """Devuelve hasta ``limite`` objetos Paciente ordenados por relevancia.
+
+    ``solo_con_historia`` deja solo pacientes con al menos una historia clínica.
+    """
+    session = session or db.session
+    normalizado = normalizar_texto(termino)
+    if not normalizado:
+        return []
+
+    palabras = tokens(normalizado)
+    numero = (termino or '').strip()
+    numero_buscado = numero.lower()
+
+    candidatos = {}
+    for fila in _candidatos_prefijo(session, normalizado, numero, limite, solo_con_historia):
+        candidatos[fila.id] = (0, fila.nombre_normalizado or '')
+
+    if len(candidatos) < limite:
+        for fila in _candidatos_subcadena(session, palabras, numero_buscado, solo_con_historia):
+            if fila.id in candidatos:
+                continue
+            rank = _rank(fila.nombre_normalizado, fila.numero, normalizado, numero_buscado, palabras)
+            candidatos[fila.id] = (rank, fila.nombre_normalizado or '')
+
+    orden = sorted(candidatos, key=lambda pid: candidatos[pid])[:limite]
+    if not orden:
+        return []
+
+    por_id = {p.id: p for p in session.query(Paciente).filter(Paciente.id.in_(orden))}
+    return [por_id[pid] for pid in orden if pid in por_id]
@@ -0,0 +1,163 @@
+"""Caché en memoria de los catálogos casi estáticos, compartida por los blueprints.
+
+Cada catálogo se guarda como una foto inmutable (``Snapshot``) con sus
+filas y diccionarios por id y por código. Antes de devolverla se compara su
+versión con ``catalogo_versiones`` (lectura barata, ver
+app/utils/versiones_catalogo.py); solo si cambió se vuelve a cargar. Las
+rutas de param e inventario suben la versión al modificar un catálogo.
+
+Las filas son tuplas con nombre, no objetos ORM: se pueden leer desde
+cualquier petición o hilo, pero no sirven para modificar la base. Los
+campos que cambian con la operación diaria (stock) no se incluyen.
+"""
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from app.extensions import db
+from app.metricas import registrar_metrica
+from app.models import (
+    Medicamento, InsumoMedico, DiagnosticoCIE10,
+    CatLaboratorioExamen, CatLaboratorioParametro,
+)
+from app.utils.versiones_catalogo import version_catalogo
+
+_Definicion = namedtuple('_Definicion', 'version modelo campos clave agrupar_por')
+
+# nombre -> (clave en catalogo_versiones, modelo, campos, campo clave, campo para agrupar)
+DEFINICIONES = {
+    'medicamentos': _Definicion(
+        'medicamentos', Medicamento,
+        ('id', 'codigo', 'nombre', 'forma_farmaceutica', 'presentacion', 'unidad_inventario'),
+        'codigo', None,
+    ),
+    'insumos': _Definicion(
+        'insumos', InsumoMedico,
+        ('id', 'codigo', 'nombre', 'unidad', 'activo'),
+        'codigo', None,
+    ),
+    'cie10': _Definicion(
+        'cie10', DiagnosticoCIE10,
+        ('id', 'codigo', 'nombre', 'descripcion', 'habilitado'),
+        'codigo', None,
+    ),
+    # los exámenes no tienen código: la carga masiva los identifica por nombre
+    'lab_examenes': _Definicion(
+        'laboratorio', CatLaboratorioExamen,
+        ('id', 'nombre', 'grupo', 'activo'),
+        'nombre', None,
+    ),
+    'lab_parametros': _Definicion(
+        'laboratorio', CatLaboratorioParametro,
+        ('id', 'examen_id', 'nombre', 'unidad', 'valor_ref_min', 'valor_ref_max'),
+        None, 'examen_id',
+    ),
+}
+
+_TIPOS = {
+    nombre: namedtuple(definicion.modelo.__name__ + 'Cache', definicion.campos)
+    for nombre, definicion in DEFINICIONES.items()
+}
+
+_VACIO = MappingProxyType({})
+
+
+class Snapshot:
+    """Foto inmutable de un catálogo en una versión dada."""
+
+    __slots__ = ('nombre', 'version', 'items', 'por_id', 'por_codigo', 'por_grupo')
+
+    def __init__(self, nombre, version, items):
+        definicion = DEFINICIONES[nombre]
+        self.nombre = nombre
+        self.version = version
+        self.items = tuple(items)
+        self.por_id = MappingProxyType({i.id: i for i in self.items})
+        self.por_codigo = (
+            MappingProxyType({getattr(i, definicion.clave): i for i in self.items})
+            if definicion.clave else _VACIO
+        )
+        grupos = {}
+        if definicion.agrupar_por:
+            for item in self.items:
+                grupos.setdefault(getattr(item, definicion.agrupar_por), []).append(item)
+        self.por_grupo = MappingProxyType({k: tuple(v) for k, v in grupos.items()})
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, item_id):
+        return self.por_id.get(item_id)
+
+    def por_clave(self, codigo):
+        return self.por_codigo.get(codigo)
+
+    def grupo(self, valor):
+        return self.por_grupo.get(valor, ())
+
+
+class _MetricasCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.aciertos = {}
+        self.fallos = {}
+        self.carga_ms = {}
+
+    def contar(self, nombre, acierto):
+        with self._lock:
+            destino = self.aciertos if acierto else self.fallos
+            destino[nombre] = destino.get(nombre, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                nombre: {
+                    'version': _snapshots[nombre].version if nombre in _snapshots else None,
+                    'filas': len(_snapshots[nombre]) if nombre in _snapshots else 0,
+                    'aciertos': self.aciertos.get(nombre, 0),
+                    'fallos': self.fallos.get(nombre, 0),
+                    'ultima_carga_ms': round(self.carga_ms.get(nombre, 0.0), 2),
+                }
+                for nombre in DEFINICIONES
+            }
+
+
+_snapshots = {}
+_lock = threading.Lock()
+metricas_cache = _MetricasCache()
+registrar_metrica('cache_catalogos', metricas_cache.snapshot)
+
+
+def _cargar(nombre, version):
+    definicion = DEFINICIONES[nombre]
+    tipo = _TIPOS[nombre]
+    modelo = definicion.modelo
+    inicio = time.perf_counter()
+    filas = (
+        db.session.query(*[getattr(modelo, campo) for campo in definicion.campos])
+        .order_by(modelo.id)
+        .all()
+    )
+    snapshot = Snapshot(nombre, version, (tipo(*fila) for fila in filas))
+    metricas_cache.carga_ms[nombre] = (time.perf_counter() - inicio) * 1000
+    return snapshot
+
+
+def catalogo(nombre):
+    """Snapshot vigente del catálogo ``nombre`` (ver DEFINICIONES)."""
+    version = version_catalogo(DEFINICIONES[nombre].version)
+    snapshot = _snapshots.get(nombre)
+    if snapshot is not None and snapshot.version == version:
+        metricas_cache.contar(nombre, True)
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshots.get(nombre)
+        if snapshot is None or snapshot.version != version:
+            metricas_cache.contar(nombre, False)
+            snapshot = _cargar(nombre, version)
+            _snapshots[nombre] = snapshot
+        else:
+            metricas_cache.contar(nombre, True)
+        return snapshot
@@ -0,0 +1,288 @@
+"""Caché en disco de los PDF de la historia clínica.
+
+Renderizar con WeasyPrint toma segundos de CPU en estancias largas y la
+misma historia se imprime varias veces desde distintos servicios. Cada PDF
+se guarda en PDF_CACHE_DIR con el nombre ``<tipo>-<historia_id>-<huella>.pdf``;
+la huella resume todo lo que cambia el documento:
+
+- ``historias_clinicas.version_contenido`` (ver app/utils/versiones_historia.py)
+- las versiones de los catálogos cuyos nombres se imprimen
+- la fecha de modificación de la plantilla y de sus hojas ``static/css/pdf_*.css``
+
+Un cambio en cualquiera de ellos da una huella nueva, así que no hace falta
+coordinar procesos. Además, al confirmar un cambio se borran los archivos
+de esa historia para liberar espacio de inmediato. Cuando el directorio
+pasa de PDF_CACHE_MAX_MB se borran los menos usados (LRU por atime, que se
+marca a mano en cada acierto).
+
+La huella es también el ETag de la respuesta: si el navegador ya la tiene
+se contesta 304 sin leer el archivo ni renderizar.
+
+Los documentos que no son de una historia (el folio de enfermería, ver
+app/utils/folio_enfermeria.py) usan una clave propia en lugar del id, con
+prefijo para no chocar con los ids de historia, y su propia versión.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, request, send_file, abort, has_app_context
+
+from app.metricas import registrar_metrica
+from app.utils.versiones_catalogo import version_catalogo
+from app.utils.versiones_historia import version_historia, suscribir
+
+_SUFIJO = '.pdf'
+
+
+class _MetricasPDF:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.no_modificados = 0
+        self.render_ms_total = 0.0
+        self.render_ms_max = 0.0
+        self.invalidados = 0
+        self.desalojados = 0
+        self.bytes_en_disco = 0
+
+    def sumar(self, campo, cantidad=1):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + cantidad)
+
+    def render(self, ms):
+        with self._lock:
+            self.fallos += 1
+            self.render_ms_total += ms
+            self.render_ms_max = max(self.render_ms_max, ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'no_modificados': self.no_modificados,
+                'render_promedio_ms': round(self.render_ms_total / self.fallos, 2) if self.fallos else 0.0,
+                'render_max_ms': round(self.render_ms_max, 2),
+                'invalidados': self.invalidados,
+                'desalojados': self.desalojados,
+                'mb_en_disco': round(self.bytes_en_disco / 1048576, 2),
+            }
+
+
+metricas_pdf = _MetricasPDF()
+registrar_metrica('cache_pdf', metricas_pdf.snapshot)
+
+# (tipo, historia_id) -> lock, para que dos peticiones simultáneas no rendericen lo mismo
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def directorio_cache():
+    directorio = current_app.config.get('PDF_CACHE_DIR') or os.path.join(
+        current_app.instance_path, 'cache_pdf'
+    )
+    os.makedirs(directorio, exist_ok=True)
+    return directorio
+
+
+def limite_bytes():
+    return current_app.config.get('PDF_CACHE_MAX_MB', 512) * 1048576
+
+
+def _lock_de(clave):
+    with _locks_lock:
+        return _locks.setdefault(clave, threading.Lock())
+
+
+def huella_contenido(clave, version, plantilla, catalogos=(), estilos=()):
+    """Huella de un documento con ``version`` impreso con ``plantilla`` y las hojas ``estilos``."""
+    ruta_plantilla = os.path.join(current_app.root_path, 'templates', plantilla)
+    dir_css = os.path.join(current_app.static_folder, 'css')
+    partes = [
+        str(clave), str(version), plantilla,
+        str(int(os.path.getmtime(ruta_plantilla))),
+    ] + [
+        f'{hoja}:{os.path.getmtime(os.path.join(dir_css, hoja))}' for hoja in estilos
+    ] + [f'{nombre}:{version_catalogo(nombre)}' for nombre in catalogos]
+    return hashlib.sha1('|'.join(partes).encode()).hexdigest()[:20]
+
+
+def huella_pdf(historia_id, plantilla, catalogos=(), estilos=()):
+    """Huella del PDF de la historia, o None si la historia no existe."""
+    version = version_historia(historia_id)
+    if version is None:
+        return None
+    return huella_contenido(historia_id, version, plantilla, catalogos, estilos)
+
+
+def _escribir(ruta, escribir):
+    """Escritura atómica: ``escribir(temporal)`` llena un temporal del mismo
+    directorio que luego se renombra; otro proceso nunca ve un PDF a medias."""
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix='.tmp')
+    os.close(descriptor)
+    try:
+        escribir(temporal)
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def _escribir_bytes(contenido):
+    def escribir(temporal):
+        with open(temporal, 'wb') as archivo:
+            archivo.write(contenido)
+    return escribir
+
+
+def _desalojar(directorio, max_bytes):
+    """Borra los PDF menos usados hasta quedar por debajo del 90 % del límite."""
+    archivos = []
+    total = 0
+    for entrada in os.scandir(directorio):
+        if entrada.is_file() and entrada.name.endswith(_SUFIJO):
+            info = entrada.stat()
+            archivos.append((info.st_atime, info.st_size, entrada.path))
+            total += info.st_size
+
+    if total > max_bytes:
+        objetivo = max_bytes * 0.9
+        for _, tamano, ruta in sorted(archivos):
+            if total <= objetivo:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                continue
+            total -= tamano
+            metricas_pdf.sumar('desalojados')
+    metricas_pdf.bytes_en_disco = total
+
+
+def _borrar_de_historia(directorio, historia_id, tipo=None, excepto=None):
+    """Borra los PDF guardados de una historia (de un tipo o de todos)."""
+    borrados = 0
+    marca = f'-{historia_id}-'
+    for entrada in os.scandir(directorio):
+        nombre = entrada.name
+        if not nombre.endswith(_SUFIJO) or marca not in nombre or entrada.path == excepto:
+            continue
+        if tipo is not None and not nombre.startswith(f'{tipo}-'):
+            continue
+        try:
+            os.remove(entrada.path)
+            borrados += 1
+        except FileNotFoundError:
+            pass
+    return borrados
+
+
+def _ruta(directorio, tipo, historia_id, huella):
+    return os.path.join(directorio, f'{tipo}-{historia_id}-{huella}{_SUFIJO}')
+
+
+def buscar_pdf(tipo, historia_id, huella):
+    """Ruta del PDF guardado para esta huella, o None si no está."""
+    ruta = _ruta(directorio_cache(), tipo, historia_id, huella)
+    try:
+        info = os.stat(ruta)
+    except FileNotFoundError:
+        return None
+    # atime explícito: el desalojo no depende de cómo esté montado el disco
+    os.utime(ruta, (time.time(), info.st_mtime))
+    metricas_pdf.sumar('aciertos')
+    return ruta
+
+
+def guardar_pdf(tipo, historia_id, huella, contenido, directorio=None, max_bytes=None):
+    """Guarda el PDF, reemplaza las versiones viejas y aplica el límite de tamaño.
+
+    ``contenido`` son los bytes del PDF o una función que lo escribe en la
+    ruta que recibe (documentos grandes que no deben pasar por memoria).
+    ``directorio`` y ``max_bytes`` se pasan cuando se llama sin contexto de
+    aplicación (al terminar un trabajo del pool, ver app/utils/render_pdf.py).
+    """
+    if directorio is None:
+        directorio = directorio_cache()
+    if max_bytes is None:
+        max_bytes = limite_bytes()
+    ruta = _ruta(directorio, tipo, historia_id, huella)
+    _escribir(ruta, contenido if callable(contenido) else _escribir_bytes(contenido))
+    _borrar_de_historia(directorio, historia_id, tipo=tipo, excepto=ruta)
+    _desalojar(directorio, max_bytes)
+    return ruta
+
+
+def obtener_pdf(tipo, historia_id, huella, generar=None, escribir=None):
+    """Ruta del PDF en disco; si no existe lo genera con ``generar()`` (bytes)
+    o con ``escribir(ruta)``, que lo escribe directo en el archivo."""
+    with _lock_de((tipo, historia_id)):
+        ruta = buscar_pdf(tipo, historia_id, huella)
+        if ruta is not None:
+            return ruta
+
+        inicio = time.perf_counter()
+        if escribir is None:
+            escribir = _escribir_bytes(generar())
+        ruta = guardar_pdf(tipo, historia_id, huella, escribir)
+        metricas_pdf.render((time.perf_counter() - inicio) * 1000)
+        return ruta
+
+
+def respuesta_pdf(tipo, historia_id, plantilla, generar, nombre_descarga, catalogos=(), estilos=()):
+    """Respuesta con el PDF de la caché (o recién generado), con ETag y 304."""
+    huella = huella_pdf(historia_id, plantilla, catalogos, estilos)
+    if huella is None:
+        abort(404)
+    return responder_pdf(tipo, historia_id, huella, generar, nombre_descarga)
+
+
+def responder_pdf(tipo, clave, huella, generar, nombre_descarga, escribir=None):
+    """Como ``respuesta_pdf`` pero con la huella ya calculada (y ``escribir`` como en ``obtener_pdf``)."""
+    # El navegador ya tiene esta versión: ni siquiera hace falta el archivo
+    if request.if_none_match.contains(huella):
+        metricas_pdf.sumar('no_modificados')
+        respuesta = current_app.response_class(status=304)
+        respuesta.set_etag(huella)
+        respuesta.cache_control.private = True
+        respuesta.cache_control.no_cache = True
+        return respuesta
+
+    return enviar_pdf(obtener_pdf(tipo, clave, huella, generar, escribir), huella, nombre_descarga)
+
+
+def enviar_pdf(ruta, huella, nombre_descarga):
+    """``send_file`` del PDF guardado, con la huella como ETag (revalida siempre)."""
+    respuesta = send_file(
+        ruta,
+        mimetype='application/pdf',
+        download_name=nombre_descarga,
+        conditional=True,
+        etag=huella,
+        max_age=0,
+    )
+    respuesta.headers['Content-Disposition'] = f'inline; filename={nombre_descarga}'
+    respuesta.cache_control.private = True
+    return respuesta
+
+
+def borrar_pdf(tipo, clave):
+    """Borra los PDF guardados de ``clave`` (p. ej. el folio de un paciente purgado)."""
+    borrados = _borrar_de_historia(directorio_cache(), clave, tipo=tipo)
+    metricas_pdf.sumar('invalidados', borrados)
+    return borrados
+
+
+@suscribir
+def invalidar(historia_ids):
+    """Borra los PDF guardados de ``historia_ids`` (se llama al confirmar un cambio)."""
+    if not has_app_context():
+        return
+    directorio = directorio_cache()
+    for historia_id in historia_ids:
+        metricas_pdf.sumar('invalidados', _borrar_de_historia(directorio, historia_id))
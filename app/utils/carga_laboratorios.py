@@ -0,0 +1,274 @@
+"""Carga masiva de resultados de laboratorio (exportes de analizadores).
+
+Un exporte trae una fila por parámetro:
+
+    NUMERO_PACIENTE, EXAMEN, PARAMETRO, VALOR, FECHA_RESULTADO, LABORATORIO
+
+En lugar de buscar paciente, historia, examen, parámetro y solicitud fila
+por fila, aquí se resuelve todo por conjuntos:
+
+- pacientes por número y la historia más reciente de cada uno
+  (``row_number()`` por paciente) en una consulta por cada 900 números
+- exámenes y parámetros desde la caché de catálogos (app/utils/cache_catalogos.py)
+- las filas se agrupan en pandas por (historia, laboratorio, día) y cada
+  grupo es una solicitud: se reutiliza la que ya exista ese día o se crea
+- ``valor_num`` y la bandera de fuera de rango se calculan con NumPy para
+  todo el archivo (app/utils/rangos_laboratorio.py)
+- solicitudes y resultados se insertan en bloque (``insert()`` con
+  executemany), sin objetos ORM; los resultados con ``guardar_resultados``,
+  un upsert sobre (solicitud, parámetro): volver a cargar un archivo
+  actualiza los valores en vez de duplicarlos
+
+Las inserciones en bloque no pasan por los eventos de sesión: al final se
+marcan las historias tocadas (``marcar_historias``) para invalidar sus PDF.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, insert, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.extensions import db
+from app.models import Paciente, HistoriaClinica, LabSolicitud, LabResultado
+from app.utils.cache_catalogos import catalogo
+from app.utils.fechas import ahora_bogota
+from app.utils.rangos_laboratorio import valores_numericos, fuera_de_rango
+from app.utils.versiones_historia import marcar_historias
+
+COLUMNAS = ('NUMERO_PACIENTE', 'EXAMEN', 'PARAMETRO', 'VALOR', 'FECHA_RESULTADO', 'LABORATORIO')
+
+# Tamaño de las listas IN (SQLite acepta pocos parámetros por sentencia)
+_LOTE_IN = 900
+# Filas de resultado por executemany
+_LOTE_INSERT = 5000
+
+ResumenCarga = namedtuple('ResumenCarga', 'creados solicitudes errores solicitud_ids')
+
+_INSERT_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+# Columnas que el upsert reemplaza cuando el resultado ya existe
+ACTUALIZABLES = ('valor', 'valor_num')
+
+
+def _por_lotes(valores, tamano):
+    valores = list(valores)
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def guardar_resultados(filas, actualizar=ACTUALIZABLES, session=None):
+    """Inserta o actualiza resultados con ``INSERT ... ON CONFLICT`` (executemany).
+
+    ``filas`` son dicts con las columnas de ``lab_resultado``; si ya hay
+    resultado para (solicitud_id, parametro_id) solo cambian ``actualizar``.
+    No dispara los eventos del ORM: quien llama marca historias y banderas.
+    """
+    session = session or db.session
+    if not filas:
+        return 0
+    dialecto = session.get_bind().dialect.name
+    if dialecto not in _INSERT_UPSERT:
+        raise RuntimeError(f'Upsert de resultados no soportado en {dialecto}')
+    sentencia = _INSERT_UPSERT[dialecto](LabResultado.__table__)
+    sentencia = sentencia.on_conflict_do_update(
+        index_elements=['solicitud_id', 'parametro_id'],
+        set_={columna: sentencia.excluded[columna] for columna in actualizar},
+    )
+    for inicio in range(0, len(filas), _LOTE_INSERT):
+        session.execute(sentencia, filas[inicio:inicio + _LOTE_INSERT])
+    return len(filas)
+
+
+def _texto(serie):
+    return serie.where(serie.notna(), '').astype(str).str.strip()
+
+
+def _pacientes_por_numero(numeros, session):
+    ids = {}
+    for lote in _por_lotes(numeros, _LOTE_IN):
+        ids.update(session.execute(
+            select(Paciente.numero, Paciente.id).where(Paciente.numero.in_(lote))
+        ).all())
+    return ids
+
+
+def consulta_ultima_historia(paciente_ids):
+    """(paciente_id, id de su historia más reciente) de ``paciente_ids``."""
+    ultima = (
+        select(
+            HistoriaClinica.paciente_id,
+            HistoriaClinica.id,
+            func.row_number().over(
+                partition_by=HistoriaClinica.paciente_id,
+                order_by=(HistoriaClinica.fecha_registro.desc(), HistoriaClinica.id.desc()),
+            ).label('orden'),
+        )
+        .where(HistoriaClinica.paciente_id.in_(paciente_ids))
+        .subquery()
+    )
+    return select(ultima.c.paciente_id, ultima.c.id).where(ultima.c.orden == 1)
+
+
+def consulta_solicitudes_dia(historia_ids, desde, hasta):
+    """Solicitudes de ``historia_ids`` entre ``desde`` y ``hasta`` (sin incluir)."""
+    return (
+        select(LabSolicitud.id, LabSolicitud.historia_id, LabSolicitud.laboratorio_nombre,
+               LabSolicitud.fecha_solicitud)
+        .where(
+            LabSolicitud.historia_id.in_(historia_ids),
+            LabSolicitud.fecha_solicitud >= desde,
+            LabSolicitud.fecha_solicitud < hasta,
+        )
+        .order_by(LabSolicitud.id)
+    )
+
+
+def _ultima_historia(paciente_ids, session):
+    """paciente_id -> id de su historia más reciente."""
+    historias = {}
+    for lote in _por_lotes(paciente_ids, _LOTE_IN):
+        historias.update(session.execute(consulta_ultima_historia(lote)).all())
+    return historias
+
+
+def _solicitudes_existentes(grupos, session):
+    """(historia_id, laboratorio, día) -> id de la primera solicitud de ese día."""
+    con_dia = grupos[grupos['dia'].notna()]
+    if con_dia.empty:
+        return {}
+    desde = con_dia['dia'].min().to_pydatetime()
+    hasta = con_dia['dia'].max().to_pydatetime() + timedelta(days=1)
+    existentes = {}
+    for lote in _por_lotes(con_dia['historia_id'].unique().tolist(), _LOTE_IN):
+        for s in session.execute(consulta_solicitudes_dia(lote, desde, hasta)):
+            clave = (s.historia_id, s.laboratorio_nombre, s.fecha_solicitud.date())
+            existentes.setdefault(clave, s.id)
+    return existentes
+
+
+def _parsear_fechas(crudo):
+    """Fechas del exporte: dd/mm/aaaa, ISO (celdas de fecha de Excel) o lo que se reconozca."""
+    fechas = pd.to_datetime(crudo, format='%d/%m/%Y', errors='coerce')
+    for formato, dia_primero in (('ISO8601', False), ('mixed', True)):
+        pendientes = fechas.isna() & (crudo != '')
+        if not pendientes.any():
+            break
+        fechas[pendientes] = pd.to_datetime(
+            crudo[pendientes], format=formato, dayfirst=dia_primero, errors='coerce'
+        )
+    return fechas
+
+
+def cargar_resultados(df, primera_fila=2, session=None, filas=None):
+    """Inserta los resultados de ``df`` en la transacción en curso.
+
+    ``df`` trae las columnas de ``COLUMNAS``; ``primera_fila`` es el número
+    de línea de la primera fila en el archivo (para los mensajes de error).
+    Si se quitaron filas de ``df``, ``filas`` trae el número de línea de
+    cada una en su lugar. Quien llama confirma o deshace. Devuelve un
+    ``ResumenCarga``.
+    """
+    session = session or db.session
+    datos = pd.DataFrame({
+        'fila': np.arange(len(df)) + primera_fila if filas is None else np.asarray(filas),
+        'numero': _texto(df['NUMERO_PACIENTE']),
+        'examen': _texto(df['EXAMEN']),
+        'parametro': _texto(df['PARAMETRO']),
+        'valor': _texto(df['VALOR']),
+        'laboratorio': _texto(df['LABORATORIO']),
+        'fecha_texto': _texto(df['FECHA_RESULTADO']),
+    })
+    datos['fecha'] = _parsear_fechas(datos['fecha_texto'])
+
+    pacientes = _pacientes_por_numero(datos['numero'].unique().tolist(), session)
+    datos['paciente_id'] = datos['numero'].map(pacientes)
+    historias = _ultima_historia(
+        datos['paciente_id'].dropna().astype('int64').unique().tolist(), session
+    )
+    datos['historia_id'] = datos['paciente_id'].map(historias)
+
+    examenes = catalogo('lab_examenes')
+    datos['examen_id'] = datos['examen'].map({e.nombre: e.id for e in examenes.items})
+    parametros = pd.DataFrame(
+        [(p.examen_id, p.nombre, p.id, p.unidad, p.valor_ref_min, p.valor_ref_max)
+         for p in catalogo('lab_parametros').items],
+        columns=['examen_id', 'parametro', 'parametro_id', 'unidad', 'ref_min', 'ref_max'],
+    ).drop_duplicates(['examen_id', 'parametro'])
+    datos = datos.merge(parametros, how='left', on=['examen_id', 'parametro'])
+
+    # El primer problema de cada fila, en el orden en que se revisaba antes
+    problemas = [
+        (datos['fecha'].isna() & (datos['fecha_texto'] != ''), lambda f: 'Fecha inválida'),
+        ((datos['numero'] == '') | (datos['examen'] == '') | (datos['parametro'] == ''),
+         lambda f: 'Falta información obligatoria'),
+        (datos['paciente_id'].isna(), lambda f: f"Paciente {f.numero} no encontrado"),
+        (datos['historia_id'].isna(), lambda f: f"Paciente {f.numero} sin historia clínica"),
+        (datos['examen_id'].isna(), lambda f: f"Examen '{f.examen}' no encontrado"),
+        (datos['parametro_id'].isna(), lambda f: f"Parámetro '{f.parametro}' no encontrado"),
+    ]
+    codigo = np.select([m.to_numpy() for m, _ in problemas], np.arange(1, len(problemas) + 1), 0)
+    con_error = codigo != 0
+    errores = [
+        f"Fila {f.fila}: {problemas[c - 1][1](f)}"
+        for f, c in zip(datos[con_error].itertuples(index=False), codigo[con_error])
+    ]
+    validos = datos[~con_error].copy()
+    if validos.empty:
+        return ResumenCarga(0, 0, errores, [])
+
+    for columna in ('historia_id', 'examen_id', 'parametro_id'):
+        validos[columna] = validos[columna].astype('int64')
+    validos['dia'] = validos['fecha'].dt.normalize()
+    claves = ['historia_id', 'laboratorio', 'dia']
+    validos['grupo'] = validos.groupby(claves, dropna=False, sort=False).ngroup()
+    grupos = validos.groupby('grupo', sort=True).agg(
+        historia_id=('historia_id', 'first'), laboratorio=('laboratorio', 'first'),
+        dia=('dia', 'first'), fecha=('fecha', 'min'),
+    )
+
+    existentes = _solicitudes_existentes(grupos, session)
+    solicitud_por_grupo = np.zeros(len(grupos), dtype='int64')
+    nuevas, posiciones = [], []
+    ahora = ahora_bogota()
+    for posicion, g in enumerate(grupos.itertuples(index=False)):
+        hay_dia = not pd.isna(g.dia)
+        existente = existentes.get((g.historia_id, g.laboratorio, g.dia.date())) if hay_dia else None
+        if existente is not None:
+            solicitud_por_grupo[posicion] = existente
+            continue
+        nuevas.append({
+            'historia_id': int(g.historia_id),
+            'fecha_solicitud': g.fecha.to_pydatetime() if hay_dia else ahora,
+            'estado': 'completado',
+            'laboratorio_nombre': g.laboratorio,
+        })
+        posiciones.append(posicion)
+    if nuevas:
+        ids = session.execute(
+            insert(LabSolicitud).returning(LabSolicitud.id, sort_by_parameter_order=True), nuevas
+        ).scalars().all()
+        solicitud_por_grupo[posiciones] = ids
+
+    validos['solicitud_id'] = solicitud_por_grupo[validos['grupo'].to_numpy()]
+    validos['valor_num'] = valores_numericos(validos['valor'])
+    validos['flag_fuera_rango'] = fuera_de_rango(validos['valor_num'], validos['ref_min'], validos['ref_max'])
+    validos['valor_num'] = validos['valor_num'].astype(object).where(validos['valor_num'].notna(), None)
+    validos['valor'] = validos['valor'].where(validos['valor'] != '', None)
+    validos['unidad'] = validos['unidad'].astype(object).where(validos['unidad'].notna(), None)
+    # Un valor por (solicitud, parámetro): si el archivo lo repite, vale la última fila
+    validos = validos.drop_duplicates(['solicitud_id', 'parametro_id'], keep='last')
+    columnas = ['solicitud_id', 'examen_id', 'parametro_id', 'valor', 'valor_num', 'unidad', 'flag_fuera_rango']
+    for inicio in range(0, len(validos), _LOTE_INSERT):
+        bloque = validos.iloc[inicio:inicio + _LOTE_INSERT][columnas]
+        guardar_resultados(
+            [dict(zip(columnas, fila)) for fila in bloque.itertuples(index=False, name=None)],
+            actualizar=('valor', 'valor_num', 'unidad', 'flag_fuera_rango'),
+            session=session,
+        )
+
+    marcar_historias(validos['historia_id'].unique().tolist(), session=session)
+    return ResumenCarga(
+        len(validos), len(nuevas), errores, sorted(set(solicitud_por_grupo.tolist())),
+    )
@@ -0,0 +1,234 @@
+"""Importación del catálogo de exámenes y parámetros de laboratorio desde CSV.
+
+El archivo trae una fila por parámetro, con el examen repetido (como
+LABORATORIOS.csv)::
+
+    param_id, examen_id, examen_nombre, examen_grupo, param_nombre, unidad, valor_ref_min, valor_ref_max
+
+Se lee con pandas y se compara en memoria con las dos tablas (una consulta
+por tabla); solo se escriben las diferencias, con sentencias en bloque y en
+una sola transacción:
+
+- exámenes y parámetros nuevos: ``insert()`` con executemany
+- cambiados: UPDATE por clave primaria en bloque (un examen inactivo que
+  vuelve en el archivo se reactiva)
+- exámenes que ya no vienen: se desactivan (``activo = False``); los
+  resultados viejos siguen apuntando a ellos
+- parámetros que ya no vienen: se borran si no tienen resultados; los que
+  sí tienen se conservan y se informan (la tabla no tiene ``activo``)
+
+Si hubo cambios se sube la versión del catálogo ``laboratorio`` para que
+las cachés (app/utils/cache_catalogos.py) se recarguen. Volver a importar
+el mismo archivo no escribe nada.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, insert, update, delete, func, text
+
+from app.extensions import db
+from app.models import CatLaboratorioExamen, CatLaboratorioParametro, LabResultado
+from app.utils.transacciones import iniciar_escritura
+from app.utils.versiones_catalogo import incrementar_version
+
+COLUMNAS = (
+    'param_id', 'examen_id', 'examen_nombre', 'examen_grupo', 'param_nombre', 'unidad',
+    'valor_ref_min', 'valor_ref_max',
+)
+
+CAMPOS_EXAMEN = ('nombre', 'grupo', 'activo')
+CAMPOS_PARAMETRO = ('examen_id', 'nombre', 'unidad', 'valor_ref_min', 'valor_ref_max')
+
+# Tamaño de las listas IN (SQLite acepta pocos parámetros por sentencia)
+_LOTE_IN = 900
+
+CambiosCatalogo = namedtuple(
+    'CambiosCatalogo',
+    'examenes_nuevos examenes_cambiados examenes_desactivados '
+    'parametros_nuevos parametros_cambiados parametros_borrados parametros_conservados '
+    'rangos_cambiados',
+)
+
+
+def _texto(serie):
+    """Texto sin espacios; vacío -> None."""
+    serie = serie.where(serie.notna(), '').astype(str).str.strip()
+    return serie.where(serie != '', None)
+
+
+def leer_csv(ruta):
+    """(exámenes, parámetros) del archivo como DataFrames indexados por id.
+
+    Lanza ``ValueError`` si faltan columnas, hay ids o números inválidos, o un
+    examen aparece con nombres o grupos distintos.
+    """
+    df = pd.read_csv(ruta, dtype=str, encoding='utf-8-sig')
+    df.columns = df.columns.str.strip()
+    faltantes = [c for c in COLUMNAS if c not in df.columns]
+    if faltantes:
+        raise ValueError(f'Columnas faltantes: {", ".join(faltantes)}')
+
+    datos = pd.DataFrame({
+        'param_id': pd.to_numeric(df['param_id'].str.strip(), errors='coerce'),
+        'examen_id': pd.to_numeric(df['examen_id'].str.strip(), errors='coerce'),
+        'examen_nombre': _texto(df['examen_nombre']),
+        'grupo': _texto(df['examen_grupo']),
+        'nombre': _texto(df['param_nombre']),
+        'unidad': _texto(df['unidad']),
+    })
+    for columna in ('valor_ref_min', 'valor_ref_max'):
+        crudo = _texto(df[columna])
+        datos[columna] = pd.to_numeric(crudo, errors='coerce')
+        invalidos = crudo.notna() & datos[columna].isna()
+        if invalidos.any():
+            raise ValueError(f'{columna} no numérico en las filas {_filas(invalidos)}')
+
+    invalidos = (
+        datos['param_id'].isna() | datos['examen_id'].isna()
+        | datos['examen_nombre'].isna() | datos['nombre'].isna()
+    )
+    if invalidos.any():
+        raise ValueError(f'Falta id o nombre en las filas {_filas(invalidos)}')
+    repetidos = datos['param_id'].duplicated(keep=False)
+    if repetidos.any():
+        raise ValueError(f'param_id repetido en las filas {_filas(repetidos)}')
+    datos[['param_id', 'examen_id']] = datos[['param_id', 'examen_id']].astype('int64')
+
+    examenes = datos[['examen_id', 'examen_nombre', 'grupo']].drop_duplicates()
+    ambiguos = examenes['examen_id'].duplicated(keep=False)
+    if ambiguos.any():
+        raise ValueError(
+            'Exámenes con nombre o grupo distinto entre filas: '
+            + ', '.join(map(str, sorted(examenes.loc[ambiguos, 'examen_id'].unique())))
+        )
+    examenes = examenes.rename(columns={'examen_id': 'id', 'examen_nombre': 'nombre'}).set_index('id')
+    examenes['activo'] = True
+
+    parametros = datos.rename(columns={'param_id': 'id'}).set_index('id')[list(CAMPOS_PARAMETRO)]
+    return examenes, parametros
+
+
+def _filas(mascara):
+    # Línea en el archivo: la 1 es el encabezado
+    lineas = (np.flatnonzero(mascara.to_numpy()) + 2).tolist()
+    return ', '.join(map(str, lineas[:10])) + (' ...' if len(lineas) > 10 else '')
+
+
+def _tabla(modelo, campos, session):
+    columnas = [modelo.id, *(getattr(modelo, c) for c in campos)]
+    filas = session.execute(select(*columnas)).all()
+    return pd.DataFrame(filas, columns=['id', *campos]).set_index('id')
+
+
+def _distintos(nuevo, actual, campos):
+    """Ids presentes en los dos cuyo valor cambió en alguno de ``campos``."""
+    comunes = nuevo.index.intersection(actual.index)
+    a, b = nuevo.loc[comunes, list(campos)], actual.loc[comunes, list(campos)]
+    cambia = pd.Series(False, index=comunes)
+    for campo in campos:
+        x, y = a[campo], b[campo]
+        # NULL == NULL cuenta como igual
+        iguales = (x == y) | (x.isna() & y.isna())
+        cambia |= ~iguales.astype(bool)
+    return comunes[cambia.to_numpy()]
+
+
+def _con_resultados(parametro_ids, session):
+    usados = set()
+    for inicio in range(0, len(parametro_ids), _LOTE_IN):
+        usados.update(session.execute(
+            select(LabResultado.parametro_id).distinct()
+            .where(LabResultado.parametro_id.in_(parametro_ids[inicio:inicio + _LOTE_IN]))
+        ).scalars())
+    return usados
+
+
+def _registros(df, campos):
+    """Dicts para executemany, con NaN -> None y enteros de Python."""
+    registros = []
+    for id_, *valores in df[list(campos)].itertuples(name=None):
+        fila = {'id': int(id_)}
+        for campo, valor in zip(campos, valores):
+            if valor is None or (isinstance(valor, float) and np.isnan(valor)):
+                valor = None
+            elif isinstance(valor, np.generic):
+                valor = valor.item()
+            fila[campo] = valor
+        registros.append(fila)
+    return registros
+
+
+def _ajustar_secuencia(modelo, session):
+    # Los ids vienen del archivo: en PostgreSQL la secuencia no avanza sola
+    if session.get_bind().dialect.name == 'postgresql':
+        tabla = modelo.__tablename__
+        session.execute(
+            text(f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), :maximo)"),
+            {'maximo': session.execute(select(func.max(modelo.id))).scalar() or 1},
+        )
+
+
+def importar_catalogo(examenes, parametros, session=None):
+    """Aplica las diferencias en la transacción en curso. No confirma.
+
+    Devuelve un ``CambiosCatalogo`` con los ids de cada tipo de cambio.
+    """
+    session = session or db.session
+    examenes_db = _tabla(CatLaboratorioExamen, CAMPOS_EXAMEN, session)
+    parametros_db = _tabla(CatLaboratorioParametro, CAMPOS_PARAMETRO, session)
+
+    examenes_nuevos = examenes.index.difference(examenes_db.index)
+    examenes_cambiados = _distintos(examenes, examenes_db, CAMPOS_EXAMEN)
+    sobrantes = examenes_db.index.difference(examenes.index)
+    examenes_desactivados = sobrantes[examenes_db.loc[sobrantes, 'activo'].astype(bool).to_numpy()]
+
+    parametros_nuevos = parametros.index.difference(parametros_db.index)
+    parametros_cambiados = _distintos(parametros, parametros_db, CAMPOS_PARAMETRO)
+    rangos_cambiados = _distintos(parametros, parametros_db, ('valor_ref_min', 'valor_ref_max'))
+    faltan = parametros_db.index.difference(parametros.index).tolist()
+    usados = _con_resultados(faltan, session) if faltan else set()
+    parametros_borrados = [i for i in faltan if i not in usados]
+    parametros_conservados = [i for i in faltan if i in usados]
+
+    cambios = CambiosCatalogo(
+        examenes_nuevos.tolist(), examenes_cambiados.tolist(), examenes_desactivados.tolist(),
+        parametros_nuevos.tolist(), parametros_cambiados.tolist(), parametros_borrados,
+        parametros_conservados, rangos_cambiados.tolist(),
+    )
+    if not any((cambios.examenes_nuevos, cambios.examenes_cambiados, cambios.examenes_desactivados,
+                cambios.parametros_nuevos, cambios.parametros_cambiados, cambios.parametros_borrados)):
+        return cambios
+
+    iniciar_escritura(session)
+    # Exámenes antes que parámetros (FK); los parámetros se borran antes de nada
+    for inicio in range(0, len(parametros_borrados), _LOTE_IN):
+        session.execute(
+            delete(CatLaboratorioParametro)
+            .where(CatLaboratorioParametro.id.in_(parametros_borrados[inicio:inicio + _LOTE_IN]))
+            .execution_options(synchronize_session=False)
+        )
+    if len(examenes_nuevos):
+        session.execute(insert(CatLaboratorioExamen), _registros(examenes.loc[examenes_nuevos], CAMPOS_EXAMEN))
+        _ajustar_secuencia(CatLaboratorioExamen, session)
+    if len(examenes_cambiados):
+        session.execute(update(CatLaboratorioExamen), _registros(examenes.loc[examenes_cambiados], CAMPOS_EXAMEN))
+    desactivar = cambios.examenes_desactivados
+    for inicio in range(0, len(desactivar), _LOTE_IN):
+        session.execute(
+            update(CatLaboratorioExamen)
+            .where(CatLaboratorioExamen.id.in_(desactivar[inicio:inicio + _LOTE_IN]))
+            .values(activo=False)
+            .execution_options(synchronize_session=False)
+        )
+    if len(parametros_nuevos):
+        session.execute(
+            insert(CatLaboratorioParametro), _registros(parametros.loc[parametros_nuevos], CAMPOS_PARAMETRO)
+        )
+        _ajustar_secuencia(CatLaboratorioParametro, session)
+    if len(parametros_cambiados):
+        session.execute(
+            update(CatLaboratorioParametro), _registros(parametros.loc[parametros_cambiados], CAMPOS_PARAMETRO)
+        )
+    incrementar_version('laboratorio', session=session)
+    return cambios
@@ -0,0 +1,90 @@
+"""Envío de los archivos del almacén por contenido (app/utils/almacen_archivos.py).
+
+El ETag es el SHA-256 del contenido (con el sufijo de la variante si es
+una miniatura): fuerte, igual en todos los workers y servidores, y
+conocido sin tocar el disco. Un ``If-None-Match`` que coincide se contesta
+304 antes de abrir nada.
+
+Con el backend local hay tres modos (ARCHIVOS_ENVIO):
+
+- ``app`` (por defecto): ``send_file`` de Werkzeug con ``conditional``:
+  ``Range`` da 206 con solo esos bytes (los visores de PDF del navegador
+  piden por partes y se puede reanudar una descarga), e ``If-Range``
+  valida contra el ETag
+- ``x-accel``: nginx. La app autoriza y responde sin cuerpo con
+  ``X-Accel-Redirect: ARCHIVOS_ACCEL_PREFIJO + ab/cd/<sha256>``; nginx
+  envía los bytes (y atiende Range) sin ocupar el worker. Por ejemplo::
+
+      location /_archivos_ayudas/ {
+          internal;
+          alias /ruta/a/instance/archivos_ayudas/;
+      }
+
+- ``x-sendfile``: Apache (mod_xsendfile) o lighttpd, con la ruta absoluta
+  en ``X-Sendfile``
+
+Un backend sin archivos locales (S3) redirige a una URL firmada que vence
+en ARCHIVOS_URL_FIRMADA_S segundos; el bucket atiende Range y ETag.
+"""
+from flask import current_app, request, redirect, send_file
+
+from app.utils.almacen_archivos import almacen, ruta_relativa
+
+def _cachear(respuesta, max_age):
+    # Datos de pacientes: solo la caché del navegador, nunca la de un proxy compartido
+    respuesta.cache_control.public = False
+    respuesta.cache_control.private = True
+    if max_age:
+        respuesta.cache_control.no_cache = None
+        respuesta.cache_control.max_age = max_age
+        respuesta.cache_control.immutable = True
+    else:
+        # Se puede guardar, pero se revalida (304 por ETag) cada vez
+        respuesta.cache_control.no_cache = True
+    return respuesta
+
+
+def _delegada(cabecera, valor, tipo_mime, nombre, descarga):
+    respuesta = current_app.response_class(mimetype=tipo_mime)
+    respuesta.headers[cabecera] = valor
+    if nombre:
+        respuesta.headers.set('Content-Disposition', 'attachment' if descarga else 'inline', filename=nombre)
+    return respuesta
+
+
+def enviar_contenido(clave, tipo_mime=None, nombre=None, sufijo='', max_age=None, descarga=False):
+    """Respuesta con el contenido ``clave`` (o su derivado ``sufijo``)."""
+    tipo_mime = tipo_mime or 'application/octet-stream'
+    etag = clave + sufijo
+    if request.if_none_match.contains_weak(etag):
+        respuesta = current_app.response_class(status=304)
+        respuesta.set_etag(etag)
+        return _cachear(respuesta, max_age)
+
+    destino = almacen()
+    ruta = destino.ruta_local(clave, sufijo)
+    if ruta is None:
+        firmar = getattr(destino, 'url_firmada', None)
+        if firmar is not None:
+            segundos = current_app.config.get('ARCHIVOS_URL_FIRMADA_S', 300)
+            return _cachear(redirect(firmar(clave, sufijo, tipo_mime, nombre, descarga, segundos)), None)
+        respuesta = send_file(
+            destino.abrir(clave, sufijo), mimetype=tipo_mime, download_name=nombre,
+            as_attachment=descarga, etag=etag, conditional=True,
+        )
+        return _cachear(respuesta, max_age)
+
+    modo = current_app.config.get('ARCHIVOS_ENVIO') or 'app'
+    if modo == 'x-accel':
+        prefijo = current_app.config.get('ARCHIVOS_ACCEL_PREFIJO') or '/_archivos_ayudas/'
+        interna = prefijo.rstrip('/') + '/' + ruta_relativa(clave, sufijo)
+        respuesta = _delegada('X-Accel-Redirect', interna, tipo_mime, nombre, descarga)
+    elif modo == 'x-sendfile':
+        respuesta = _delegada('X-Sendfile', ruta, tipo_mime, nombre, descarga)
+    else:
+        respuesta = send_file(
+            ruta, mimetype=tipo_mime, download_name=nombre, as_attachment=descarga,
+            etag=etag, conditional=True,
+        )
+    respuesta.set_etag(etag)
+    return _cachear(respuesta, max_age)
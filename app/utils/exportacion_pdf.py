@@ -0,0 +1,217 @@
+"""Exportación masiva de historias en PDF como un ZIP que se envía por partes.
+
+Auditoría y facturación piden, por ejemplo, todas las historias de un
+servicio en un mes. ``crear_exportacion`` guarda la lista de historias en un
+trabajo (ver app/utils/render_pdf.py) y ``generar_zip`` produce el ZIP:
+
+- hasta PDF_LOTE_PARALELO historias se renderizan a la vez en el pool de PDF;
+  las que la caché ya tiene se leen del disco sin renderizar
+- cada PDF se agrega al ZIP en cuanto termina y sus bytes se envían de una
+  vez, así en memoria solo están los PDF en vuelo, nunca el archivo completo
+- las entradas van sin comprimir (un PDF ya está comprimido) y con data
+  descriptor, que es lo que permite escribir el ZIP sin volver atrás
+
+Si la conexión se cae, el trabajo recuerda qué historias ya se entregaron
+y cuáles quedaron en la caché. Volver a pedir el mismo id reanuda sin
+repetir renders; con ``solo_pendientes`` el ZIP trae solo lo que faltó.
+"""
+import time
+import zipfile
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from functools import partial
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app.extensions import db
+from app.models import HistoriaClinica
+from app.utils.cache_pdf import (
+    huella_pdf, buscar_pdf, guardar_pdf, directorio_cache, limite_bytes, metricas_pdf,
+)
+from app.utils.indice_catalogo import normalizar_codigo
+from app.utils.render_pdf import (
+    ColaLlena, nuevo_trabajo, leer_trabajo, actualizar_trabajo, enviar,
+)
+
+
+class _SalidaZip:
+    """Destino de ``ZipFile`` sin ``seek``: acumula bytes hasta que se envían."""
+
+    def __init__(self):
+        self._partes = []
+        self._posicion = 0
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def seleccionar_historias(servicio=None, desde=None, hasta=None, cie10=None, session=None):
+    """Historias que cumplen los filtros, de la más antigua a la más reciente.
+
+    ``desde``/``hasta`` son fechas (``hasta`` incluido); ``cie10`` es un
+    prefijo de código (J18 incluye J180, J189...).
+    """
+    session = session or db.session
+    consulta = session.query(
+        HistoriaClinica.id, HistoriaClinica.servicio_hospitalario, HistoriaClinica.nombre_paciente,
+    )
+    if servicio:
+        consulta = consulta.filter(HistoriaClinica.servicio_hospitalario == servicio)
+    if desde:
+        consulta = consulta.filter(
+            HistoriaClinica.fecha_registro >= datetime.combine(desde, datetime.min.time())
+        )
+    if hasta:
+        consulta = consulta.filter(
+            HistoriaClinica.fecha_registro < datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+        )
+    if cie10:
+        consulta = consulta.filter(
+            db.func.upper(db.func.replace(HistoriaClinica.cie10_principal, '.', ''))
+            .like(normalizar_codigo(cie10) + '%')
+        )
+    return consulta.order_by(HistoriaClinica.fecha_registro, HistoriaClinica.id).all()
+
+
+def _nombre_entrada(historia_id, servicio, nombre_paciente):
+    carpeta = secure_filename(servicio or '') or 'sin_servicio'
+    nombre = secure_filename(nombre_paciente or '') or 'paciente'
+    return f'{carpeta}/{historia_id}_{nombre}.pdf'
+
+
+def crear_exportacion(filtros, historias, nombre_descarga):
+    """Registra el trabajo de exportación con la lista de historias a incluir."""
+    return nuevo_trabajo(
+        'lote',
+        endpoint_archivo='pacientes.descargar_exportacion',
+        filtros=filtros,
+        nombre_descarga=nombre_descarga,
+        historias=[
+            {'id': h.id, 'nombre': _nombre_entrada(h.id, h.servicio_hospitalario, h.nombre_paciente)}
+            for h in historias
+        ],
+        total=len(historias),
+        hechas=0,
+        entregadas=[],
+        errores={},
+    )
+
+
+def _enviar_con_espera(html, hojas):
+    """Manda al pool; si la cola está llena espera en vez de fallar la exportación."""
+    while True:
+        try:
+            return enviar('weasyprint', html, hojas)
+        except ColaLlena:
+            time.sleep(1)
+
+
+def _guardar_en_cache(historia_id, huella, directorio, max_bytes, futuro):
+    # Se guarda aunque el cliente ya se haya ido: al reanudar sale de la caché
+    if futuro.exception() is None:
+        contenido, ms = futuro.result()
+        metricas_pdf.render(ms)
+        guardar_pdf('libro', historia_id, huella, contenido, directorio, max_bytes)
+
+
+def generar_zip(trabajo_id, generar_html, plantilla, hojas=(), catalogos=(), solo_pendientes=False):
+    """Genera el ZIP por partes (bytes) a medida que cada PDF queda listo.
+
+    Debe correr dentro de ``stream_with_context``: arma el HTML y consulta
+    la caché con la base de datos de la petición.
+    """
+    trabajo = leer_trabajo(trabajo_id)
+    entregadas = set(trabajo['entregadas'])
+    errores = dict(trabajo['errores'])
+    cola = iter([
+        h for h in trabajo['historias']
+        if not (solo_pendientes and h['id'] in entregadas)
+    ])
+    paralelo = max(1, current_app.config.get('PDF_LOTE_PARALELO', 2))
+    fecha = time.localtime(trabajo['creado'])[:6]
+    directorio, max_bytes = directorio_cache(), limite_bytes()
+
+    salida = _SalidaZip()
+    archivo_zip = zipfile.ZipFile(salida, 'w', zipfile.ZIP_STORED)
+
+    def agregar(entrada, contenido):
+        archivo_zip.writestr(zipfile.ZipInfo(entrada['nombre'], date_time=fecha), contenido)
+        return salida.vaciar()
+
+    def registrar_entrega(entrada):
+        entregadas.add(entrada['id'])
+        actualizar_trabajo(
+            trabajo_id,
+            entregadas=sorted(entregadas),
+            hechas=len(entregadas) + len(errores),
+            progreso=int(100 * (len(entregadas) + len(errores)) / max(trabajo['total'], 1)),
+        )
+
+    actualizar_trabajo(trabajo_id, estado='renderizando', iniciado=time.time())
+    en_vuelo = {}
+    agotada = False
+    try:
+        while True:
+            while not agotada and len(en_vuelo) < paralelo:
+                entrada = next(cola, None)
+                if entrada is None:
+                    agotada = True
+                    break
+                huella = huella_pdf(entrada['id'], plantilla, catalogos, hojas)
+                if huella is None:
+                    errores[str(entrada['id'])] = 'La historia ya no existe'
+                    continue
+                ruta = buscar_pdf('libro', entrada['id'], huella)
+                if ruta is not None:
+                    with open(ruta, 'rb') as archivo:
+                        yield agregar(entrada, archivo.read())
+                    registrar_entrega(entrada)
+                    continue
+                futuro = _enviar_con_espera(generar_html(entrada['id']), hojas)
+                futuro.add_done_callback(partial(
+                    _guardar_en_cache, entrada['id'], huella, directorio, max_bytes,
+                ))
+                en_vuelo[futuro] = entrada
+
+            if not en_vuelo:
+                break
+
+            terminados, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                entrada = en_vuelo.pop(futuro)
+                try:
+                    contenido, _ = futuro.result()
+                except Exception as e:
+                    errores[str(entrada['id'])] = str(e)
+                    continue
+                yield agregar(entrada, contenido)
+                del contenido
+                registrar_entrega(entrada)
+
+        if errores:
+            detalle = '\n'.join(f'historia {hid}: {error}' for hid, error in errores.items())
+            archivo_zip.writestr(zipfile.ZipInfo('errores.txt', date_time=fecha), detalle)
+        archivo_zip.close()
+        yield salida.vaciar()
+        actualizar_trabajo(
+            trabajo_id, estado='listo', errores=errores, terminado=time.time(),
+            hechas=len(entregadas) + len(errores), progreso=100,
+        )
+    except GeneratorExit:
+        # El cliente cortó: lo entregado queda anotado para reanudar con el mismo id
+        actualizar_trabajo(trabajo_id, estado='interrumpido', errores=errores)
+        raise
@@ -0,0 +1,238 @@
+"""Folio de enfermería de un paciente en PDF, por bloques.
+
+Una estancia larga en UCI acumula miles de registros; renderizarlos en un
+solo documento deja todo el árbol de WeasyPrint en memoria. Aquí los
+registros se leen por páginas de PDF_FOLIO_BLOQUE (paginación por id, sin
+OFFSET) y cada página se renderiza como un documento independiente en el
+pool de PDF (app/utils/render_pdf.py). Como mucho PDF_LOTE_PARALELO bloques
+están en vuelo; cada uno se escribe a un archivo temporal al terminar y al
+final se concatenan directo en el archivo de la caché: con ``qpdf`` si está
+instalado (copia por páginas sin cargar los documentos), si no con pypdf.
+El folio completo nunca pasa por un buffer en memoria del worker web.
+
+El resultado se guarda en la caché de PDF con la clave ``p<paciente_id>``;
+la huella usa ``pacientes.version_enfermeria`` (ver
+app/utils/versiones_historia.py).
+"""
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+
+from flask import current_app, render_template
+from pypdf import PdfWriter
+from sqlalchemy import select
+
+from app.extensions import db
+from app.models import Paciente, RegistroEnfermeria, AdministracionMedicamento, SolicitudInsumo
+from app.utils.cache_catalogos import catalogo
+from app.utils.cache_pdf import huella_contenido
+from app.utils.fechas import ahora_bogota
+from app.utils.render_pdf import enviar, directorio_trabajos, ErrorPDF
+from app.utils.versiones_historia import version_enfermeria
+
+PLANTILLA_FOLIO = 'enfermeria/pdf_enfermeria_limpio.html'
+HOJAS_FOLIO = ('pdf_enfermeria.css',)
+CATALOGOS_FOLIO = ('medicamentos', 'insumos')
+
+
+def clave_folio(paciente_id):
+    return f'p{paciente_id}'
+
+
+def huella_folio(paciente_id):
+    """Huella del folio del paciente, o None si el paciente no existe."""
+    version = version_enfermeria(paciente_id)
+    if version is None:
+        return None
+    return huella_contenido(clave_folio(paciente_id), version, PLANTILLA_FOLIO, CATALOGOS_FOLIO, HOJAS_FOLIO)
+
+
+def _json_dict(texto):
+    try:
+        datos = json.loads(texto or '{}')
+    except (TypeError, ValueError):
+        return {}
+    return datos if isinstance(datos, dict) else {}
+
+
+def consulta_bloque(paciente_id, ultimo_id, tamano):
+    """Los ``tamano`` registros del paciente que siguen a ``ultimo_id``."""
+    return (
+        select(
+            RegistroEnfermeria.id, RegistroEnfermeria.fecha_registro, RegistroEnfermeria.turno,
+            RegistroEnfermeria.signos_vitales, RegistroEnfermeria.balance_liquidos,
+            RegistroEnfermeria.control_glicemia, RegistroEnfermeria.observaciones,
+            RegistroEnfermeria.tipo_nota, RegistroEnfermeria.texto_nota,
+        )
+        .where(RegistroEnfermeria.paciente_id == paciente_id, RegistroEnfermeria.id > ultimo_id)
+        .order_by(RegistroEnfermeria.id)
+        .limit(tamano)
+    )
+
+
+def bloques_registros(paciente_id, tamano, session=None):
+    """Registros del paciente en listas de ``tamano``, del más antiguo al más reciente."""
+    session = session or db.session
+    ultimo_id = 0
+    while True:
+        filas = session.execute(consulta_bloque(paciente_id, ultimo_id, tamano)).all()
+        if not filas:
+            return
+        ultimo_id = filas[-1].id
+        yield [
+            {
+                'fecha_registro': f.fecha_registro, 'turno': f.turno,
+                'sv': _json_dict(f.signos_vitales),
+                'bl': _json_dict(f.balance_liquidos),
+                'control_glicemia': f.control_glicemia, 'observaciones': f.observaciones,
+                'tipo_nota': f.tipo_nota, 'texto_nota': f.texto_nota, 'id': f.id,
+            }
+            for f in filas
+        ]
+        if len(filas) < tamano:
+            return
+
+
+def _administraciones(registro_ids, session):
+    medicamentos = catalogo('medicamentos')
+    filas = session.execute(
+        select(
+            AdministracionMedicamento.medicamento_id, AdministracionMedicamento.cantidad,
+            AdministracionMedicamento.unidad, AdministracionMedicamento.via,
+            AdministracionMedicamento.observaciones, AdministracionMedicamento.hora_administracion,
+        )
+        .where(
+            AdministracionMedicamento.registro_enfermeria_id.in_(registro_ids),
+            AdministracionMedicamento.cantidad > 0,
+        )
+        .order_by(AdministracionMedicamento.hora_administracion, AdministracionMedicamento.id)
+    ).all()
+    resultado = []
+    for a in filas:
+        med = medicamentos.get(a.medicamento_id)
+        resultado.append({
+            'hora_administracion': a.hora_administracion,
+            'codigo': med.codigo if med else 'N/A',
+            'nombre': med.nombre if med else '',
+            'cantidad': a.cantidad, 'unidad': a.unidad, 'via': a.via,
+            'observaciones': a.observaciones,
+        })
+    return resultado
+
+
+def _insumos(paciente_id, session):
+    insumos = catalogo('insumos')
+    registrados = []
+    for s in session.execute(
+        select(
+            SolicitudInsumo.insumo_medico_id, SolicitudInsumo.cantidad, SolicitudInsumo.estado,
+            SolicitudInsumo.fecha_solicitud, SolicitudInsumo.observaciones,
+        )
+        .where(SolicitudInsumo.paciente_id == paciente_id)
+        .order_by(SolicitudInsumo.fecha_solicitud, SolicitudInsumo.id)
+    ):
+        insumo = insumos.get(s.insumo_medico_id)
+        if not insumo:
+            continue
+        entregado = s.estado == 'entregado'
+        registrados.append({
+            'fecha_uso': s.fecha_solicitud.strftime('%Y-%m-%d %H:%M') if s.fecha_solicitud else '',
+            'nombre': insumo.nombre,
+            'solicitado': int(s.cantidad),
+            'usado': int(s.cantidad) if entregado else 0,
+            'pendiente': 0 if entregado else int(s.cantidad),
+            'observaciones': s.observaciones or 'Sin observaciones',
+        })
+    return registrados
+
+
+def _html_bloque(paciente, registros, numero, total, fecha_generacion, session, insumos=None):
+    return render_template(
+        PLANTILLA_FOLIO,
+        paciente=paciente,
+        registros=registros,
+        medicamentos=_administraciones([r['id'] for r in registros], session) if registros else [],
+        insumos_registrados=insumos,
+        bloque=numero,
+        total_bloques=total,
+        fecha_generacion=fecha_generacion,
+    )
+
+
+def _concatenar(partes, destino):
+    if shutil.which('qpdf'):
+        subprocess.run(
+            ['qpdf', '--empty', '--pages', *partes, '--', destino],
+            check=True, capture_output=True, timeout=current_app.config.get('PDF_TIMEOUT_S', 120),
+        )
+        return
+    escritor = PdfWriter()
+    try:
+        for ruta in partes:
+            escritor.append(ruta)
+        with open(destino, 'wb') as archivo:
+            escritor.write(archivo)
+    finally:
+        escritor.close()
+
+
+def escribir_folio(paciente_id, destino, session=None):
+    """Escribe en ``destino`` el folio completo: bloques renderizados en el pool y concatenados."""
+    session = session or db.session
+    paciente = session.get(Paciente, paciente_id)
+    tamano = max(1, current_app.config.get('PDF_FOLIO_BLOQUE', 200))
+    paralelo = max(1, current_app.config.get('PDF_LOTE_PARALELO', 2))
+    total_registros = session.query(RegistroEnfermeria.id).filter(
+        RegistroEnfermeria.paciente_id == paciente_id
+    ).count()
+    total = max(1, -(-total_registros // tamano))
+    fecha_generacion = ahora_bogota().strftime('%d/%m/%Y %H:%M')
+
+    temporal = tempfile.mkdtemp(prefix='folio_', dir=directorio_trabajos())
+    partes = []
+    en_vuelo = deque()
+
+    def recoger():
+        numero, futuro = en_vuelo.popleft()
+        try:
+            contenido, _ = futuro.result(timeout=current_app.config.get('PDF_TIMEOUT_S', 120))
+        except ErrorPDF:
+            raise
+        except Exception as e:
+            raise ErrorPDF(f'Bloque {numero} del folio: {e}') from e
+        ruta = os.path.join(temporal, f'{numero:05d}.pdf')
+        with open(ruta, 'wb') as archivo:
+            archivo.write(contenido)
+        partes.append(ruta)
+
+    try:
+        bloques = bloques_registros(paciente_id, tamano, session)
+        # Un paciente sin registros igual lleva un bloque (encabezado e insumos)
+        registros, numero = next(bloques, []), 1
+        while registros is not None:
+            # Se lee el siguiente antes de renderizar: los insumos van en el último bloque
+            siguiente = next(bloques, None)
+            html = _html_bloque(
+                paciente, registros, numero, max(total, numero), fecha_generacion, session,
+                insumos=_insumos(paciente_id, session) if siguiente is None else None,
+            )
+            en_vuelo.append((numero, enviar('weasyprint', html, HOJAS_FOLIO)))
+            del html
+            registros, numero = siguiente, numero + 1
+            # Se recogen en orden: nunca hay más de ``paralelo`` bloques en memoria
+            if len(en_vuelo) >= paralelo:
+                recoger()
+        while en_vuelo:
+            recoger()
+
+        try:
+            _concatenar(partes, destino)
+        except subprocess.SubprocessError as e:
+            raise ErrorPDF(f'No se pudieron unir los bloques del folio: {e}') from e
+    finally:
+        for _, futuro in en_vuelo:
+            futuro.cancel()
+        shutil.rmtree(temporal, ignore_errors=True)
@@ -0,0 +1,205 @@
+"""Índices en memoria de los catálogos para el autocompletado.
+
+Cada proceso carga una vez las entradas del catálogo y arma:
+
+- un trie por código (``A09`` encuentra A09, A090, A099, ...)
+- un índice invertido de palabras de la descripción normalizada, con el
+  vocabulario ordenado para resolver prefijos con ``bisect``
+
+El índice es inmutable; cuando la versión del catálogo en
+``catalogo_versiones`` cambia (``param.cie10_toggle``, las rutas de
+medicamentos o ``flask invalidar-catalogo <nombre>``) se construye uno
+nuevo y se reemplaza de una sola vez.
+"""
+import bisect
+import threading
+import time
+from collections import namedtuple
+
+from app.metricas import registrar_metrica
+from app.utils.cache_catalogos import catalogo
+from app.utils.texto import normalizar_texto, tokens
+from app.utils.versiones_catalogo import version_catalogo
+
+Entrada = namedtuple('Entrada', 'id codigo nombre extra')
+
+
+def normalizar_codigo(valor):
+    return (valor or '').replace('.', '').replace(' ', '').upper()
+
+
+def _cargar_cie10():
+    filas = sorted(catalogo('cie10').items, key=lambda f: f.codigo)
+    return [Entrada(f.id, f.codigo, f.nombre, {}) for f in filas if f.habilitado is True]
+
+
+def _cargar_medicamentos():
+    filas = sorted(catalogo('medicamentos').items, key=lambda f: f.codigo)
+    return [
+        Entrada(f.id, f.codigo, f.nombre, {
+            'presentacion': f.presentacion,
+            'unidad_inventario': f.unidad_inventario,
+        })
+        for f in filas
+    ]
+
+
+# nombre del catálogo (el mismo de catalogo_versiones) -> entradas tomadas de la caché
+CARGADORES = {
+    'cie10': _cargar_cie10,
+    'medicamentos': _cargar_medicamentos,
+}
+
+
+class _NodoTrie:
+    __slots__ = ('hijos', 'posiciones')
+
+    def __init__(self):
+        self.hijos = {}
+        # posiciones de las entradas cuyo código pasa por este nodo, en orden de código
+        self.posiciones = []
+
+
+class IndiceCatalogo:
+    def __init__(self, entradas, version):
+        self.version = version
+        self.entradas = list(entradas)
+        self._codigos = [normalizar_codigo(e.codigo) for e in self.entradas]
+        self._nombres = [normalizar_texto(e.nombre) for e in self.entradas]
+        self._palabras = [n.split(' ') for n in self._nombres]
+
+        self._raiz = _NodoTrie()
+        for pos, codigo in enumerate(self._codigos):
+            nodo = self._raiz
+            for letra in codigo:
+                nodo = nodo.hijos.setdefault(letra, _NodoTrie())
+                nodo.posiciones.append(pos)
+
+        invertido = {}
+        for pos, palabras in enumerate(self._palabras):
+            for palabra in set(palabras):
+                if palabra:
+                    invertido.setdefault(palabra, []).append(pos)
+        self._vocabulario = sorted(invertido)
+        self._postings = {p: frozenset(v) for p, v in invertido.items()}
+
+    def __len__(self):
+        return len(self.entradas)
+
+    def _por_codigo(self, codigo):
+        nodo = self._raiz
+        for letra in codigo:
+            nodo = nodo.hijos.get(letra)
+            if nodo is None:
+                return []
+        return nodo.posiciones
+
+    def _por_prefijo_de_palabra(self, prefijo):
+        inicio = bisect.bisect_left(self._vocabulario, prefijo)
+        resultado = set()
+        for palabra in self._vocabulario[inicio:]:
+            if not palabra.startswith(prefijo):
+                break
+            resultado |= self._postings[palabra]
+        return resultado
+
+    def _por_descripcion(self, palabras):
+        conjuntos = sorted((self._por_prefijo_de_palabra(p) for p in palabras), key=len)
+        if not conjuntos:
+            return set()
+        resultado = set(conjuntos[0])
+        for otro in conjuntos[1:]:
+            resultado &= otro
+            if not resultado:
+                break
+        return resultado
+
+    def _relevancia(self, pos, codigo, normalizado, palabras):
+        """Menor es mejor: código exacto, prefijo de código, descripción."""
+        if self._codigos[pos] == codigo:
+            grupo = 0
+        elif codigo and self._codigos[pos].startswith(codigo):
+            grupo = 1
+        elif self._nombres[pos].startswith(normalizado):
+            grupo = 2
+        elif self._palabras[pos][0].startswith(palabras[0]):
+            grupo = 3
+        else:
+            grupo = 4
+        return (grupo, len(self._palabras[pos]), self._codigos[pos])
+
+    def buscar(self, termino, limite=20, desplazamiento=0):
+        normalizado = normalizar_texto(termino)
+        if not normalizado:
+            return []
+        codigo = normalizar_codigo(termino)
+        palabras = tokens(normalizado)
+        tope = desplazamiento + limite
+
+        candidatos = set(self._por_codigo(codigo)[:tope]) if codigo else set()
+        candidatos |= self._por_descripcion(palabras)
+
+        orden = sorted(
+            candidatos,
+            key=lambda pos: self._relevancia(pos, codigo, normalizado, palabras)
+        )
+        return [self.entradas[pos] for pos in orden[desplazamiento:tope]]
+
+
+class _MetricasIndices:
+    def __init__(self):
+        self.construcciones = {}
+        self.construccion_ms = {}
+        self.consultas = {}
+
+    def snapshot(self):
+        return {
+            nombre: {
+                'version': indice.version,
+                'entradas': len(indice),
+                'construcciones': self.construcciones.get(nombre, 0),
+                'ultima_construccion_ms': round(self.construccion_ms.get(nombre, 0.0), 2),
+                'consultas': self.consultas.get(nombre, 0),
+            }
+            for nombre, indice in _indices.items()
+        }
+
+
+_indices = {}
+_lock = threading.Lock()
+metricas_indices = _MetricasIndices()
+registrar_metrica('indices_catalogo', metricas_indices.snapshot)
+
+
+def _construir(nombre, version):
+    inicio = time.perf_counter()
+    indice = IndiceCatalogo(CARGADORES[nombre](), version)
+    metricas_indices.construcciones[nombre] = metricas_indices.construcciones.get(nombre, 0) + 1
+    metricas_indices.construccion_ms[nombre] = (time.perf_counter() - inicio) * 1000
+    return indice
+
+
+def obtener_indice(nombre):
+    """Índice vigente del proceso; lo reconstruye si cambió la versión del catálogo."""
+    version = version_catalogo(nombre)
+    indice = _indices.get(nombre)
+    if indice is not None and indice.version == version:
+        return indice
+
+    with _lock:
+        indice = _indices.get(nombre)
+        if indice is None or indice.version != version:
+            indice = _construir(nombre, version)
+            _indices[nombre] = indice
+        return indice
+
+
+def buscar_en_catalogo(nombre, termino, limite=20, desplazamiento=0):
+    """Entradas del catálogo que coinciden con ``termino``, ordenadas por relevancia."""
+    metricas_indices.consultas[nombre] = metricas_indices.consultas.get(nombre, 0) + 1
+    return obtener_indice(nombre).buscar(termino, limite, desplazamiento)
+
+
+def buscar_cie10(termino, limite=20):
+    """Diagnósticos habilitados que coinciden con ``termino``."""
+    return buscar_en_catalogo('cie10', termino, limite)
@@ -0,0 +1,247 @@
+"""Ingesta continua de los exportes CSV de los analizadores.
+
+Los analizadores (o quien copia sus exportes) dejan los CSV en
+LAB_INGESTA_DIR (por defecto instance/ingesta_laboratorios), con las mismas
+columnas que la carga masiva (``COLUMNAS``, app/utils/carga_laboratorios.py).
+``flask ingesta-laboratorios`` revisa la carpeta cada LAB_INGESTA_INTERVALO_S
+segundos:
+
+- un archivo se toma cuando lleva LAB_INGESTA_ESPERA_S segundos sin
+  cambiar (el analizador pudo no haber terminado de escribirlo)
+- se lee por bloques de LAB_INGESTA_BLOQUE líneas; las vacías se saltan y
+  el resto de cada bloque pasa por ``cargar_resultados`` (catálogos en
+  caché, inserción en bloque, banderas de fuera de rango) y se confirma
+  por separado
+- después de cada bloque se guarda el punto de control en
+  ``.estado/<sha256>.json``: el hash del contenido y cuántas líneas de
+  datos ya se leyeron. Si el proceso se detiene, sigue desde ahí; si cae
+  entre la confirmación y el punto de control, el bloque se repite, y como
+  los resultados son un upsert y las solicitudes del día se reutilizan, no
+  se duplica nada
+- al terminar, el archivo pasa a ``procesados/AAAA-MM-DD/`` o, si no
+  se pudo leer o ninguna fila entró, a ``errores/``; los errores por fila
+  quedan al lado en ``<archivo>.errores.txt``
+
+El punto de control va por contenido, no por nombre: un exporte copiado
+dos veces se reconoce y se archiva sin volver a cargarlo, y un archivo
+reemplazado por otro con el mismo nombre empieza de cero.
+
+Un error de base de datos deja el archivo en su lugar para la siguiente
+vuelta; después de LAB_INGESTA_INTENTOS fallos seguidos pasa a ``errores/``.
+Debe correr un solo proceso de ingesta por carpeta.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from app.extensions import db
+from app.utils.carga_laboratorios import cargar_resultados, COLUMNAS
+from app.utils.fechas import ahora_bogota
+from app.utils.transacciones import confirmar
+
+EXTENSIONES = ('.csv',)
+
+ResumenIngesta = namedtuple('ResumenIngesta', 'archivo destino filas creados errores')
+
+
+class ArchivoInvalido(Exception):
+    """El archivo no se puede cargar tal como está (formato, columnas, codificación)."""
+
+
+def directorios(entrada=None):
+    """Carpeta de entrada y sus subcarpetas (se crean si no existen)."""
+    entrada = entrada or current_app.config.get('LAB_INGESTA_DIR') or os.path.join(
+        current_app.instance_path, 'ingesta_laboratorios'
+    )
+    rutas = {
+        'entrada': entrada,
+        'procesados': os.path.join(entrada, 'procesados'),
+        'errores': os.path.join(entrada, 'errores'),
+        'estado': os.path.join(entrada, '.estado'),
+    }
+    for ruta in rutas.values():
+        os.makedirs(ruta, exist_ok=True)
+    return rutas
+
+
+def pendientes(entrada, espera_s=0):
+    """Archivos de la carpeta de entrada que ya no están cambiando, del más viejo al más nuevo."""
+    limite = time.time() - espera_s
+    archivos = []
+    with os.scandir(entrada) as entradas:
+        for e in entradas:
+            if not e.is_file() or not e.name.lower().endswith(EXTENSIONES):
+                continue
+            modificado = e.stat().st_mtime
+            if modificado <= limite:
+                archivos.append((modificado, e.path))
+    return [ruta for _, ruta in sorted(archivos)]
+
+
+def _sha256(ruta):
+    huella = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for datos in iter(lambda: f.read(1024 * 1024), b''):
+            huella.update(datos)
+    return huella.hexdigest()
+
+
+# Punto de control
+
+def _ruta_estado(dirs, clave):
+    return os.path.join(dirs['estado'], clave + '.json')
+
+
+def _leer_estado(dirs, clave):
+    try:
+        with open(_ruta_estado(dirs, clave), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'filas': 0, 'creados': 0, 'errores': 0, 'intentos': 0, 'terminado': None}
+
+
+def _guardar_estado(dirs, clave, estado):
+    # Escribir aparte y renombrar: un corte a mitad no deja el JSON a medias
+    ruta = _ruta_estado(dirs, clave)
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(estado, f)
+    os.replace(ruta + '.tmp', ruta)
+
+
+def _anotar_errores(dirs, clave, errores):
+    if errores:
+        with open(os.path.join(dirs['estado'], clave + '.errores.txt'), 'a', encoding='utf-8') as f:
+            f.writelines(e + '\n' for e in errores)
+
+
+# Lectura y archivo
+
+def _bloques(ruta, desde, tamano):
+    """DataFrames de ``tamano`` líneas a partir de la línea de datos ``desde``."""
+    try:
+        encabezado = pd.read_csv(ruta, dtype=str, nrows=0)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ArchivoInvalido(f'No se pudo leer: {e}') from e
+    faltantes = [c for c in COLUMNAS if c not in encabezado.columns]
+    if faltantes:
+        raise ArchivoInvalido(f'Columnas faltantes: {", ".join(faltantes)}')
+    # Todo como texto, igual que la carga masiva: los documentos no deben volverse float.
+    # Las líneas en blanco se leen como filas vacías para que ``desde`` y los números
+    # de fila de los errores cuenten líneas del archivo; procesar_archivo las descarta
+    lector = pd.read_csv(
+        ruta, dtype=str, chunksize=tamano, skiprows=range(1, desde + 1), skip_blank_lines=False,
+    )
+    try:
+        yield from lector
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ArchivoInvalido(f'No se pudo leer: {e}') from e
+    finally:
+        lector.close()
+
+
+def _archivar(ruta, carpeta, clave, dirs):
+    """Mueve el archivo (y su reporte de errores) a ``carpeta``; devuelve la ruta final."""
+    os.makedirs(carpeta, exist_ok=True)
+    nombre = os.path.basename(ruta)
+    destino = os.path.join(carpeta, nombre)
+    if os.path.exists(destino):
+        base, extension = os.path.splitext(nombre)
+        destino = os.path.join(carpeta, f'{base}.{clave[:12]}{extension}')
+    shutil.move(ruta, destino)
+    reporte = os.path.join(dirs['estado'], clave + '.errores.txt')
+    if os.path.exists(reporte):
+        shutil.move(reporte, destino + '.errores.txt')
+    return destino
+
+
+def procesar_archivo(ruta, dirs, bloque=5000, intentos=3, parar=None, session=None):
+    """Carga lo que falte de ``ruta`` y lo archiva al terminar.
+
+    Devuelve un ``ResumenIngesta`` (``destino`` es None si el archivo queda
+    en la entrada: detenido por ``parar`` o a la espera de otro intento).
+    """
+    session = session or db.session
+    clave = _sha256(ruta)
+    estado = _leer_estado(dirs, clave)
+    nombre = os.path.basename(ruta)
+
+    if estado['terminado']:
+        # Mismo contenido ya cargado: solo se archiva
+        destino = _archivar(ruta, os.path.join(dirs['procesados'], 'duplicados'), clave, dirs)
+        return ResumenIngesta(nombre, destino, 0, 0, 0)
+
+    filas_antes = estado['filas']
+    try:
+        for df in _bloques(ruta, estado['filas'], bloque):
+            if parar is not None and parar.is_set():
+                return ResumenIngesta(nombre, None, estado['filas'] - filas_antes, estado['creados'], estado['errores'])
+            # La fila 1 del archivo es el encabezado
+            lineas = np.arange(len(df)) + estado['filas'] + 2
+            con_datos = df.notna().any(axis=1).to_numpy()
+            creados, errores = 0, []
+            if con_datos.any():
+                resumen = cargar_resultados(
+                    df[con_datos].reset_index(drop=True), session=session, filas=lineas[con_datos],
+                )
+                confirmar(session)
+                creados, errores = resumen.creados, resumen.errores
+            _anotar_errores(dirs, clave, errores)
+            estado.update(
+                filas=estado['filas'] + len(df),
+                creados=estado['creados'] + creados,
+                errores=estado['errores'] + len(errores),
+                intentos=0,
+            )
+            _guardar_estado(dirs, clave, estado)
+    except ArchivoInvalido as e:
+        session.rollback()
+        _anotar_errores(dirs, clave, [str(e)])
+        destino = _archivar(ruta, dirs['errores'], clave, dirs)
+        estado['terminado'] = ahora_bogota().isoformat()
+        _guardar_estado(dirs, clave, estado)
+        return ResumenIngesta(nombre, destino, estado['filas'] - filas_antes, estado['creados'], estado['errores'] + 1)
+    except Exception:
+        session.rollback()
+        estado['intentos'] += 1
+        _guardar_estado(dirs, clave, estado)
+        if estado['intentos'] < intentos:
+            raise
+        current_app.logger.exception('Ingesta de %s: %s intentos fallidos', nombre, estado['intentos'])
+        _anotar_errores(dirs, clave, [f'Se abandonó tras {estado["intentos"]} intentos fallidos'])
+        destino = _archivar(ruta, dirs['errores'], clave, dirs)
+        return ResumenIngesta(nombre, destino, estado['filas'] - filas_antes, estado['creados'], estado['errores'])
+
+    sin_carga = estado['creados'] == 0 and estado['errores'] > 0
+    carpeta = dirs['errores'] if sin_carga else os.path.join(dirs['procesados'], ahora_bogota().strftime('%Y-%m-%d'))
+    destino = _archivar(ruta, carpeta, clave, dirs)
+    estado['terminado'] = ahora_bogota().isoformat()
+    _guardar_estado(dirs, clave, estado)
+    return ResumenIngesta(nombre, destino, estado['filas'] - filas_antes, estado['creados'], estado['errores'])
+
+
+def vigilar(dirs, al_procesar, intervalo=10, espera_s=5, bloque=5000, intentos=3, parar=None, una_vez=False):
+    """Procesa la carpeta de entrada hasta que ``parar`` se active (o una sola vez)."""
+    while parar is None or not parar.is_set():
+        for ruta in pendientes(dirs['entrada'], espera_s):
+            if parar is not None and parar.is_set():
+                break
+            try:
+                resumen = procesar_archivo(ruta, dirs, bloque=bloque, intentos=intentos, parar=parar)
+            except Exception:
+                # Queda en la entrada; se reintenta en la próxima vuelta
+                current_app.logger.exception('Ingesta de %s falló', os.path.basename(ruta))
+                continue
+            al_procesar(resumen)
+        if una_vez:
+            break
+        if parar is not None:
+            parar.wait(intervalo)
+        else:
+            time.sleep(intervalo)
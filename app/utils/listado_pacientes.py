@@ -0,0 +1,197 @@
+"""Listado de pacientes paginado por cursor (keyset).
+
+El listado va de la actividad más reciente a la más antigua
+(``pacientes.ultima_actividad``, ver app/utils/actividad_pacientes.py) y
+avanza con un cursor ``<ultima_actividad>_<id>`` en lugar de OFFSET, así
+que la página 500 cuesta lo mismo que la primera: el índice
+``ix_pacientes_ultima_actividad`` entrega las filas ya ordenadas a partir
+del cursor.
+
+Filtros:
+
+- ``q``: nombre o documento, con los mismos aciertos que la búsqueda del
+  resto de la aplicación (``condicion_busqueda``,
+  app/utils/busqueda_pacientes.py), aplicados en la misma consulta: sin
+  tope de candidatos, en el orden del listado
+- ``servicio``: servicio de la historia más reciente
+- ``cama``: prefijo de la cama
+- ``estado``: ``activos`` (sin nota de egreso posterior a su última
+  historia) o ``egresados``
+
+El número y el servicio de la última historia se traen como columnas de la
+misma consulta (subconsultas correlacionadas sobre
+``ix_historias_clinicas_paciente_fecha``), solo para las filas de la página.
+
+El total es aproximado: se cuenta una vez por combinación de filtros y se
+guarda PACIENTES_TOTAL_TTL_S segundos; en PostgreSQL, sin filtros, se usa la
+estimación del planificador.
+"""
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select, func, exists, and_, tuple_, text
+
+from app.extensions import db
+from app.models import Paciente, HistoriaClinica, RegistroEnfermeria
+from app.utils import actividad_pacientes  # noqa: F401  (registra los eventos de actividad)
+from app.utils.busqueda_pacientes import condicion_busqueda
+
+POR_PAGINA = 25
+ESTADOS = ('activos', 'egresados')
+
+_totales = {}
+_totales_lock = threading.Lock()
+
+
+def _de_ultima_historia(columna):
+    return (
+        select(columna)
+        .where(HistoriaClinica.paciente_id == Paciente.id)
+        .order_by(HistoriaClinica.fecha_registro.desc(), HistoriaClinica.id.desc())
+        .limit(1)
+        .correlate(Paciente)
+        .scalar_subquery()
+    )
+
+
+def paciente_activo():
+    """El paciente tiene historia y no hay nota de egreso posterior a la última."""
+    ultima_fecha = _de_ultima_historia(HistoriaClinica.fecha_registro)
+    egreso = exists().where(and_(
+        RegistroEnfermeria.paciente_id == Paciente.id,
+        RegistroEnfermeria.tipo_nota == 'egreso',
+        RegistroEnfermeria.fecha_registro >= ultima_fecha,
+    )).correlate(Paciente)
+    return and_(ultima_fecha.isnot(None), ~egreso)
+
+
+def normalizar_filtros(args):
+    """Filtros del listado a partir de ``request.args`` (los vacíos se omiten)."""
+    filtros = {
+        'q': (args.get('q') or '').strip(),
+        'servicio': (args.get('servicio') or '').strip(),
+        'cama': (args.get('cama') or '').strip(),
+        'estado': (args.get('estado') or '').strip(),
+    }
+    if filtros['estado'] not in ESTADOS:
+        filtros['estado'] = ''
+    return {k: v for k, v in filtros.items() if v}
+
+
+def _condiciones(filtros, session):
+    # Sin actividad no hay posición en el orden del listado: no entra en páginas ni en el total
+    condiciones = [Paciente.ultima_actividad.isnot(None)]
+    if filtros.get('q'):
+        condiciones.append(condicion_busqueda(filtros['q'], session))
+    if filtros.get('servicio'):
+        condiciones.append(_de_ultima_historia(HistoriaClinica.servicio_hospitalario) == filtros['servicio'])
+    if filtros.get('cama'):
+        condiciones.append(Paciente.cama.startswith(filtros['cama'], autoescape=True))
+    if filtros.get('estado') == 'activos':
+        condiciones.append(paciente_activo())
+    elif filtros.get('estado') == 'egresados':
+        condiciones.append(~paciente_activo())
+    return condiciones
+
+
+def codificar_cursor(fila):
+    return f'{fila.ultima_actividad.isoformat()}_{fila.id}'
+
+
+def _leer_cursor(cursor):
+    try:
+        fecha, paciente_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(fecha), int(paciente_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def consulta_pagina(filtros, posicion=None, retrocede=False, por_pagina=POR_PAGINA, session=None):
+    """Sentencia de una página a partir de ``posicion`` (``(ultima_actividad, id)``).
+
+    Hacia las filas más antiguas, o hacia las más recientes si ``retrocede``;
+    trae una fila de más, que indica si hay otra página en esa dirección.
+    """
+    session = session or db.session
+    clave = tuple_(Paciente.ultima_actividad, Paciente.id)
+    consulta = select(
+        Paciente.id, Paciente.nombre, Paciente.numero, Paciente.cama, Paciente.ultima_actividad,
+        _de_ultima_historia(HistoriaClinica.id).label('historia_id'),
+        _de_ultima_historia(HistoriaClinica.numero_historia).label('numero_historia'),
+        _de_ultima_historia(HistoriaClinica.servicio_hospitalario).label('servicio'),
+    ).where(*_condiciones(filtros, session))
+
+    if retrocede:
+        consulta = consulta.where(clave > posicion).order_by(
+            Paciente.ultima_actividad.asc(), Paciente.id.asc()
+        )
+    else:
+        if posicion is not None:
+            consulta = consulta.where(clave < posicion)
+        consulta = consulta.order_by(Paciente.ultima_actividad.desc(), Paciente.id.desc())
+    return consulta.limit(por_pagina + 1)
+
+
+def pagina_pacientes(filtros, despues=None, antes=None, por_pagina=POR_PAGINA, session=None):
+    """Una página del listado.
+
+    ``despues`` avanza desde el cursor de la última fila de la página actual;
+    ``antes`` retrocede desde el de la primera. Devuelve ``(filas, anterior,
+    siguiente)`` con los cursores de las páginas vecinas (None si no hay).
+    """
+    session = session or db.session
+    retrocede = False
+    posicion = _leer_cursor(antes) if antes else None
+    if posicion is not None:
+        retrocede = True
+    else:
+        posicion = _leer_cursor(despues) if despues else None
+
+    filas = session.execute(
+        consulta_pagina(filtros, posicion, retrocede, por_pagina, session)
+    ).all()
+    hay_mas = len(filas) > por_pagina
+    filas = filas[:por_pagina]
+    if retrocede:
+        filas.reverse()
+        anterior = codificar_cursor(filas[0]) if hay_mas and filas else None
+        siguiente = codificar_cursor(filas[-1]) if filas else None
+    else:
+        anterior = codificar_cursor(filas[0]) if posicion is not None and filas else None
+        siguiente = codificar_cursor(filas[-1]) if hay_mas else None
+    return filas, anterior, siguiente
+
+
+def consulta_total(filtros, session=None):
+    return select(func.count()).select_from(Paciente).where(*_condiciones(filtros, session or db.session))
+
+
+def total_aproximado(filtros, session=None):
+    """Total de pacientes con los filtros, de la caché si se contó hace poco."""
+    session = session or db.session
+    clave = tuple(sorted(filtros.items()))
+    ahora = time.monotonic()
+    with _totales_lock:
+        guardado = _totales.get(clave)
+    if guardado is not None and guardado[0] > ahora:
+        return guardado[1]
+
+    total = None
+    if not filtros and session.get_bind().dialect.name == 'postgresql':
+        total = session.execute(text(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = 'pacientes'"
+        )).scalar()
+        # -1 o 0 mientras la tabla no se ha analizado: se cuenta de verdad
+        total = total if total and total > 0 else None
+    if total is None:
+        total = session.execute(consulta_total(filtros, session)).scalar()
+
+    with _totales_lock:
+        if len(_totales) >= 500:
+            # Cada búsqueda distinta deja una entrada: se descartan las vencidas
+            for vieja in [k for k, (vence, _) in _totales.items() if vence <= ahora]:
+                del _totales[vieja]
+        _totales[clave] = (ahora + current_app.config.get('PACIENTES_TOTAL_TTL_S', 120), total)
+    return total
@@ -0,0 +1,230 @@
+"""Miniaturas y vistas previas de los estudios de imágenes.
+
+En la lista de estudios se mostraba el original (imágenes y PDF de varios
+MB) aun para ver de qué se trataba. Al subir un archivo se generan en
+segundo plano dos JPEG, y se guardan junto al original en el almacén por
+contenido (app/utils/almacen_archivos.py):
+
+- ``miniatura``: lado mayor de 256 px, para la lista
+- ``vista``: lado mayor de 1600 px, para abrir el estudio en el navegador
+
+Un hilo coordina cada trabajo (lee el original, guarda los resultados) y
+la decodificación y el redimensionado con Pillow corren en un pool de
+procesos acotado (MINIATURAS_WORKERS), así no compiten por el GIL con las
+peticiones. De un PDF se usa la primera página: con ``pdftoppm`` (poppler)
+si está instalado; si no, la imagen más grande de esa página con pypdf, que
+en los informes escaneados es la página misma. Si no se puede obtener
+imagen no hay miniatura y la lista muestra el enlace de siempre.
+
+Como la clave es el hash del contenido, las URL de las miniaturas nunca
+cambian de contenido y se sirven con caché larga (MINIATURAS_CACHE_S).
+"""
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from app.metricas import registrar_metrica
+from app.utils.almacen_archivos import almacen
+
+# variante -> lado mayor en píxeles
+VARIANTES = {'miniatura': 256, 'vista': 1600}
+MIMETYPE = 'image/jpeg'
+
+_CALIDAD_JPEG = 82
+
+
+def sufijo(variante):
+    return f'.{variante}.jpg'
+
+
+def admite(tipo_mime):
+    return bool(tipo_mime) and (tipo_mime.startswith('image/') or tipo_mime == 'application/pdf')
+
+
+# Lado del proceso
+
+def _primera_pagina_pdf(ruta):
+    from PIL import Image
+
+    if shutil.which('pdftoppm'):
+        with tempfile.TemporaryDirectory() as directorio:
+            salida = os.path.join(directorio, 'pagina')
+            subprocess.run(
+                ['pdftoppm', '-f', '1', '-l', '1', '-r', '110', '-png', '-singlefile', ruta, salida],
+                check=True, capture_output=True, timeout=60,
+            )
+            with Image.open(salida + '.png') as pagina:
+                pagina.load()
+                return pagina
+
+    from pypdf import PdfReader
+    pagina = PdfReader(ruta).pages[0]
+    imagenes = [i.image for i in pagina.images if i.image is not None]
+    if not imagenes:
+        return None
+    return max(imagenes, key=lambda i: i.width * i.height)
+
+
+def _abrir_imagen(ruta):
+    from PIL import Image, ImageOps
+
+    imagen = Image.open(ruta)
+    # JPEG: decodifica ya reducido (1/2, 1/4, 1/8) cuando alcanza para la vista
+    lado = VARIANTES['vista']
+    imagen.draft('RGB', (lado, lado))
+    return ImageOps.exif_transpose(imagen)
+
+
+def _a_rgb(imagen):
+    from PIL import Image
+
+    if imagen.mode in ('RGBA', 'LA', 'P'):
+        imagen = imagen.convert('RGBA')
+        fondo = Image.new('RGB', imagen.size, 'white')
+        fondo.paste(imagen, mask=imagen.getchannel('A'))
+        return fondo
+    return imagen.convert('RGB')
+
+
+def generar(ruta, tipo_mime):
+    """Devuelve ``{variante: bytes JPEG}``; vacío si no hay imagen que mostrar."""
+    from PIL import Image
+    from pypdf.errors import PyPdfError
+
+    try:
+        imagen = _primera_pagina_pdf(ruta) if tipo_mime == 'application/pdf' else _abrir_imagen(ruta)
+    except (OSError, ValueError, Image.DecompressionBombError, subprocess.SubprocessError, PyPdfError):
+        # Archivo dañado o que no es lo que dice su extensión: sin miniatura
+        return {}
+    if imagen is None:
+        return {}
+
+    imagen = _a_rgb(imagen)
+    resultado = {}
+    # De mayor a menor: cada variante se reduce desde la anterior
+    for variante, lado in sorted(VARIANTES.items(), key=lambda v: -v[1]):
+        imagen.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+        salida = io.BytesIO()
+        imagen.save(salida, 'JPEG', quality=_CALIDAD_JPEG, optimize=True, progressive=True)
+        resultado[variante] = salida.getvalue()
+    return resultado
+
+
+# Lado de la aplicación
+
+class _MetricasMiniaturas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.generadas = 0
+        self.sin_imagen = 0
+        self.errores = 0
+        self.pendientes = 0
+        self.ultimo_ms = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'generadas': self.generadas,
+                'sin_imagen': self.sin_imagen,
+                'errores': self.errores,
+                'pendientes': self.pendientes,
+                'ultimo_ms': round(self.ultimo_ms, 2),
+            }
+
+
+metricas_miniaturas = _MetricasMiniaturas()
+registrar_metrica('miniaturas', metricas_miniaturas.snapshot)
+
+# Un hilo: los trabajos se hacen de a uno y el pool solo recibe uno a la vez
+_coordinador = ThreadPoolExecutor(max_workers=1, thread_name_prefix='miniaturas')
+_pool = None
+_pid_pool = None
+_pool_lock = threading.Lock()
+
+
+def _obtener_pool(workers):
+    """Pool del proceso actual (gunicorn hace fork: cada worker crea el suyo)."""
+    global _pool, _pid_pool
+    with _pool_lock:
+        if _pool is None or _pid_pool != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pid_pool = os.getpid()
+        return _pool
+
+
+def _generar_en_pool(ruta, tipo_mime, workers, timeout):
+    global _pool
+    if workers <= 0:
+        return generar(ruta, tipo_mime)
+    try:
+        return _obtener_pool(workers).submit(generar, ruta, tipo_mime).result(timeout=timeout)
+    except BrokenProcessPool:
+        # Un proceso murió (p. ej. sin memoria con una imagen enorme): el próximo crea otro pool
+        with _pool_lock:
+            _pool = None
+        raise
+
+
+def generar_miniaturas(destino, clave, tipo_mime, workers=0, timeout=120):
+    """Genera y guarda las variantes que falten. Devuelve cuántas guardó."""
+    faltan = [v for v in VARIANTES if not destino.existe(clave, sufijo(v))]
+    if not faltan:
+        return 0
+    ruta = destino.ruta_local(clave)
+    temporal = None
+    if ruta is None:
+        # Backend remoto: se baja el original a un temporal para el pool
+        with destino.abrir(clave) as origen, tempfile.NamedTemporaryFile(delete=False) as temporal:
+            shutil.copyfileobj(origen, temporal)
+        ruta = temporal.name
+    try:
+        variantes = _generar_en_pool(ruta, tipo_mime, workers, timeout)
+    finally:
+        if temporal is not None:
+            os.remove(temporal.name)
+    for variante in faltan:
+        if variante in variantes:
+            destino.guardar_derivado(clave, sufijo(variante), variantes[variante], MIMETYPE)
+    return len(variantes)
+
+
+def _trabajo(app, destino, clave, tipo_mime):
+    inicio = time.perf_counter()
+    try:
+        guardadas = generar_miniaturas(
+            destino, clave, tipo_mime,
+            workers=app.config.get('MINIATURAS_WORKERS', 1),
+            timeout=app.config.get('MINIATURAS_TIMEOUT_S', 120),
+        )
+    except Exception:
+        app.logger.exception('No se pudieron generar las miniaturas de %s', clave)
+        with metricas_miniaturas._lock:
+            metricas_miniaturas.pendientes -= 1
+            metricas_miniaturas.errores += 1
+        return
+    with metricas_miniaturas._lock:
+        metricas_miniaturas.pendientes -= 1
+        if guardadas:
+            metricas_miniaturas.generadas += 1
+        else:
+            metricas_miniaturas.sin_imagen += 1
+        metricas_miniaturas.ultimo_ms = (time.perf_counter() - inicio) * 1000
+
+
+def encolar_miniaturas(clave, tipo_mime):
+    """Programa las miniaturas del contenido en segundo plano (si es imagen o PDF)."""
+    if not admite(tipo_mime):
+        return False
+    with metricas_miniaturas._lock:
+        metricas_miniaturas.pendientes += 1
+    _coordinador.submit(_trabajo, current_app._get_current_object(), almacen(), clave, tipo_mime)
+    return True
@@ -0,0 +1,58 @@
+import sqlite3
+
+from sqlalchemy import event
+
+from app.extensions import db
+
+
+def _aplicar_pragmas(dbapi_connection, pragmas):
+    pragmas = dict(pragmas)
+    journal_mode = pragmas.pop('journal_mode', None)
+    cursor = dbapi_connection.cursor()
+    try:
+        # busy_timeout primero para que los demás PRAGMA esperen si hay bloqueo
+        if pragmas.get('busy_timeout') is not None:
+            cursor.execute(f"PRAGMA busy_timeout={pragmas.pop('busy_timeout')}")
+
+        if journal_mode:
+            # journal_mode es persistente en el archivo: solo se cambia si difiere,
+            # porque cambiarlo exige bloqueo exclusivo
+            actual = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            if str(actual).lower() != str(journal_mode).lower():
+                try:
+                    cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+                except sqlite3.OperationalError:
+                    # otro proceso tiene la base ocupada; lo cambiará la próxima conexión
+                    pass
+
+        for nombre, valor in pragmas.items():
+            if valor is None or valor == '':
+                continue
+            cursor.execute(f"PRAGMA {nombre}={valor}")
+    finally:
+        cursor.close()
+
+
+def configurar_motor(app):
+    """Registra los eventos de conexión del motor de la app.
+
+    En SQLite aplica los PRAGMA de la configuración (WAL, busy_timeout, etc.)
+    a cada conexión nueva del pool. En PostgreSQL no hace nada especial.
+    """
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    pragmas = dict(app.config.get('SQLITE_PRAGMAS') or {})
+    if engine.url.database in (None, '', ':memory:'):
+        # WAL y mmap no aplican a bases en memoria
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('mmap_size', None)
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        _aplicar_pragmas(dbapi_connection, pragmas)
+
+    return engine
@@ -0,0 +1,206 @@
+"""Consultas calientes y verificación de su plan de ejecución (SQLite).
+
+Cada entrada arma la sentencia que la aplicación ejecuta en cada carga de
+página o en cada bloque de un proceso en lote. Las de app/utils salen de
+las mismas funciones que usa el código (``consulta_pagina``,
+``consulta_ultima_historia``, ``sentencias_remarcado``...), así que si un
+cambio en ellas deja de usar un índice la verificación lo detecta; las que
+las rutas arman en línea se reproducen aquí con los mismos modelos.
+
+``verificar_planes`` compila cada sentencia en el dialecto de la sesión,
+corre ``EXPLAIN QUERY PLAN`` con sus parámetros (ya convertidos por los
+tipos de SQLAlchemy, igual que al ejecutarla) y reporta las que recorren
+una tabla completa en lugar de usar un índice.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, text
+
+from app.extensions import db
+from app.models import (
+    RegistroEnfermeria, AdministracionMedicamento, Medicamento, HistoriaClinica, OrdenMedica,
+    OrdenLaboratorioItem, SignosVitales, AyudaDiagnostica, CatLaboratorioParametro, LabSolicitud,
+    LabResultado, SolicitudInsumo, InsumoPaciente,
+)
+from app.utils.acumulado_laboratorio import consulta_resultados
+from app.utils.carga_laboratorios import consulta_ultima_historia, consulta_solicitudes_dia
+from app.utils.folio_enfermeria import consulta_bloque
+from app.utils.listado_pacientes import consulta_pagina, consulta_total
+from app.utils.rangos_laboratorio import sentencias_remarcado, consulta_ids_parametro
+
+_FECHA = datetime(2026, 1, 15, 8, 0)
+_CURSOR = (_FECHA, 100)
+
+
+def _pagina_siguiente(session):
+    return consulta_pagina({}, _CURSOR, session=session)
+
+
+def _pagina_anterior(session):
+    return consulta_pagina({}, _CURSOR, retrocede=True, session=session)
+
+
+def _pagina_por_cama(session):
+    return consulta_pagina({'cama': '3'}, _CURSOR, session=session)
+
+
+def _pagina_busqueda(session):
+    return consulta_pagina({'q': 'garcia'}, _CURSOR, session=session)
+
+
+def _remarcado_solicitudes(session):
+    return sentencias_remarcado(LabResultado.solicitud_id.in_([1, 2]))
+
+
+def _remarcado_parametro(session):
+    return sentencias_remarcado(
+        LabResultado.parametro_id == 1, LabResultado.id > 0, LabResultado.id <= 5000,
+    )
+
+
+# nombre -> función(session) que devuelve la sentencia o una tupla de sentencias
+CONSULTAS_CALIENTES = {
+    # app/utils
+    'listado_pacientes_siguiente': _pagina_siguiente,
+    'listado_pacientes_anterior': _pagina_anterior,
+    'listado_pacientes_por_cama': _pagina_por_cama,
+    'listado_pacientes_busqueda': _pagina_busqueda,
+    'listado_pacientes_total': lambda session: consulta_total({}, session),
+    'carga_lab_ultima_historia': lambda session: consulta_ultima_historia([1, 2, 3]),
+    'carga_lab_solicitudes_dia': lambda session: consulta_solicitudes_dia(
+        [1, 2, 3], _FECHA, _FECHA + timedelta(days=1),
+    ),
+    'remarcado_por_solicitudes': _remarcado_solicitudes,
+    'remarcado_por_parametro': _remarcado_parametro,
+    'remarcado_ids_parametro': lambda session: consulta_ids_parametro(1, 0, 5000),
+    'acumulado_laboratorio': lambda session: consulta_resultados(1),
+    'folio_enfermeria_bloque': lambda session: consulta_bloque(1, 0, 200),
+    # Consultas que las rutas arman en línea
+    'registros_por_paciente': lambda session: (
+        select(RegistroEnfermeria).where(RegistroEnfermeria.paciente_id == 1)
+        .order_by(RegistroEnfermeria.fecha_registro.desc())
+    ),
+    'registros_por_historia': lambda session: (
+        select(RegistroEnfermeria.id).where(RegistroEnfermeria.historia_clinica_id == 1)
+    ),
+    'administraciones_por_registro': lambda session: (
+        select(AdministracionMedicamento)
+        .where(AdministracionMedicamento.registro_enfermeria_id.in_([1, 2]),
+               AdministracionMedicamento.cantidad > 0)
+        .order_by(AdministracionMedicamento.hora_administracion.desc())
+    ),
+    'suma_administrada_por_historia': lambda session: (
+        select(func.coalesce(func.sum(AdministracionMedicamento.cantidad), 0))
+        .join(Medicamento, AdministracionMedicamento.medicamento_id == Medicamento.id)
+        .join(RegistroEnfermeria, AdministracionMedicamento.registro_enfermeria_id == RegistroEnfermeria.id)
+        .where(RegistroEnfermeria.historia_clinica_id == 1, Medicamento.codigo == 'X')
+    ),
+    'historias_por_paciente': lambda session: (
+        select(HistoriaClinica).where(HistoriaClinica.paciente_id == 1)
+        .order_by(HistoriaClinica.fecha_registro.desc())
+    ),
+    'ordenes_por_historia': lambda session: select(OrdenMedica).where(OrdenMedica.historia_id == 1),
+    'items_lab_por_orden': lambda session: (
+        select(OrdenLaboratorioItem).where(OrdenLaboratorioItem.orden_id.in_([1, 2]))
+    ),
+    'signos_por_historia': lambda session: select(SignosVitales).where(SignosVitales.historia_id == 1),
+    'ayudas_por_historia': lambda session: (
+        select(AyudaDiagnostica).where(AyudaDiagnostica.historia_id == 1, AyudaDiagnostica.tipo == 'imagen')
+    ),
+    'parametros_por_examen': lambda session: (
+        select(CatLaboratorioParametro).where(CatLaboratorioParametro.examen_id == 1)
+        .order_by(CatLaboratorioParametro.id)
+    ),
+    'solicitudes_lab_por_historia': lambda session: (
+        select(LabSolicitud).where(LabSolicitud.historia_id == 1)
+        .order_by(LabSolicitud.fecha_solicitud.desc())
+    ),
+    'resultado_por_solicitud_parametro': lambda session: (
+        select(LabResultado).where(LabResultado.solicitud_id == 1, LabResultado.parametro_id == 2)
+    ),
+    'solicitudes_insumos_pendientes': lambda session: (
+        select(SolicitudInsumo).where(SolicitudInsumo.paciente_id == 1, SolicitudInsumo.estado == 'pendiente')
+    ),
+    'uso_insumo_por_paciente': lambda session: (
+        select(func.sum(InsumoPaciente.cantidad))
+        .where(InsumoPaciente.paciente_id == 1, InsumoPaciente.insumo_id == 2)
+    ),
+}
+
+
+def es_recorrido_completo(detalle, derivadas=()):
+    """'SCAN tabla' sin índice = recorrido completo de la tabla.
+
+    ``derivadas`` son las subconsultas que el mismo plan arma aparte
+    (CO-ROUTINE / MATERIALIZE): recorrerlas no toca la tabla.
+    """
+    detalle = detalle.upper()
+    if not detalle.startswith('SCAN '):
+        return False
+    if detalle[len('SCAN '):].split(' ', 1)[0] in derivadas:
+        return False
+    if 'VIRTUAL TABLE INDEX' in detalle and ':M' in detalle:
+        # FTS5 resuelve el MATCH con su propio índice
+        return False
+    return 'USING INDEX' not in detalle and 'USING COVERING INDEX' not in detalle \
+        and 'USING INTEGER PRIMARY KEY' not in detalle
+
+
+def _derivadas(plan):
+    return {
+        d.upper().split(' ', 2)[1] for d in plan
+        if d.upper().startswith(('CO-ROUTINE ', 'MATERIALIZE '))
+    }
+
+
+def compilar(sentencia, session=None):
+    """(SQL, parámetros posicionales) de la sentencia tal como la enviaría la sesión.
+
+    Los parámetros quedan ligados en vez de en línea: ``literal_binds`` no
+    llega a todos los operandos (p. ej. el lado derecho de ``IS NOT`` en
+    SQLite) y las listas IN se expanden con ``render_postcompile``.
+    """
+    session = session or db.session
+    compilada = sentencia.compile(
+        dialect=session.get_bind().dialect, compile_kwargs={'render_postcompile': True},
+    )
+    valores = compilada.construct_params()
+    procesadores = compilada._bind_processors
+    parametros = []
+    for nombre in compilada.positiontup:
+        valor = valores[nombre]
+        procesar = procesadores.get(nombre)
+        parametros.append(procesar(valor) if procesar and valor is not None else valor)
+    return str(compilada), tuple(parametros)
+
+
+def plan_de(sentencia, session=None):
+    session = session or db.session
+    if isinstance(sentencia, str):
+        filas = session.execute(text('EXPLAIN QUERY PLAN ' + sentencia)).all()
+    else:
+        sql, parametros = compilar(sentencia, session)
+        filas = session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, parametros).all()
+    # (id, parent, notused, detail)
+    return [fila[-1] for fila in filas]
+
+
+def verificar_planes(consultas=None, session=None):
+    """Devuelve {nombre: [detalles con recorrido completo]} solo de las que fallan."""
+    session = session or db.session
+    if session.get_bind().dialect.name != 'sqlite':
+        return {}
+
+    fallas = {}
+    for nombre, armar in (consultas or CONSULTAS_CALIENTES).items():
+        sentencias = armar(session)
+        if not isinstance(sentencias, tuple):
+            sentencias = (sentencias,)
+        recorridos = []
+        for sentencia in sentencias:
+            plan = plan_de(sentencia, session)
+            derivadas = _derivadas(plan)
+            recorridos += [d for d in plan if es_recorrido_completo(d, derivadas)]
+        if recorridos:
+            fallas[nombre] = recorridos
+    return fallas
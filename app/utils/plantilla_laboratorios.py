@@ -0,0 +1,180 @@
+"""Plantilla Excel de la carga masiva de laboratorios.
+
+El libro se escribe en modo ``write_only`` de openpyxl: las filas pasan
+directo al archivo sin quedarse en memoria, y el formato va en estilos con
+nombre (uno por tipo de celda) en lugar de objetos Font/Border por celda.
+El archivo se arma en un temporal del disco y se envía por bloques.
+
+- Hoja "Examenes": prellenada solo con los pacientes hospitalizados activos
+  (``paciente_activo``, app/utils/listado_pacientes.py), leídos por bloques
+- Hoja "Catalogos": sus filas salen de la caché de catálogos y se guardan
+  por versión del catálogo de laboratorio; solo se recalculan si cambió
+"""
+import tempfile
+import threading
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, Font, PatternFill, Alignment, Border, Side
+from sqlalchemy import select
+
+from app.extensions import db
+from app.models import Paciente
+from app.utils.cache_catalogos import catalogo
+from app.utils.carga_laboratorios import COLUMNAS
+from app.utils.listado_pacientes import paciente_activo
+from app.utils.versiones_catalogo import version_catalogo
+
+MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+COLUMNAS_CATALOGO = (
+    'EXAMEN_ID', 'EXAMEN_NOMBRE', 'GRUPO', 'PARAMETRO_NOMBRE', 'UNIDAD', 'VALOR_REF_MIN', 'VALOR_REF_MAX',
+)
+
+INSTRUCCIONES = (
+    "INSTRUCCIONES DE CARGA MASIVA DE EXÁMENES DE LABORATORIO",
+    "",
+    "1. Hoja \"Examenes\":",
+    "   - La columna NUMERO_PACIENTE ya viene prellenada con los pacientes hospitalizados activos.",
+    "   - NO modifique estos números. Si no va a registrar exámenes para un paciente,",
+    "     simplemente deje su fila en blanco.",
+    "   - Para un paciente que no aparece, agregue su número al final de la hoja.",
+    "",
+    "2. COLUMNAS OBLIGATORIAS POR CADA FILA CON DATOS:",
+    "   - NUMERO_PACIENTE: Ya viene prellenado.",
+    "   - EXAMEN: Nombre exacto del examen en el sistema.",
+    "   - PARAMETRO: Nombre exacto del parámetro del examen.",
+    "   - VALOR: Valor del resultado.",
+    "   - FECHA_RESULTADO: Fecha en formato DD/MM/YYYY.",
+    "   - LABORATORIO: Nombre del laboratorio que realizó el examen.",
+    "",
+    "3. REGLAS:",
+    "   - Puede dejar filas sin exámenes si no va a cargar nada para ese paciente.",
+    "   - No cambie ni elimine los números de pacientes prellenados.",
+    "   - No agregue filas intermedias vacías entre filas que sí tengan datos.",
+    "",
+    "4. HOJA \"Catalogos\":",
+    "   - Contiene la lista de exámenes y parámetros válidos.",
+    "   - Copie y pegue desde allí los valores de EXAMEN y PARAMETRO para evitar errores",
+    "     de escritura.",
+    "",
+    "5. DESPUÉS DE LLENAR:",
+    "   - Guardar el archivo como Excel (.xlsx).",
+    "   - Ir a Módulo Ayudas > Laboratorios > Carga masiva.",
+    "   - Seleccionar este archivo.",
+    "   - Hacer clic en \"Procesar carga masiva\".",
+)
+
+_PACIENTES_POR_BLOQUE = 2000
+
+# (versión del catálogo de laboratorio, filas de la hoja Catalogos)
+_catalogo_filas = (None, ())
+_lock = threading.Lock()
+
+
+def _estilos():
+    borde = Border(*(Side(style='thin'),) * 4)
+    return (
+        NamedStyle(
+            name='plantilla_encabezado',
+            font=Font(bold=True, color='FFFFFF', size=11),
+            fill=PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid'),
+            alignment=Alignment(horizontal='center', vertical='center', wrap_text=True),
+            border=borde,
+        ),
+        NamedStyle(
+            name='plantilla_celda',
+            alignment=Alignment(horizontal='left', vertical='center'),
+            border=borde,
+        ),
+        NamedStyle(name='plantilla_negrita', font=Font(bold=True)),
+        NamedStyle(name='plantilla_titulo', font=Font(bold=True, size=12)),
+    )
+
+
+def filas_catalogo():
+    """Filas de la hoja Catalogos para la versión vigente del catálogo."""
+    global _catalogo_filas
+    version = version_catalogo('laboratorio')
+    guardadas = _catalogo_filas
+    if guardadas[0] == version:
+        return guardadas[1]
+
+    parametros = catalogo('lab_parametros')
+    filas = []
+    for ex in sorted(catalogo('lab_examenes').items, key=lambda e: (e.grupo or '', e.nombre)):
+        del_examen = parametros.grupo(ex.id)
+        if not del_examen:
+            filas.append((ex.id, ex.nombre, ex.grupo or '', None, None, None, None))
+        for p in del_examen:
+            filas.append((ex.id, ex.nombre, ex.grupo or '', p.nombre, p.unidad or '', p.valor_ref_min, p.valor_ref_max))
+    with _lock:
+        _catalogo_filas = (version, tuple(filas))
+    return _catalogo_filas[1]
+
+
+def _fila(hoja, valores, estilo):
+    fila = []
+    for valor in valores:
+        celda = WriteOnlyCell(hoja, value=valor)
+        celda.style = estilo
+        fila.append(celda)
+    return fila
+
+
+def _numeros_activos(session):
+    return session.execute(
+        select(Paciente.numero)
+        .where(paciente_activo())
+        .order_by(Paciente.numero)
+        .execution_options(yield_per=_PACIENTES_POR_BLOQUE)
+    ).scalars()
+
+
+def escribir_plantilla(destino, session=None):
+    """Escribe la plantilla en ``destino`` (ruta o archivo binario)."""
+    session = session or db.session
+    libro = Workbook(write_only=True)
+    for estilo in _estilos():
+        libro.add_named_style(estilo)
+
+    instrucciones = libro.create_sheet('Instrucciones')
+    instrucciones.column_dimensions['A'].width = 90
+    for i, linea in enumerate(INSTRUCCIONES):
+        instrucciones.append(_fila(instrucciones, [linea], 'plantilla_titulo') if i == 0 else [linea])
+
+    examenes = libro.create_sheet('Examenes')
+    for letra, ancho in zip('ABCDEF', (18, 25, 25, 15, 20, 20)):
+        examenes.column_dimensions[letra].width = ancho
+    examenes.append(_fila(examenes, COLUMNAS, 'plantilla_encabezado'))
+    # append() escribe la fila al instante, así que las mismas celdas con
+    # estilo sirven para todos los pacientes: solo cambia el número
+    fila = _fila(examenes, (None,) * len(COLUMNAS), 'plantilla_celda')
+    for numero in _numeros_activos(session):
+        fila[0].value = numero
+        examenes.append(fila)
+
+    catalogos = libro.create_sheet('Catalogos')
+    for letra in 'ABCDEFG':
+        catalogos.column_dimensions[letra].width = 22
+    catalogos.append(_fila(catalogos, COLUMNAS_CATALOGO, 'plantilla_negrita'))
+    for fila in filas_catalogo():
+        catalogos.append(fila)
+
+    libro.save(destino)
+
+
+def plantilla_temporal(session=None):
+    """Plantilla escrita en un archivo temporal, posicionado al inicio.
+
+    ``send_file`` lo envía por bloques y lo cierra (y con eso lo borra) al
+    terminar la respuesta.
+    """
+    temporal = tempfile.TemporaryFile()
+    try:
+        escribir_plantilla(temporal, session)
+    except Exception:
+        temporal.close()
+        raise
+    temporal.seek(0)
+    return temporal
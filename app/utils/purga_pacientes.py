@@ -0,0 +1,139 @@
+"""Borrado de pacientes con todo lo que cuelga de ellos.
+
+Borrar por el ORM carga cada historia, orden y registro en la sesión y
+emite un DELETE por fila; además las tablas sin cascada en los modelos
+(órdenes, laboratorio, administraciones, insumos) quedaban huérfanas.
+``purgar_pacientes`` borra con un ``DELETE ... WHERE ... IN (subconsulta)``
+por tabla, de las hojas hacia ``pacientes``, dentro de la transacción en
+curso: o se borra todo o nada. Quien llama confirma (``confirmar()``) o
+deshace (para simular y solo ver los conteos).
+
+Los índices FTS se mantienen con sus propios triggers de DELETE. Los PDF
+guardados de esas historias se borran al confirmar (ver
+app/utils/versiones_historia.py); los archivos de ayudas diagnósticas y los
+folios de enfermería guardados (que no son de una historia) se borran con
+``borrar_archivos`` y ``borrar_folios`` una vez confirmado.
+"""
+import os
+
+from flask import current_app
+from sqlalchemy import select, delete, update, and_, or_
+
+from app.extensions import db
+from app.models import (
+    Paciente, HistoriaClinica, OrdenMedica, OrdenLaboratorioItem, SignosVitales, Evolucion,
+    Diagnostico, AyudaDiagnostica, LabSolicitud, LabResultado, RegistroEnfermeria,
+    AdministracionMedicamento, SolicitudInsumo, InsumoPaciente,
+)
+from app.utils.almacen_archivos import es_clave, soltar_archivos, borrar_contenidos
+from app.utils.cache_pdf import borrar_pdf
+from app.utils.folio_enfermeria import clave_folio
+from app.utils.versiones_historia import marcar_historias
+
+
+def seleccion_pacientes(ids=(), numero_prefijo=None):
+    """Subconsulta con los ids de paciente a purgar (por id o prefijo de documento)."""
+    consulta = select(Paciente.id)
+    condiciones = []
+    if ids:
+        condiciones.append(Paciente.id.in_(list(ids)))
+    if numero_prefijo:
+        condiciones.append(Paciente.numero.startswith(numero_prefijo, autoescape=True))
+    if not condiciones:
+        raise ValueError('Indique al menos un id o un prefijo de documento')
+    return consulta.where(*condiciones)
+
+
+def purgar_pacientes(pacientes, session=None):
+    """Borra los pacientes de la subconsulta ``pacientes`` y todo lo suyo.
+
+    Devuelve ``(conteos, archivos, paciente_ids)``: filas borradas por tabla,
+    en el orden en que se borraron, los archivos de ayudas que quedaron sin
+    registro (rutas antiguas y claves del almacén por contenido sin
+    referencias) y los pacientes borrados, para ``borrar_archivos`` y
+    ``borrar_folios`` después de confirmar.
+    """
+    session = session or db.session
+    historias = select(HistoriaClinica.id).where(HistoriaClinica.paciente_id.in_(pacientes))
+    ordenes = select(OrdenMedica.id).where(OrdenMedica.historia_id.in_(historias))
+    solicitudes = select(LabSolicitud.id).where(LabSolicitud.historia_id.in_(historias))
+    registros = select(RegistroEnfermeria.id).where(RegistroEnfermeria.paciente_id.in_(pacientes))
+
+    # Antes de borrar: qué PDF invalidar al confirmar y qué archivos quedan sueltos
+    paciente_ids = session.execute(pacientes).scalars().all()
+    marcar_historias(session.execute(historias).scalars().all(), session=session)
+    adjuntos = session.execute(
+        select(AyudaDiagnostica.archivo, AyudaDiagnostica.archivo_id)
+        .where(
+            AyudaDiagnostica.historia_id.in_(historias),
+            or_(AyudaDiagnostica.archivo.isnot(None), AyudaDiagnostica.archivo_id.isnot(None)),
+        )
+    ).all()
+    archivos = [a.archivo for a in adjuntos if a.archivo]
+    # Contenidos del almacén que ya nadie más usa
+    archivos += soltar_archivos([a.archivo_id for a in adjuntos], session=session)
+
+    pasos = [
+        (LabResultado, delete(LabResultado).where(LabResultado.solicitud_id.in_(solicitudes))),
+        (LabSolicitud, delete(LabSolicitud).where(LabSolicitud.historia_id.in_(historias))),
+        (OrdenLaboratorioItem, delete(OrdenLaboratorioItem).where(OrdenLaboratorioItem.orden_id.in_(ordenes))),
+        (OrdenMedica, delete(OrdenMedica).where(OrdenMedica.historia_id.in_(historias))),
+        (SignosVitales, delete(SignosVitales).where(SignosVitales.historia_id.in_(historias))),
+        (Evolucion, delete(Evolucion).where(Evolucion.historia_id.in_(historias))),
+        (Diagnostico, delete(Diagnostico).where(Diagnostico.historia_id.in_(historias))),
+        (AyudaDiagnostica, delete(AyudaDiagnostica).where(AyudaDiagnostica.historia_id.in_(historias))),
+        (AdministracionMedicamento, delete(AdministracionMedicamento).where(
+            AdministracionMedicamento.registro_enfermeria_id.in_(registros)
+        )),
+        (RegistroEnfermeria, delete(RegistroEnfermeria).where(RegistroEnfermeria.paciente_id.in_(pacientes))),
+        (SolicitudInsumo, delete(SolicitudInsumo).where(SolicitudInsumo.paciente_id.in_(pacientes))),
+        (InsumoPaciente, delete(InsumoPaciente).where(InsumoPaciente.paciente_id.in_(pacientes))),
+    ]
+    conteos = {}
+    for modelo, sentencia in pasos:
+        conteos[modelo.__tablename__] = session.execute(
+            sentencia.execution_options(synchronize_session=False)
+        ).rowcount
+
+    # Referencias desde filas de otros pacientes: se sueltan en vez de borrarlas
+    for columna, modelo in (
+        (HistoriaClinica.historia_base_id, HistoriaClinica),
+        (RegistroEnfermeria.historia_clinica_id, RegistroEnfermeria),
+    ):
+        session.execute(
+            update(modelo)
+            .where(and_(columna.in_(historias), modelo.paciente_id.not_in(pacientes)))
+            .values({columna.key: None})
+            .execution_options(synchronize_session=False)
+        )
+
+    conteos[HistoriaClinica.__tablename__] = session.execute(
+        delete(HistoriaClinica).where(HistoriaClinica.paciente_id.in_(pacientes))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    conteos[Paciente.__tablename__] = session.execute(
+        delete(Paciente).where(Paciente.id.in_(pacientes))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return conteos, archivos, paciente_ids
+
+
+def borrar_archivos(archivos):
+    """Borra los archivos de ayudas de una purga ya confirmada."""
+    claves = [a for a in archivos if es_clave(a)]
+    borrados = borrar_contenidos(claves)
+    for archivo in archivos:
+        if es_clave(archivo):
+            continue
+        ruta_abs = os.path.join(current_app.root_path, archivo)
+        try:
+            os.remove(ruta_abs)
+            borrados += 1
+        except OSError:
+            pass
+    return borrados
+
+
+def borrar_folios(paciente_ids):
+    """Borra de la caché de PDF los folios de enfermería de una purga ya confirmada."""
+    return sum(borrar_pdf('enfermeria', clave_folio(paciente_id)) for paciente_id in paciente_ids)
@@ -0,0 +1,190 @@
+"""Banderas de resultados de laboratorio fuera del rango de referencia.
+
+Regla única para todo el sistema: un resultado está fuera de rango si su
+``valor_num`` es menor que ``valor_ref_min`` o mayor que ``valor_ref_max``
+del parámetro. Un límite vacío no marca nada por ese lado; un valor que no
+es número nunca se marca.
+
+``valor_num`` se lee una vez al guardar (evento de ``LabResultado`` en
+app/models.py; la carga masiva lo calcula en bloque), así que las banderas
+se evalúan por conjuntos:
+
+- ``fuera_de_rango``: con NumPy, sobre columnas ya en memoria (carga masiva)
+- ``marcar_rangos``: un UPDATE por solicitud(es) o por parámetro, que solo
+  toca las filas cuya bandera cambia
+- ``encolar_remarcado``: al editar los límites de un parámetro, sus
+  resultados se recalculan en un hilo de fondo por bloques de
+  LAB_REMARCADO_BLOQUE filas, cada bloque en su propia transacción corta
+
+Las historias con banderas cambiadas se marcan (``marcar_historias``) para
+que el informe de laboratorio en PDF se regenere.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import select, update, case, or_
+
+from app.extensions import db
+from app.metricas import registrar_metrica
+from app.models import LabResultado, LabSolicitud, CatLaboratorioParametro
+from app.utils.transacciones import iniciar_escritura, confirmar
+from app.utils.versiones_historia import marcar_historias
+
+
+def valores_numericos(serie):
+    """``valor_num`` de una columna de textos (NaN donde no hay número)."""
+    texto = serie.astype('string').str.strip().str.replace(',', '.', regex=False)
+    numeros = pd.to_numeric(texto, errors='coerce').astype('float64')
+    return numeros.where(np.isfinite(numeros))
+
+
+def fuera_de_rango(valores, minimos, maximos):
+    """Banderas con NumPy; NaN (sin número o sin límite) nunca marca."""
+    valores = np.asarray(valores, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        return (valores < np.asarray(minimos, dtype='float64')) | (valores > np.asarray(maximos, dtype='float64'))
+
+
+def _limite(columna):
+    return (
+        select(columna)
+        .where(CatLaboratorioParametro.id == LabResultado.parametro_id)
+        .correlate(LabResultado)
+        .scalar_subquery()
+    )
+
+
+def _bandera():
+    fuera = or_(
+        LabResultado.valor_num < _limite(CatLaboratorioParametro.valor_ref_min),
+        LabResultado.valor_num > _limite(CatLaboratorioParametro.valor_ref_max),
+    )
+    # Comparar con NULL da NULL: cae en el else
+    return case((fuera, True), else_=False)
+
+
+def sentencias_remarcado(*condiciones):
+    """(historias con banderas por cambiar, UPDATE de esas banderas) para ``condiciones``."""
+    nueva = _bandera()
+    cambia = [*condiciones, LabResultado.flag_fuera_rango.is_distinct_from(nueva)]
+    historias = (
+        select(LabSolicitud.historia_id).distinct()
+        .where(LabSolicitud.id.in_(select(LabResultado.solicitud_id).where(*cambia)))
+    )
+    remarcar = (
+        update(LabResultado).where(*cambia).values(flag_fuera_rango=nueva)
+        .execution_options(synchronize_session=False)
+    )
+    return historias, remarcar
+
+
+def marcar_rangos(*condiciones, session=None):
+    """Recalcula la bandera de los resultados que cumplen ``condiciones``.
+
+    Devuelve cuántas filas cambiaron. No confirma.
+    """
+    session = session or db.session
+    historias_afectadas, remarcar = sentencias_remarcado(*condiciones)
+    iniciar_escritura(session)
+    historias = session.execute(historias_afectadas).scalars().all()
+    if not historias:
+        return 0
+    cambiadas = session.execute(remarcar).rowcount
+    marcar_historias(historias, session=session)
+    return cambiadas
+
+
+def marcar_solicitudes(solicitud_ids, session=None):
+    return marcar_rangos(LabResultado.solicitud_id.in_(list(solicitud_ids)), session=session)
+
+
+class _MetricasRemarcado:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.trabajos = 0
+        self.errores = 0
+        self.filas = 0
+        self.ultimo_ms = 0.0
+        self.pendientes = set()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'trabajos': self.trabajos,
+                'errores': self.errores,
+                'filas_cambiadas': self.filas,
+                'ultimo_ms': round(self.ultimo_ms, 2),
+                'pendientes': sorted(self.pendientes),
+            }
+
+
+metricas_remarcado = _MetricasRemarcado()
+registrar_metrica('remarcado_laboratorio', metricas_remarcado.snapshot)
+
+# Un solo hilo: los trabajos se serializan y no compiten entre sí por el bloqueo de escritura
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='remarcado_lab')
+
+
+def consulta_ids_parametro(parametro_id, ultimo_id, bloque):
+    return (
+        select(LabResultado.id)
+        .where(LabResultado.parametro_id == parametro_id, LabResultado.id > ultimo_id)
+        .order_by(LabResultado.id)
+        .limit(bloque)
+    )
+
+
+def remarcar_parametro(parametro_id, bloque=None, session=None):
+    """Recalcula todos los resultados del parámetro, un bloque de ids por transacción."""
+    session = session or db.session
+    bloque = bloque or current_app.config.get('LAB_REMARCADO_BLOQUE', 5000)
+    cambiadas, ultimo_id = 0, 0
+    while True:
+        ids = session.execute(consulta_ids_parametro(parametro_id, ultimo_id, bloque)).scalars().all()
+        if not ids:
+            break
+        cambiadas += marcar_rangos(
+            LabResultado.parametro_id == parametro_id,
+            LabResultado.id > ultimo_id, LabResultado.id <= ids[-1],
+            session=session,
+        )
+        confirmar(session)
+        ultimo_id = ids[-1]
+    return cambiadas
+
+
+def _trabajo(app, parametro_id):
+    inicio = time.perf_counter()
+    with metricas_remarcado._lock:
+        metricas_remarcado.pendientes.discard(parametro_id)
+    with app.app_context():
+        try:
+            cambiadas = remarcar_parametro(parametro_id)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('No se pudieron recalcular las banderas del parámetro %s', parametro_id)
+            with metricas_remarcado._lock:
+                metricas_remarcado.errores += 1
+            return
+    with metricas_remarcado._lock:
+        metricas_remarcado.trabajos += 1
+        metricas_remarcado.filas += cambiadas
+        metricas_remarcado.ultimo_ms = (time.perf_counter() - inicio) * 1000
+
+
+def encolar_remarcado(parametro_id):
+    """Programa el recálculo de las banderas del parámetro en segundo plano.
+
+    Si ya hay uno pendiente para el mismo parámetro no se agrega otro: al
+    correr leerá los límites vigentes.
+    """
+    with metricas_remarcado._lock:
+        if parametro_id in metricas_remarcado.pendientes:
+            return False
+        metricas_remarcado.pendientes.add(parametro_id)
+    _executor.submit(_trabajo, current_app._get_current_object(), parametro_id)
+    return True
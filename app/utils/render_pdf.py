@@ -0,0 +1,417 @@
+"""Renderizado de PDF fuera de los workers de gunicorn.
+
+WeasyPrint (libro de la historia) y xhtml2pdf (informe de laboratorio)
+consumen segundos de CPU por documento; hechos dentro de la petición
+dejaban a los demás usuarios esperando durante la ronda. Aquí el trabajo
+pesado va a un pool de procesos acotado (PDF_WORKERS) cuyos procesos, al
+arrancar:
+
+- crean una sola ``FontConfiguration`` y cargan Pango/fontconfig con un
+  documento mínimo
+- parsean una vez las hojas ``static/css/pdf_*.css`` (y de nuevo solo si
+  el archivo cambia: su fecha entra en la huella de la caché de PDF)
+- guardan en memoria las imágenes de ``static/img`` (el logo), que las
+  plantillas piden con URL absoluta y antes se descargaban del propio
+  servidor en cada render
+
+Hay dos formas de usarlo:
+
+- ``renderizar``: la petición espera el resultado (rutas PDF de siempre)
+- ``encolar_pdf``: devuelve un trabajo al instante; su estado se consulta en
+  /pdf/trabajos/<id> y el archivo queda en la caché de app/utils/cache_pdf.py
+
+Si hay más de PDF_COLA_MAX documentos pendientes se lanza ``ColaLlena`` en
+vez de seguir acumulando: la app responde 503 y las páginas interactivas no
+se quedan sin CPU. El estado de cada trabajo es un JSON en disco, así lo
+puede consultar cualquier worker de gunicorn.
+"""
+import base64
+import io
+import json
+import mimetypes
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from flask import current_app, url_for, abort
+
+from app.metricas import registrar_metrica
+from app.utils.cache_pdf import (
+    huella_pdf, buscar_pdf, guardar_pdf, directorio_cache, limite_bytes, metricas_pdf,
+)
+
+
+class ColaLlena(Exception):
+    """Hay demasiados PDF pendientes; se debe reintentar más tarde."""
+
+
+class ErrorPDF(Exception):
+    """El motor de PDF no pudo generar el documento."""
+
+
+PROGRESO = {'en_cola': 0, 'renderizando': 50, 'listo': 100, 'error': 100}
+
+_ID_TRABAJO = re.compile(r'[0-9a-f]{32}')
+
+# Campos internos del trabajo que no se muestran al cliente
+_PRIVADOS = ('archivo', 'huella', 'historias', 'entregadas')
+
+
+# Lado del proceso de render
+
+_fuentes = None
+_dir_css = None
+# nombre -> (mtime, CSS parseado)
+_hojas = {}
+_estaticos = {}
+_data_uris = {}
+
+
+def _iniciar_worker(dir_static):
+    """Precarga fuentes, hojas de estilo e imágenes (una vez por proceso)."""
+    global _fuentes, _dir_css
+    from weasyprint import CSS, HTML
+    from weasyprint.text.fonts import FontConfiguration
+    from xhtml2pdf import pisa
+
+    dir_img = os.path.join(dir_static, 'img')
+    for raiz, _, archivos in os.walk(dir_img):
+        for nombre in archivos:
+            ruta = os.path.join(raiz, nombre)
+            relativa = os.path.relpath(ruta, dir_static).replace(os.sep, '/')
+            with open(ruta, 'rb') as archivo:
+                _estaticos[relativa] = archivo.read()
+
+    _fuentes = FontConfiguration()
+    _dir_css = os.path.join(dir_static, 'css')
+    hojas = [
+        _hoja(nombre) for nombre in sorted(os.listdir(_dir_css))
+        if nombre.startswith('pdf_') and nombre.endswith('.css')
+    ]
+
+    # Documentos mínimos: cargan las fuentes y las hojas por defecto de cada motor
+    HTML(string='<p style="font-family: Helvetica, Arial, sans-serif">.</p>').write_pdf(
+        stylesheets=hojas, font_config=_fuentes
+    )
+    pisa.CreatePDF('<p style="font-family: Helvetica">.</p>', dest=io.BytesIO())
+
+
+def _hoja(nombre):
+    """Hoja parseada; se vuelve a parsear si el archivo cambió desde la última vez."""
+    from weasyprint import CSS
+
+    ruta = os.path.join(_dir_css, nombre)
+    modificado = os.path.getmtime(ruta)
+    guardada = _hojas.get(nombre)
+    if guardada is None or guardada[0] != modificado:
+        guardada = _hojas[nombre] = (modificado, CSS(filename=ruta, font_config=_fuentes))
+    return guardada[1]
+
+
+def _estatico(url):
+    """Bytes precargados si la URL apunta a /static/, si no None."""
+    marca = '/static/'
+    if marca not in url:
+        return None
+    return _estaticos.get(url.split(marca, 1)[1].split('?', 1)[0])
+
+
+def _url_fetcher(url, *args, **kwargs):
+    contenido = _estatico(url)
+    if contenido is not None:
+        return {
+            'string': contenido,
+            'mime_type': mimetypes.guess_type(url)[0] or 'application/octet-stream',
+            'redirected_url': url,
+        }
+    from weasyprint import default_url_fetcher
+    return default_url_fetcher(url, *args, **kwargs)
+
+
+def _link_callback(uri, rel):
+    """xhtml2pdf: las imágenes de /static/ salen de memoria como data URI."""
+    if uri in _data_uris:
+        return _data_uris[uri]
+    contenido = _estatico(uri)
+    if contenido is None:
+        return uri
+    tipo = mimetypes.guess_type(uri)[0] or 'application/octet-stream'
+    _data_uris[uri] = f'data:{tipo};base64,' + base64.b64encode(contenido).decode()
+    return _data_uris[uri]
+
+
+def _renderizar(motor, html, hojas=(), archivo_trabajo=None):
+    """Devuelve (bytes del PDF, milisegundos de render)."""
+    if archivo_trabajo:
+        _actualizar_trabajo(archivo_trabajo, estado='renderizando', iniciado=time.time())
+    inicio = time.perf_counter()
+
+    if motor == 'weasyprint':
+        from weasyprint import HTML
+        contenido = HTML(string=html, url_fetcher=_url_fetcher).write_pdf(
+            stylesheets=[_hoja(h) for h in hojas], font_config=_fuentes
+        )
+    elif motor == 'xhtml2pdf':
+        from xhtml2pdf import pisa
+        destino = io.BytesIO()
+        resultado = pisa.CreatePDF(html, dest=destino, link_callback=_link_callback)
+        if resultado.err:
+            raise ErrorPDF(f'xhtml2pdf reportó {resultado.err} errores')
+        contenido = destino.getvalue()
+    else:
+        raise ErrorPDF(f'Motor de PDF desconocido: {motor}')
+
+    return contenido, (time.perf_counter() - inicio) * 1000
+
+
+# Estado de los trabajos (JSON en disco)
+
+def _escribir_json(ruta, datos):
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix='.tmp')
+    with os.fdopen(descriptor, 'w', encoding='utf-8') as archivo:
+        json.dump(datos, archivo)
+    os.replace(temporal, ruta)
+
+
+def _actualizar_trabajo(ruta, **cambios):
+    with open(ruta, encoding='utf-8') as archivo:
+        datos = json.load(archivo)
+    datos.update(cambios)
+    if 'estado' in cambios and 'progreso' not in cambios and cambios['estado'] in PROGRESO:
+        datos['progreso'] = PROGRESO[cambios['estado']]
+    _escribir_json(ruta, datos)
+    return datos
+
+
+def directorio_trabajos():
+    directorio = current_app.config.get('PDF_TRABAJOS_DIR') or os.path.join(
+        current_app.instance_path, 'trabajos_pdf'
+    )
+    os.makedirs(directorio, exist_ok=True)
+    return directorio
+
+
+def _ruta_trabajo(trabajo_id):
+    return os.path.join(directorio_trabajos(), f'{trabajo_id}.json')
+
+
+def leer_trabajo(trabajo_id):
+    """Estado del trabajo, o None si el id no existe (o ya se limpió)."""
+    if not _ID_TRABAJO.fullmatch(trabajo_id or ''):
+        return None
+    try:
+        with open(_ruta_trabajo(trabajo_id), encoding='utf-8') as archivo:
+            return json.load(archivo)
+    except FileNotFoundError:
+        return None
+
+
+def publico(trabajo):
+    """El trabajo sin rutas ni huellas internas, para responder al cliente."""
+    return {k: v for k, v in trabajo.items() if k not in _PRIVADOS}
+
+
+def nuevo_trabajo(tipo, endpoint_archivo='pdf.archivo_trabajo', **datos):
+    """Registra un trabajo en disco y lo devuelve; ``datos`` completa o reemplaza los campos base.
+
+    ``endpoint_archivo`` es la vista que entrega el resultado (recibe ``trabajo_id``).
+    """
+    directorio = directorio_trabajos()
+    _limpiar_trabajos(directorio, current_app.config.get('PDF_TRABAJOS_HORAS', 24))
+
+    trabajo_id = uuid.uuid4().hex
+    trabajo = {
+        'id': trabajo_id,
+        'tipo': tipo,
+        'estado': 'en_cola',
+        'progreso': PROGRESO['en_cola'],
+        'creado': time.time(),
+        'iniciado': None,
+        'terminado': None,
+        'error': None,
+        'url_estado': url_for('pdf.estado_trabajo', trabajo_id=trabajo_id),
+        'url_archivo': url_for(endpoint_archivo, trabajo_id=trabajo_id),
+    }
+    trabajo.update(datos)
+    _escribir_json(_ruta_trabajo(trabajo_id), trabajo)
+    return trabajo
+
+
+def actualizar_trabajo(trabajo_id, **cambios):
+    return _actualizar_trabajo(_ruta_trabajo(trabajo_id), **cambios)
+
+
+def _limpiar_trabajos(directorio, horas):
+    limite = time.time() - horas * 3600
+    for entrada in os.scandir(directorio):
+        if entrada.name.endswith('.json') and entrada.stat().st_mtime < limite:
+            try:
+                os.remove(entrada.path)
+            except FileNotFoundError:
+                pass
+
+
+# Pool
+
+class _MetricasPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.workers = 0
+        self.pendientes = 0
+        self.completados = 0
+        self.errores = 0
+        self.rechazados = 0
+        self.render_ms_total = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pendientes': self.pendientes,
+                'completados': self.completados,
+                'errores': self.errores,
+                'rechazados': self.rechazados,
+                'render_promedio_ms': round(self.render_ms_total / self.completados, 2)
+                if self.completados else 0.0,
+            }
+
+
+metricas_pool = _MetricasPool()
+registrar_metrica('pool_pdf', metricas_pool.snapshot)
+
+_pool = None
+_pid_pool = None
+_pool_lock = threading.Lock()
+
+
+def _obtener_pool():
+    """Pool del proceso actual (gunicorn hace fork: cada worker crea el suyo)."""
+    global _pool, _pid_pool
+    with _pool_lock:
+        if _pool is None or _pid_pool != os.getpid():
+            workers = current_app.config.get('PDF_WORKERS', 2)
+            if workers > 0:
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_iniciar_worker,
+                    initargs=(current_app.static_folder,),
+                )
+            else:
+                # Sin procesos (desarrollo): se renderiza en el mismo hilo
+                _iniciar_worker(current_app.static_folder)
+                _pool = 'en_proceso'
+            _pid_pool = os.getpid()
+            metricas_pool.workers = workers
+        return _pool
+
+
+def _terminado(pool, futuro):
+    global _pool
+    if isinstance(futuro.exception(), BrokenProcessPool):
+        # Un proceso murió (p. ej. sin memoria): el próximo envío crea un pool nuevo
+        with _pool_lock:
+            descartado = _pool is pool
+            if descartado:
+                _pool = None
+        if descartado:
+            # Sin esperar: suelta el hilo administrador y los procesos que sigan vivos
+            pool.shutdown(wait=False, cancel_futures=True)
+    with metricas_pool._lock:
+        metricas_pool.pendientes -= 1
+        if futuro.exception() is not None:
+            metricas_pool.errores += 1
+        else:
+            metricas_pool.completados += 1
+            metricas_pool.render_ms_total += futuro.result()[1]
+
+
+def _enviar(*args):
+    """Manda ``_renderizar(*args)`` al pool respetando PDF_COLA_MAX."""
+    pool = _obtener_pool()
+    with metricas_pool._lock:
+        if metricas_pool.pendientes >= current_app.config.get('PDF_COLA_MAX', 20):
+            metricas_pool.rechazados += 1
+            raise ColaLlena('Hay demasiados PDF en proceso, intente de nuevo en unos segundos.')
+        metricas_pool.pendientes += 1
+
+    if pool == 'en_proceso':
+        futuro = Future()
+        try:
+            futuro.set_result(_renderizar(*args))
+        except Exception as e:
+            futuro.set_exception(e)
+    else:
+        futuro = pool.submit(_renderizar, *args)
+    futuro.add_done_callback(partial(_terminado, pool))
+    return futuro
+
+
+def enviar(motor, html, hojas=()):
+    """Manda el HTML al pool; el futuro entrega (bytes del PDF, ms de render)."""
+    return _enviar(motor, html, tuple(hojas))
+
+
+def renderizar(motor, html, hojas=()):
+    """Genera el PDF en el pool y espera el resultado (bytes)."""
+    futuro = _enviar(motor, html, tuple(hojas))
+    contenido, _ = futuro.result(timeout=current_app.config.get('PDF_TIMEOUT_S', 120))
+    return contenido
+
+
+def _al_terminar(ruta_trabajo, tipo, historia_id, huella, directorio, max_bytes, futuro):
+    # Corre en el hilo del pool: una excepción aquí se perdería y el trabajo
+    # quedaría "renderizando" para siempre
+    try:
+        error = futuro.exception()
+        if error is not None:
+            raise error
+        contenido, ms = futuro.result()
+        metricas_pdf.render(ms)
+        archivo = guardar_pdf(tipo, historia_id, huella, contenido, directorio, max_bytes)
+        _actualizar_trabajo(ruta_trabajo, estado='listo', archivo=archivo, terminado=time.time())
+    except Exception as e:
+        try:
+            _actualizar_trabajo(ruta_trabajo, estado='error', error=str(e), terminado=time.time())
+        except OSError:
+            # El trabajo ya se limpió del disco
+            pass
+
+
+def encolar_pdf(tipo, historia_id, plantilla, generar_html, nombre_descarga,
+                motor='weasyprint', hojas=(), catalogos=()):
+    """Crea un trabajo para el PDF de la historia y devuelve su estado público.
+
+    ``generar_html()`` corre aquí (necesita la base y el contexto de la
+    app); solo el paso a PDF va al pool. Si la caché ya tiene la versión
+    vigente el trabajo nace terminado.
+    """
+    huella = huella_pdf(historia_id, plantilla, catalogos, hojas)
+    if huella is None:
+        abort(404)
+
+    datos = {'historia_id': historia_id, 'huella': huella, 'nombre_descarga': nombre_descarga, 'archivo': None}
+    archivo = buscar_pdf(tipo, historia_id, huella)
+    if archivo is not None:
+        datos.update(estado='listo', progreso=PROGRESO['listo'], archivo=archivo, terminado=time.time())
+        return publico(nuevo_trabajo(tipo, **datos))
+
+    html = generar_html()
+    trabajo = nuevo_trabajo(tipo, **datos)
+    ruta = _ruta_trabajo(trabajo['id'])
+    try:
+        futuro = _enviar(motor, html, tuple(hojas), ruta)
+    except ColaLlena:
+        os.remove(ruta)
+        raise
+    futuro.add_done_callback(partial(
+        _al_terminar, ruta, tipo, historia_id, huella, directorio_cache(), limite_bytes(),
+    ))
+    return publico(leer_trabajo(trabajo['id']))
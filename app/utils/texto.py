@@ -0,0 +1,29 @@
+import math
+import re
+import unicodedata
+
+_ESPACIOS = re.compile(r'\s+')
+
+
+def normalizar_texto(valor):
+    """Minúsculas, sin tildes/diéresis y con espacios simples ('Pérez  Ñuñez' -> 'perez nunez')."""
+    if not valor:
+        return ''
+    descompuesto = unicodedata.normalize('NFKD', str(valor))
+    sin_marcas = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return _ESPACIOS.sub(' ', sin_marcas).strip().lower()
+
+
+def tokens(valor):
+    return [t for t in normalizar_texto(valor).split(' ') if t]
+
+
+def valor_numerico(valor):
+    """Número de un resultado escrito a mano ('4,5' -> 4.5); None si no es un número."""
+    if valor is None:
+        return None
+    try:
+        numero = float(str(valor).strip().replace(',', '.'))
+    except ValueError:
+        return None
+    return numero if math.isfinite(numero) else None
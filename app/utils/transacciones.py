@@ -0,0 +1,155 @@
+"""Capa de confirmación (commit) común para todos los blueprints.
+
+En SQLite las escrituras toman el bloqueo con ``BEGIN IMMEDIATE`` antes de
+hacer flush, así un lector no intenta "subir" a escritor a mitad de la
+transacción. Si la base está ocupada se reintenta con backoff exponencial
+y jitter; como todavía no se ha escrito nada, reintentar no pierde datos.
+"""
+import random
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy.exc import OperationalError, DBAPIError
+
+from app.extensions import db
+from app.metricas import registrar_metrica
+
+# SQLSTATE de PostgreSQL: serialization_failure, deadlock_detected, lock_not_available
+_PG_CODIGOS_BLOQUEO = {'40001', '40P01', '55P03'}
+
+
+class BaseDatosOcupada(Exception):
+    """La base de datos siguió bloqueada después de todos los reintentos."""
+
+
+class _MetricasBloqueo:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.escrituras = 0
+        self.reintentos = 0
+        self.fallos = 0
+        self.espera_total_ms = 0.0
+        self.espera_max_ms = 0.0
+        # límites superiores en ms de cada balde del histograma
+        self.histograma = {10: 0, 50: 0, 250: 0, 1000: 0, 5000: 0, 'inf': 0}
+
+    def registrar(self, espera_ms, reintentos, fallo=False):
+        with self._lock:
+            self.escrituras += 1
+            self.reintentos += reintentos
+            self.fallos += 1 if fallo else 0
+            self.espera_total_ms += espera_ms
+            self.espera_max_ms = max(self.espera_max_ms, espera_ms)
+            for limite in self.histograma:
+                if limite == 'inf' or espera_ms <= limite:
+                    self.histograma[limite] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            promedio = self.espera_total_ms / self.escrituras if self.escrituras else 0.0
+            return {
+                'escrituras': self.escrituras,
+                'reintentos': self.reintentos,
+                'fallos': self.fallos,
+                'espera_total_ms': round(self.espera_total_ms, 2),
+                'espera_promedio_ms': round(promedio, 2),
+                'espera_max_ms': round(self.espera_max_ms, 2),
+                'histograma_ms': {str(k): v for k, v in self.histograma.items()},
+            }
+
+
+metricas_bloqueo = _MetricasBloqueo()
+registrar_metrica('bloqueos_bd', metricas_bloqueo.snapshot)
+
+
+def es_error_bloqueo(exc):
+    """True si la excepción corresponde a contención de bloqueos."""
+    if not isinstance(exc, DBAPIError):
+        return False
+    orig = getattr(exc, 'orig', None)
+    codigo = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if codigo in _PG_CODIGOS_BLOQUEO:
+        return True
+    mensaje = str(orig or exc).lower()
+    return 'database is locked' in mensaje or 'database is busy' in mensaje
+
+
+def _config(nombre, defecto):
+    if has_app_context():
+        return current_app.config.get(nombre, defecto)
+    return defecto
+
+
+def _espera_backoff(intento):
+    base = _config('DB_LOCK_BACKOFF_BASE_MS', 50) / 1000
+    tope = _config('DB_LOCK_BACKOFF_MAX_MS', 2000) / 1000
+    # "full jitter": espera aleatoria entre 0 y el tope exponencial
+    return random.uniform(0, min(tope, base * (2 ** intento)))
+
+
+def iniciar_escritura(session=None):
+    """Abre la transacción de escritura con BEGIN IMMEDIATE (solo SQLite).
+
+    No hace nada si la transacción ya escribió (el bloqueo ya se tiene) o si
+    el backend no es SQLite. Reintenta con backoff si la base está ocupada.
+    """
+    session = session or db.session
+    conexion = session.connection()
+    if conexion.dialect.name != 'sqlite':
+        return
+
+    dbapi_conn = conexion.connection.dbapi_connection
+    if getattr(dbapi_conn, 'in_transaction', False):
+        return
+
+    max_intentos = _config('DB_LOCK_REINTENTOS', 4)
+    inicio = time.perf_counter()
+    intento = 0
+    while True:
+        try:
+            conexion.exec_driver_sql('BEGIN IMMEDIATE')
+            break
+        except OperationalError as exc:
+            if not es_error_bloqueo(exc) or intento + 1 >= max_intentos:
+                espera = (time.perf_counter() - inicio) * 1000
+                metricas_bloqueo.registrar(espera, intento, fallo=True)
+                if es_error_bloqueo(exc):
+                    raise BaseDatosOcupada(
+                        'La base de datos está ocupada, intente de nuevo en unos segundos.'
+                    ) from exc
+                raise
+            time.sleep(_espera_backoff(intento))
+            intento += 1
+
+    espera = (time.perf_counter() - inicio) * 1000
+    metricas_bloqueo.registrar(espera, intento)
+
+
+def confirmar(session=None):
+    """Reemplazo de ``db.session.commit()`` para las rutas.
+
+    Toma el bloqueo de escritura antes del flush y luego confirma. Ante un
+    error de bloqueo que no se pudo evitar hace rollback y lanza
+    ``BaseDatosOcupada``.
+    """
+    session = session or db.session
+    try:
+        if session.new or session.dirty or session.deleted:
+            iniciar_escritura(session)
+        session.commit()
+    except BaseDatosOcupada:
+        session.rollback()
+        raise
+    except DBAPIError as exc:
+        session.rollback()
+        if es_error_bloqueo(exc):
+            metricas_bloqueo.registrar(0.0, 0, fallo=True)
+            raise BaseDatosOcupada(
+                'La base de datos está ocupada, intente de nuevo en unos segundos.'
+            ) from exc
+        raise
@@ -0,0 +1,65 @@
+"""Versiones de los catálogos, compartidas por todos los procesos.
+
+Cada catálogo (cie10, medicamentos, ...) tiene una fila en
+``catalogo_versiones``. Las rutas que modifican un catálogo llaman a
+``incrementar_version`` antes de confirmar; los índices y cachés en memoria
+comparan su versión con ``version_catalogo`` y se reconstruyen si cambió.
+La lectura se guarda unos instantes (CATALOGO_VERSION_TTL_MS) para no ir a
+la base en cada tecla del autocompletado.
+"""
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import select, update
+
+from app.extensions import db
+from app.models import CatalogoVersion
+from app.utils.fechas import ahora_bogota
+from app.utils.transacciones import iniciar_escritura
+
+_lock = threading.Lock()
+# nombre -> (version, instante de la lectura)
+_leidas = {}
+
+
+def _ttl_segundos():
+    if has_app_context():
+        return current_app.config.get('CATALOGO_VERSION_TTL_MS', 1000) / 1000
+    return 1.0
+
+
+def version_catalogo(nombre, session=None):
+    """Versión vigente del catálogo ``nombre`` (0 si nunca se ha modificado)."""
+    ahora = time.monotonic()
+    leida = _leidas.get(nombre)
+    if leida is not None and ahora - leida[1] < _ttl_segundos():
+        return leida[0]
+
+    session = session or db.session
+    version = session.execute(
+        select(CatalogoVersion.version).where(CatalogoVersion.nombre == nombre)
+    ).scalar() or 0
+    with _lock:
+        _leidas[nombre] = (version, ahora)
+    return version
+
+
+def incrementar_version(nombre, session=None):
+    """Sube la versión del catálogo dentro de la transacción en curso.
+
+    No confirma: quien llama hace ``confirmar()`` junto con el cambio del
+    catálogo, así la versión nueva solo se ve si el cambio se guardó.
+    """
+    session = session or db.session
+    iniciar_escritura(session)
+    resultado = session.execute(
+        update(CatalogoVersion)
+        .where(CatalogoVersion.nombre == nombre)
+        .values(version=CatalogoVersion.version + 1, actualizado=ahora_bogota())
+    )
+    if resultado.rowcount == 0:
+        session.add(CatalogoVersion(nombre=nombre, version=1))
+
+    with _lock:
+        _leidas.pop(nombre, None)
@@ -0,0 +1,175 @@
+"""Versión de contenido por historia clínica.
+
+``historias_clinicas.version_contenido`` sube en la misma transacción cada
+vez que el ORM escribe algo que se ve en la historia impresa: la historia,
+sus órdenes médicas, los exámenes de cada orden, los signos vitales, las
+solicitudes y resultados de laboratorio o los datos del paciente. Las
+cachés derivadas (PDF, ver app/utils/cache_pdf.py) usan la versión como
+parte de la clave, así que nunca sirven contenido viejo aunque otro
+proceso haya hecho el cambio.
+
+De la misma forma ``pacientes.version_enfermeria`` sube con los registros
+de enfermería del paciente, sus administraciones de medicamentos y sus
+insumos (solicitados o usados); es la versión del folio de enfermería.
+Va aparte para que cada registro del turno no invalide la historia impresa.
+
+Los ``query(...).update()``/``delete()`` masivos no pasan por aquí; quien
+los use sobre estas tablas debe llamar a ``marcar_historias`` o
+``marcar_enfermeria``.
+"""
+from sqlalchemy import event, select, update
+
+from app.extensions import db
+from app.models import (
+    HistoriaClinica, OrdenMedica, OrdenLaboratorioItem, SignosVitales, Paciente,
+    LabSolicitud, LabResultado, RegistroEnfermeria, AdministracionMedicamento,
+    SolicitudInsumo, InsumoPaciente,
+)
+
+_CLAVE = 'historias_modificadas'
+
+# funciones que reciben el conjunto de ids de historia cuando se confirma
+_suscriptores = []
+
+
+def suscribir(funcion):
+    """Registra ``funcion(historia_ids)``; se llama después de cada commit que las modifica."""
+    _suscriptores.append(funcion)
+    return funcion
+
+
+def version_historia(historia_id, session=None):
+    """Versión de contenido vigente (None si la historia no existe)."""
+    session = session or db.session
+    return session.execute(
+        select(HistoriaClinica.version_contenido).where(HistoriaClinica.id == historia_id)
+    ).scalar()
+
+
+def marcar_historias(historia_ids, session=None):
+    """Sube la versión de ``historia_ids`` dentro de la transacción en curso."""
+    session = session or db.session
+    ids = {i for i in historia_ids if i is not None}
+    if not ids:
+        return
+    session.execute(
+        update(HistoriaClinica)
+        .where(HistoriaClinica.id.in_(ids))
+        .values(version_contenido=HistoriaClinica.version_contenido + 1)
+        .execution_options(synchronize_session=False)
+    )
+    session.info.setdefault(_CLAVE, set()).update(ids)
+
+
+def version_enfermeria(paciente_id, session=None):
+    """Versión vigente del folio de enfermería (None si el paciente no existe)."""
+    session = session or db.session
+    return session.execute(
+        select(Paciente.version_enfermeria).where(Paciente.id == paciente_id)
+    ).scalar()
+
+
+def marcar_enfermeria(paciente_ids, session=None):
+    """Sube la versión de enfermería de ``paciente_ids`` dentro de la transacción en curso."""
+    session = session or db.session
+    ids = {i for i in paciente_ids if i is not None}
+    if not ids:
+        return
+    session.execute(
+        update(Paciente)
+        .where(Paciente.id.in_(ids))
+        .values(version_enfermeria=Paciente.version_enfermeria + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _paciente_enfermeria_de(obj):
+    """Paciente cuyo folio de enfermería cambia con un objeto del flush."""
+    if isinstance(obj, (RegistroEnfermeria, SolicitudInsumo, InsumoPaciente)):
+        if obj.paciente_id is not None:
+            return obj.paciente_id
+        return obj.paciente.id if obj.paciente is not None else None
+    if isinstance(obj, AdministracionMedicamento):
+        registro = obj.registro
+        return registro.paciente_id if registro is not None else None
+    if isinstance(obj, Paciente):
+        return obj.id
+    return None
+
+
+def _historia_de(obj):
+    """(historia_id, paciente_id) afectados por un objeto del flush."""
+    if isinstance(obj, HistoriaClinica):
+        return obj.id, None
+    if isinstance(obj, (OrdenMedica, SignosVitales, LabSolicitud)):
+        if obj.historia_id is not None:
+            return obj.historia_id, None
+        historia = obj.historia_clinica if isinstance(obj, SignosVitales) else obj.historia
+        return (historia.id if historia is not None else None), None
+    if isinstance(obj, OrdenLaboratorioItem):
+        orden = obj.orden
+        return (orden.historia_id if orden is not None else None), None
+    if isinstance(obj, LabResultado):
+        solicitud = obj.solicitud
+        return (solicitud.historia_id if solicitud is not None else None), None
+    if isinstance(obj, Paciente):
+        return None, obj.id
+    return None, None
+
+
+@event.listens_for(db.session, 'before_flush')
+def _recolectar(session, flush_context, instances):
+    historias, pacientes, enfermeria = set(), set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        historia_id, paciente_id = _historia_de(obj)
+        if historia_id is not None:
+            historias.add(historia_id)
+        if paciente_id is not None:
+            pacientes.add(paciente_id)
+        paciente_enfermeria = _paciente_enfermeria_de(obj)
+        if paciente_enfermeria is not None:
+            enfermeria.add(paciente_enfermeria)
+    if historias or pacientes or enfermeria:
+        session.info['_pendientes_version'] = (historias, pacientes, enfermeria)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _subir_versiones(session, flush_context):
+    pendientes = session.info.pop('_pendientes_version', None)
+    if not pendientes:
+        return
+    historias, pacientes, enfermeria = pendientes
+    conexion = session.connection()
+    if enfermeria:
+        conexion.execute(
+            update(Paciente.__table__)
+            .where(Paciente.__table__.c.id.in_(enfermeria))
+            .values(version_enfermeria=Paciente.__table__.c.version_enfermeria + 1)
+        )
+    if pacientes:
+        historias |= set(conexion.execute(
+            select(HistoriaClinica.id).where(HistoriaClinica.paciente_id.in_(pacientes))
+        ).scalars())
+    if historias:
+        conexion.execute(
+            update(HistoriaClinica.__table__)
+            .where(HistoriaClinica.__table__.c.id.in_(historias))
+            .values(version_contenido=HistoriaClinica.__table__.c.version_contenido + 1)
+        )
+        session.info.setdefault(_CLAVE, set()).update(historias)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _avisar(session):
+    historias = session.info.pop(_CLAVE, None)
+    if historias:
+        for funcion in _suscriptores:
+            funcion(historias)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar(session):
+    session.info.pop(_CLAVE, None)
+    session.info.pop('_pendientes_version', None)
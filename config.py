@@ -1,6 +1,164 @@
 import os
 
+
+def _env_bool(nombre, defecto=False):
+    valor = os.getenv(nombre)
+    if valor is None:
+        return defecto
+    return valor.strip().lower() in ('1', 'true', 'si', 'sí', 'yes', 'on')
+
+
+def _env_int(nombre, defecto):
+    valor = os.getenv(nombre)
+    if valor is None or not valor.strip():
+        return defecto
+    return int(valor)
+
+
+def _normalizar_uri(uri):
+    """Acepta el esquema 'postgres://' que entregan algunos proveedores."""
+    if uri and uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def es_sqlite(uri):
+    return (uri or '').startswith('sqlite')
+
+
 class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'una_clave_muy_segura_12345')
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///historia_clinica.db'
+    SQLALCHEMY_DATABASE_URI = _normalizar_uri(
+        os.getenv('DATABASE_URL', 'sqlite:///historia_clinica.db')
+    )
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = _env_bool('SQLALCHEMY_ECHO')
+
+    # Pool de conexiones (aplica a PostgreSQL y a SQLite en archivo)
+    DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 10)
+    DB_POOL_TIMEOUT = _env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = _env_int('DB_POOL_RECYCLE', 1800)
+
+    # Reintentos ante "database is locked" (ver app/utils/transacciones.py)
+    DB_LOCK_REINTENTOS = _env_int('DB_LOCK_REINTENTOS', 4)
+    DB_LOCK_BACKOFF_BASE_MS = _env_int('DB_LOCK_BACKOFF_BASE_MS', 50)
+    DB_LOCK_BACKOFF_MAX_MS = _env_int('DB_LOCK_BACKOFF_MAX_MS', 2000)
+
+    # Cada cuánto un proceso vuelve a leer catalogo_versiones (ver app/utils/versiones_catalogo.py)
+    CATALOGO_VERSION_TTL_MS = _env_int('CATALOGO_VERSION_TTL_MS', 1000)
+
+    # Caché en disco de los PDF de historias (ver app/utils/cache_pdf.py); sin
+    # directorio se usa instance/cache_pdf
+    PDF_CACHE_DIR = os.getenv('PDF_CACHE_DIR')
+    PDF_CACHE_MAX_MB = _env_int('PDF_CACHE_MAX_MB', 512)
+
+    # Pool de procesos para renderizar PDF (ver app/utils/render_pdf.py); 0 = en el mismo hilo
+    PDF_WORKERS = _env_int('PDF_WORKERS', 2)
+    PDF_COLA_MAX = _env_int('PDF_COLA_MAX', 20)
+    PDF_TIMEOUT_S = _env_int('PDF_TIMEOUT_S', 120)
+    PDF_TRABAJOS_DIR = os.getenv('PDF_TRABAJOS_DIR')
+    PDF_TRABAJOS_HORAS = _env_int('PDF_TRABAJOS_HORAS', 24)
+    # Exportación masiva en ZIP (ver app/utils/exportacion_pdf.py)
+    PDF_LOTE_MAX = _env_int('PDF_LOTE_MAX', 1000)
+    PDF_LOTE_PARALELO = _env_int('PDF_LOTE_PARALELO', 2)
+    # Registros de enfermería por bloque del folio en PDF (ver app/utils/folio_enfermeria.py)
+    PDF_FOLIO_BLOQUE = _env_int('PDF_FOLIO_BLOQUE', 200)
+
+    # Segundos que se reutiliza el total aproximado del listado de pacientes (ver app/utils/listado_pacientes.py)
+    PACIENTES_TOTAL_TTL_S = _env_int('PACIENTES_TOTAL_TTL_S', 120)
+
+    # Resultados por transacción al recalcular banderas tras editar un rango (ver app/utils/rangos_laboratorio.py)
+    LAB_REMARCADO_BLOQUE = _env_int('LAB_REMARCADO_BLOQUE', 5000)
+    # Historias cuyo acumulado de laboratorio se guarda en memoria (ver app/utils/acumulado_laboratorio.py)
+    LAB_ACUMULADO_CACHE = _env_int('LAB_ACUMULADO_CACHE', 128)
+    # Ingesta de exportes CSV de analizadores (ver app/utils/ingesta_laboratorios.py); sin
+    # directorio se usa instance/ingesta_laboratorios
+    LAB_INGESTA_DIR = os.getenv('LAB_INGESTA_DIR')
+    LAB_INGESTA_INTERVALO_S = _env_int('LAB_INGESTA_INTERVALO_S', 10)
+    LAB_INGESTA_ESPERA_S = _env_int('LAB_INGESTA_ESPERA_S', 5)
+    LAB_INGESTA_BLOQUE = _env_int('LAB_INGESTA_BLOQUE', 5000)
+    LAB_INGESTA_INTENTOS = _env_int('LAB_INGESTA_INTENTOS', 3)
+
+    # Almacén por contenido de los archivos de ayudas (ver app/utils/almacen_archivos.py):
+    # 'local' (ARCHIVOS_DIR, por defecto instance/archivos_ayudas) o 's3'
+    ARCHIVOS_BACKEND = os.getenv('ARCHIVOS_BACKEND', 'local')
+    ARCHIVOS_DIR = os.getenv('ARCHIVOS_DIR')
+    ARCHIVOS_S3_BUCKET = os.getenv('ARCHIVOS_S3_BUCKET')
+    ARCHIVOS_S3_PREFIJO = os.getenv('ARCHIVOS_S3_PREFIJO', 'ayudas/')
+    ARCHIVOS_S3_ENDPOINT = os.getenv('ARCHIVOS_S3_ENDPOINT')
+    ARCHIVOS_BLOQUE_KB = _env_int('ARCHIVOS_BLOQUE_KB', 1024)
+    # Envío de archivos (ver app/utils/envio_archivos.py): 'app', 'x-accel' (nginx) o 'x-sendfile'
+    ARCHIVOS_ENVIO = os.getenv('ARCHIVOS_ENVIO', 'app')
+    ARCHIVOS_ACCEL_PREFIJO = os.getenv('ARCHIVOS_ACCEL_PREFIJO', '/_archivos_ayudas/')
+    ARCHIVOS_URL_FIRMADA_S = _env_int('ARCHIVOS_URL_FIRMADA_S', 300)
+    # Miniaturas y vistas previas de estudios (ver app/utils/miniaturas.py); 0 workers = en el hilo de fondo
+    MINIATURAS_WORKERS = _env_int('MINIATURAS_WORKERS', 1)
+    MINIATURAS_TIMEOUT_S = _env_int('MINIATURAS_TIMEOUT_S', 120)
+    MINIATURAS_CACHE_S = _env_int('MINIATURAS_CACHE_S', 31536000)
+
+    # PRAGMAs que se aplican a cada conexión SQLite nueva
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        # valor negativo = KiB (64 MB por conexión)
+        'cache_size': _env_int('SQLITE_CACHE_SIZE', -64000),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 268435456),
+        'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+    }
+
+    @classmethod
+    def opciones_motor(cls, uri):
+        """Construye SQLALCHEMY_ENGINE_OPTIONS según el backend configurado."""
+        opciones = {'pool_pre_ping': True}
+
+        if es_sqlite(uri):
+            # SQLite en memoria usa un pool de un solo hilo: no admite tamaño
+            if ':memory:' in uri or uri.rstrip('/') in ('sqlite:', 'sqlite:/'):
+                return opciones
+            opciones['connect_args'] = {
+                'timeout': cls.SQLITE_PRAGMAS['busy_timeout'] / 1000,
+            }
+
+        opciones.update({
+            'pool_size': cls.DB_POOL_SIZE,
+            'max_overflow': cls.DB_MAX_OVERFLOW,
+            'pool_timeout': cls.DB_POOL_TIMEOUT,
+            'pool_recycle': cls.DB_POOL_RECYCLE,
+        })
+        return opciones
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # TEST_DATABASE_URL permite correr las pruebas contra PostgreSQL
+    SQLALCHEMY_DATABASE_URI = _normalizar_uri(
+        os.getenv('TEST_DATABASE_URL', 'sqlite:///:memory:')
+    )
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+    SESSION_COOKIE_SECURE = _env_bool('SESSION_COOKIE_SECURE', True)
+    DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 20)
+
+
+config_por_entorno = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+    'default': DevelopmentConfig,
+}
+
+
+def obtener_config(nombre=None):
+    """Devuelve la clase de configuración según APP_ENV (o el nombre dado)."""
+    nombre = (nombre or os.getenv('APP_ENV') or os.getenv('FLASK_ENV') or 'default').lower()
+    return config_por_entorno.get(nombre, DevelopmentConfig)
@@ -0,0 +1,98 @@
+"""busqueda normalizada de pacientes (nombre_normalizado + indice trigram)
+
+Revision ID: 3f9b0d6e8a21
+Revises: 7c1e5a9d2f40
+Create Date: 2026-10-19 10:03:17.552031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.utils.texto import normalizar_texto
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9b0d6e8a21'
+down_revision = '7c1e5a9d2f40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('pacientes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('nombre_normalizado', sa.String(length=150), nullable=True))
+        batch_op.create_index(batch_op.f('ix_pacientes_nombre_normalizado'), ['nombre_normalizado'], unique=False)
+
+    # Rellenar la columna para los pacientes existentes
+    bind = op.get_bind()
+    pacientes = sa.table(
+        'pacientes',
+        sa.column('id', sa.Integer),
+        sa.column('nombre', sa.String),
+        sa.column('nombre_normalizado', sa.String),
+    )
+    filas = bind.execute(sa.select(pacientes.c.id, pacientes.c.nombre)).all()
+    if filas:
+        bind.execute(
+            pacientes.update()
+            .where(pacientes.c.id == sa.bindparam('_id'))
+            .values(nombre_normalizado=sa.bindparam('_nombre')),
+            [{'_id': f.id, '_nombre': normalizar_texto(f.nombre)} for f in filas],
+        )
+
+    if bind.dialect.name == 'sqlite':
+        # Índice FTS5 trigram (subcadenas) con contenido externo sobre pacientes
+        op.execute("""
+            CREATE VIRTUAL TABLE pacientes_fts USING fts5(
+                nombre_normalizado, numero,
+                content='pacientes', content_rowid='id', tokenize='trigram'
+            )
+        """)
+        op.execute("""
+            CREATE TRIGGER pacientes_fts_ai AFTER INSERT ON pacientes BEGIN
+                INSERT INTO pacientes_fts(rowid, nombre_normalizado, numero)
+                VALUES (new.id, new.nombre_normalizado, new.numero);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER pacientes_fts_ad AFTER DELETE ON pacientes BEGIN
+                INSERT INTO pacientes_fts(pacientes_fts, rowid, nombre_normalizado, numero)
+                VALUES ('delete', old.id, old.nombre_normalizado, old.numero);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER pacientes_fts_au AFTER UPDATE ON pacientes BEGIN
+                INSERT INTO pacientes_fts(pacientes_fts, rowid, nombre_normalizado, numero)
+                VALUES ('delete', old.id, old.nombre_normalizado, old.numero);
+                INSERT INTO pacientes_fts(rowid, nombre_normalizado, numero)
+                VALUES (new.id, new.nombre_normalizado, new.numero);
+            END
+        """)
+        op.execute("INSERT INTO pacientes_fts(pacientes_fts) VALUES ('rebuild')")
+
+    elif bind.dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute(
+            "CREATE INDEX ix_pacientes_nombre_normalizado_trgm "
+            "ON pacientes USING gin (nombre_normalizado gin_trgm_ops)"
+        )
+        op.execute(
+            "CREATE INDEX ix_pacientes_numero_trgm "
+            "ON pacientes USING gin (numero gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS pacientes_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS pacientes_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS pacientes_fts_ai")
+        op.execute("DROP TABLE IF EXISTS pacientes_fts")
+    elif bind.dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_pacientes_numero_trgm")
+        op.execute("DROP INDEX IF EXISTS ix_pacientes_nombre_normalizado_trgm")
+
+    with op.batch_alter_table('pacientes', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pacientes_nombre_normalizado'))
+        batch_op.drop_column('nombre_normalizado')
@@ -0,0 +1,46 @@
+"""indices compuestos para las rutas calientes
+
+Revision ID: 7c1e5a9d2f40
+Revises: de3ca7c49147
+Create Date: 2026-10-19 09:12:44.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5a9d2f40'
+down_revision = 'de3ca7c49147'
+branch_labels = None
+depends_on = None
+
+
+# (nombre, tabla, columnas) — mismo orden que en app/models.py (__table_args__)
+INDICES = [
+    ('ix_registro_enfermeria_paciente_fecha', 'registro_enfermeria', ['paciente_id', 'fecha_registro']),
+    ('ix_registro_enfermeria_historia_fecha', 'registro_enfermeria', ['historia_clinica_id', 'fecha_registro']),
+    ('ix_administracion_medicamento_registro_med', 'administracion_medicamento', ['registro_enfermeria_id', 'medicamento_id']),
+    ('ix_administracion_medicamento_medicamento', 'administracion_medicamento', ['medicamento_id']),
+    ('ix_historias_clinicas_paciente_fecha', 'historias_clinicas', ['paciente_id', 'fecha_registro']),
+    ('ix_ordenes_medicas_historia', 'ordenes_medicas', ['historia_id']),
+    ('ix_orden_laboratorio_items_orden', 'orden_laboratorio_items', ['orden_id']),
+    ('ix_signos_vitales_historia', 'signos_vitales', ['historia_id']),
+    ('ix_ayuda_diagnostica_historia_tipo', 'ayuda_diagnostica', ['historia_id', 'tipo']),
+    ('ix_cat_laboratorio_parametro_examen', 'cat_laboratorio_parametro', ['examen_id']),
+    ('ix_lab_solicitud_historia_fecha', 'lab_solicitud', ['historia_id', 'fecha_solicitud']),
+    ('ix_lab_resultado_solicitud_parametro', 'lab_resultado', ['solicitud_id', 'parametro_id']),
+    ('ix_lab_resultado_parametro', 'lab_resultado', ['parametro_id']),
+    ('ix_solicitudes_insumos_paciente_estado', 'solicitudes_insumos', ['paciente_id', 'estado']),
+    ('ix_insumos_paciente_paciente_insumo', 'insumos_paciente', ['paciente_id', 'insumo_id']),
+]
+
+
+def upgrade():
+    for nombre, tabla, columnas in INDICES:
+        op.create_index(nombre, tabla, columnas, unique=False)
+
+
+def downgrade():
+    for nombre, tabla, _ in reversed(INDICES):
+        op.drop_index(nombre, table_name=tabla)
@@ -0,0 +1,58 @@
+"""valor numerico de los resultados de laboratorio
+
+Revision ID: a3f8c2e6d4b1
+Revises: f1d4b7a2c8e6
+Create Date: 2026-10-19 19:05:41.377120
+
+"""
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f8c2e6d4b1'
+down_revision = 'f1d4b7a2c8e6'
+branch_labels = None
+depends_on = None
+
+
+def _numero(texto):
+    try:
+        valor = float(str(texto).strip().replace(',', '.'))
+    except ValueError:
+        return None
+    return valor if math.isfinite(valor) else None
+
+
+def upgrade():
+    # ADD COLUMN directo: un batch que recree la tabla borraría los triggers FTS de lab_resultado
+    op.add_column('lab_resultado', sa.Column('valor_num', sa.Float(), nullable=True))
+
+    conexion = op.get_bind()
+    ultimo_id = 0
+    while True:
+        filas = conexion.execute(sa.text(
+            "SELECT id, valor FROM lab_resultado WHERE id > :ultimo AND valor IS NOT NULL "
+            "ORDER BY id LIMIT 5000"
+        ), {'ultimo': ultimo_id}).all()
+        if not filas:
+            break
+        ultimo_id = filas[-1].id
+        valores = [{'id': f.id, 'num': _numero(f.valor)} for f in filas]
+        valores = [v for v in valores if v['num'] is not None]
+        if valores:
+            conexion.execute(sa.text("UPDATE lab_resultado SET valor_num = :num WHERE id = :id"), valores)
+
+    # Banderas con la misma regla de app/utils/rangos_laboratorio.py
+    op.execute("""
+        UPDATE lab_resultado SET flag_fuera_rango = CASE WHEN
+            valor_num < (SELECT p.valor_ref_min FROM cat_laboratorio_parametro p WHERE p.id = lab_resultado.parametro_id)
+            OR valor_num > (SELECT p.valor_ref_max FROM cat_laboratorio_parametro p WHERE p.id = lab_resultado.parametro_id)
+        THEN TRUE ELSE FALSE END
+    """)
+
+
+def downgrade():
+    op.drop_column('lab_resultado', 'valor_num')
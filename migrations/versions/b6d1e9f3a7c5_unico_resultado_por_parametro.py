@@ -0,0 +1,36 @@
+"""un resultado por parametro en cada solicitud de laboratorio
+
+Revision ID: b6d1e9f3a7c5
+Revises: a3f8c2e6d4b1
+Create Date: 2026-10-19 20:41:13.558902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d1e9f3a7c5'
+down_revision = 'a3f8c2e6d4b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Los duplicados que ya existan se resuelven como lo hacía la pantalla: vale el último
+    op.execute("""
+        DELETE FROM lab_resultado WHERE id NOT IN (
+            SELECT MAX(id) FROM lab_resultado GROUP BY solicitud_id, parametro_id
+        )
+    """)
+    # Índice único y no restricción de tabla: en SQLite no hay que recrear la tabla
+    # (se perderían los triggers FTS) y ON CONFLICT lo usa igual
+    op.drop_index('ix_lab_resultado_solicitud_parametro', table_name='lab_resultado')
+    op.create_index(
+        'uq_lab_resultado_solicitud_parametro', 'lab_resultado', ['solicitud_id', 'parametro_id'], unique=True
+    )
+
+
+def downgrade():
+    op.drop_index('uq_lab_resultado_solicitud_parametro', table_name='lab_resultado')
+    op.create_index('ix_lab_resultado_solicitud_parametro', 'lab_resultado', ['solicitud_id', 'parametro_id'])
@@ -0,0 +1,33 @@
+"""versiones de catalogos para invalidar caches en memoria
+
+Revision ID: b8e4f1a2c6d3
+Revises: 3f9b0d6e8a21
+Create Date: 2026-10-19 11:02:17.540913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e4f1a2c6d3'
+down_revision = '3f9b0d6e8a21'
+branch_labels = None
+depends_on = None
+
+
+CATALOGOS = ['cie10']
+
+
+def upgrade():
+    tabla = op.create_table('catalogo_versiones',
+    sa.Column('nombre', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('actualizado', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('nombre')
+    )
+    op.bulk_insert(tabla, [{'nombre': nombre, 'version': 1} for nombre in CATALOGOS])
+
+
+def downgrade():
+    op.drop_table('catalogo_versiones')
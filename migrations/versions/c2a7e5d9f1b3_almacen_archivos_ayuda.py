@@ -0,0 +1,48 @@
+"""almacen por contenido de los archivos de ayudas
+
+Revision ID: c2a7e5d9f1b3
+Revises: b6d1e9f3a7c5
+Create Date: 2026-10-19 22:05:37.201846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2a7e5d9f1b3'
+down_revision = 'b6d1e9f3a7c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'archivos_ayuda',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('tamano', sa.BigInteger(), nullable=False),
+        sa.Column('tipo_mime', sa.String(length=100), nullable=True),
+        sa.Column('referencias', sa.Integer(), nullable=False),
+        sa.Column('creado', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('sha256'),
+    )
+    # ayuda_diagnostica no tiene triggers FTS: se puede recrear con batch.
+    # Los archivos de antes siguen en ``archivo``
+    with op.batch_alter_table('ayuda_diagnostica', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archivo_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('nombre_archivo', sa.String(length=255), nullable=True))
+        batch_op.create_foreign_key(
+            'fk_ayuda_diagnostica_archivo_id', 'archivos_ayuda', ['archivo_id'], ['id']
+        )
+        batch_op.create_index('ix_ayuda_diagnostica_archivo_id', ['archivo_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('ayuda_diagnostica', schema=None) as batch_op:
+        batch_op.drop_index('ix_ayuda_diagnostica_archivo_id')
+        batch_op.drop_constraint('fk_ayuda_diagnostica_archivo_id', type_='foreignkey')
+        batch_op.drop_column('nombre_archivo')
+        batch_op.drop_column('archivo_id')
+    op.drop_table('archivos_ayuda')
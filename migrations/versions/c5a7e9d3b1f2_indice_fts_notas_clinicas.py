@@ -0,0 +1,81 @@
+"""indice FTS5 sobre el texto clinico (SOAP, antecedentes, notas, interpretacion)
+
+Revision ID: c5a7e9d3b1f2
+Revises: b8e4f1a2c6d3
+Create Date: 2026-10-19 11:48:05.201774
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a7e9d3b1f2'
+down_revision = 'b8e4f1a2c6d3'
+branch_labels = None
+depends_on = None
+
+
+# (tabla FTS, tabla de contenido, columnas indexadas)
+INDICES_FTS = [
+    ('historias_fts', 'historias_clinicas', [
+        'subjetivos', 'objetivos', 'analisis', 'plan',
+        'antecedentes_medicos', 'antecedentes_farmacologicos', 'antecedentes_quirurgicos',
+        'antecedentes_toxicos', 'antecedentes_alergicos', 'antecedentes_ginecobstetricos',
+    ]),
+    ('notas_enfermeria_fts', 'registro_enfermeria', ['texto_nota']),
+    ('lab_interpretacion_fts', 'lab_resultado', ['interpretacion']),
+]
+
+
+def _crear_indice(fts, tabla, columnas):
+    lista = ', '.join(columnas)
+    nuevos = ', '.join(f'new.{c}' for c in columnas)
+    viejos = ', '.join(f'old.{c}' for c in columnas)
+
+    # unicode61 sin diacríticos: 'neumonía' y 'neumonia' son el mismo término
+    op.execute(f"""
+        CREATE VIRTUAL TABLE {fts} USING fts5(
+            {lista},
+            content='{tabla}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='3'
+        )
+    """)
+    op.execute(f"""
+        CREATE TRIGGER {fts}_ai AFTER INSERT ON {tabla} BEGIN
+            INSERT INTO {fts}(rowid, {lista}) VALUES (new.id, {nuevos});
+        END
+    """)
+    op.execute(f"""
+        CREATE TRIGGER {fts}_ad AFTER DELETE ON {tabla} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+        END
+    """)
+    # Solo se reindexa si cambió alguna columna de texto
+    op.execute(f"""
+        CREATE TRIGGER {fts}_au AFTER UPDATE OF {lista} ON {tabla} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+            INSERT INTO {fts}(rowid, {lista}) VALUES (new.id, {nuevos});
+        END
+    """)
+    op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def upgrade():
+    # FTS5 es propio de SQLite; en otros motores la búsqueda usa ILIKE
+    # (ver app/utils/busqueda_clinica.py)
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for fts, tabla, columnas in INDICES_FTS:
+        _crear_indice(fts, tabla, columnas)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for fts, _tabla, _columnas in reversed(INDICES_FTS):
+        for sufijo in ('au', 'ad', 'ai'):
+            op.execute(f"DROP TRIGGER IF EXISTS {fts}_{sufijo}")
+        op.execute(f"DROP TABLE IF EXISTS {fts}")
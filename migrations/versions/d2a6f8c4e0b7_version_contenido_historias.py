@@ -0,0 +1,28 @@
+"""version de contenido de la historia para la cache de PDF
+
+Revision ID: d2a6f8c4e0b7
+Revises: c5a7e9d3b1f2
+Create Date: 2026-10-19 14:21:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a6f8c4e0b7'
+down_revision = 'c5a7e9d3b1f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ADD COLUMN directo: un batch que recree la tabla borraría los triggers FTS de historias_clinicas
+    op.add_column('historias_clinicas', sa.Column(
+        'version_contenido', sa.Integer(), nullable=False, server_default='0'
+    ))
+
+
+def downgrade():
+    # SQLite >= 3.35 admite DROP COLUMN sin recrear la tabla
+    op.drop_column('historias_clinicas', 'version_contenido')
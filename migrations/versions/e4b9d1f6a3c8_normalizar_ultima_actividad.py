@@ -0,0 +1,30 @@
+"""normalizar ultima_actividad de pacientes en SQLite
+
+Revision ID: e4b9d1f6a3c8
+Revises: c2a7e5d9f1b3
+Create Date: 2026-10-20 09:14:37.215482
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b9d1f6a3c8'
+down_revision = 'c2a7e5d9f1b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Bases que ya pasaron por f1d4b7a2c8e6 antes de que normalizara: el relleno con
+    # CURRENT_TIMESTAMP quedó sin decimales y el cursor del listado no avanzaba sobre esas filas
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("""
+            UPDATE pacientes SET ultima_actividad = strftime('%Y-%m-%d %H:%M:%f000', ultima_actividad)
+            WHERE ultima_actividad IS NOT NULL
+              AND (length(ultima_actividad) <> 26 OR substr(ultima_actividad, 11, 1) <> ' ')
+        """)
+
+
+def downgrade():
+    pass
@@ -0,0 +1,27 @@
+"""version de los registros de enfermeria del paciente para la cache de PDF
+
+Revision ID: e7c3a1f5b9d2
+Revises: d2a6f8c4e0b7
+Create Date: 2026-10-19 16:05:12.447921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c3a1f5b9d2'
+down_revision = 'd2a6f8c4e0b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pacientes', sa.Column(
+        'version_enfermeria', sa.Integer(), nullable=False, server_default='0'
+    ))
+
+
+def downgrade():
+    # SQLite >= 3.35 admite DROP COLUMN sin recrear la tabla
+    op.drop_column('pacientes', 'version_enfermeria')
@@ -0,0 +1,67 @@
+"""ultima actividad del paciente para el listado paginado
+
+Revision ID: f1d4b7a2c8e6
+Revises: e7c3a1f5b9d2
+Create Date: 2026-10-19 17:32:08.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1d4b7a2c8e6'
+down_revision = 'e7c3a1f5b9d2'
+branch_labels = None
+depends_on = None
+
+
+def _trigger_fts(columnas):
+    op.execute("DROP TRIGGER IF EXISTS pacientes_fts_au")
+    op.execute(f"""
+        CREATE TRIGGER pacientes_fts_au AFTER UPDATE {columnas}ON pacientes BEGIN
+            INSERT INTO pacientes_fts(pacientes_fts, rowid, nombre_normalizado, numero)
+            VALUES ('delete', old.id, old.nombre_normalizado, old.numero);
+            INSERT INTO pacientes_fts(rowid, nombre_normalizado, numero)
+            VALUES (new.id, new.nombre_normalizado, new.numero);
+        END
+    """)
+
+
+# SQLite guarda los DateTime de SQLAlchemy como texto 'AAAA-MM-DD HH:MM:SS.ffffff' y
+# compara como texto: CURRENT_TIMESTAMP (sin fracción) o fechas cargadas por fuera quedarían
+# desordenadas frente a los cursores del listado, que siempre llevan los seis decimales
+NORMALIZAR_SQLITE = """
+    UPDATE pacientes SET ultima_actividad = strftime('%Y-%m-%d %H:%M:%f000', ultima_actividad)
+    WHERE ultima_actividad IS NOT NULL
+      AND (length(ultima_actividad) <> 26 OR substr(ultima_actividad, 11, 1) <> ' ')
+"""
+
+
+def upgrade():
+    # ADD COLUMN directo: un batch que recree la tabla borraría los triggers FTS de pacientes
+    op.add_column('pacientes', sa.Column('ultima_actividad', sa.DateTime(), nullable=True))
+    op.execute("""
+        UPDATE pacientes SET ultima_actividad = COALESCE(
+            (SELECT MAX(f) FROM (
+                SELECT MAX(h.fecha_registro) AS f FROM historias_clinicas h WHERE h.paciente_id = pacientes.id
+                UNION ALL
+                SELECT MAX(r.fecha_registro) FROM registro_enfermeria r WHERE r.paciente_id = pacientes.id
+            ) AS actividad),
+            CURRENT_TIMESTAMP
+        )
+    """)
+    op.create_index('ix_pacientes_ultima_actividad', 'pacientes', ['ultima_actividad', 'id'])
+
+    if op.get_bind().dialect.name == 'sqlite':
+        # Las versiones y la actividad se actualizan a menudo: el índice FTS solo
+        # debe reescribirse cuando cambian las columnas que indexa
+        _trigger_fts('OF nombre_normalizado, numero ')
+        op.execute(NORMALIZAR_SQLITE)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        _trigger_fts('')
+    op.drop_index('ix_pacientes_ultima_actividad', table_name='pacientes')
+    op.drop_column('pacientes', 'ultima_actividad')